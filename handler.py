@@ -1,365 +1,4431 @@
+import codecs
+import gzip
+import heapq
+import io
 import json
+import math
 import os
-import requests
-import boto3
+import re
+import struct
+import sys
+import threading
 import time
 import uuid
-from typing import Any, Dict, Optional, List
+import zlib
+from itertools import accumulate
+from operator import mul
+from typing import Any, Callable, Dict, Iterator, Optional, List, Tuple
 from datetime import datetime
+from decimal import Decimal
 
-from boto3.dynamodb.conditions import Key
+# boto3 and requests are imported on first use (see CLIENTS below) so that
+# invocations which never touch storage, such as /help, skip their import cost.
 
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN", "")
 TELEGRAM_API = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
 
 OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://host.docker.internal:11434")
+OLLAMA_ENABLED = os.environ.get("OLLAMA_ENABLED", "").lower() in ("1", "true", "yes")
+# Model routing - extra endpoints to fail over to, and a smaller model to fall back on
+OLLAMA_URLS = [u.strip().rstrip('/') for u in os.environ.get("OLLAMA_URLS", "").split(",") if u.strip()]
+OLLAMA_FALLBACK_MODEL = os.environ.get("OLLAMA_FALLBACK_MODEL", "")
+OLLAMA_TIMEOUT = float(os.environ.get("OLLAMA_TIMEOUT", "60"))
+OLLAMA_MAX_ATTEMPTS = 2  # targets tried per chat turn
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", "3"))  # consecutive failures that open a breaker
+BREAKER_SLOW_MS = float(os.environ.get("BREAKER_SLOW_MS", "20000"))  # slower calls count as failures
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", "30"))  # seconds open before a half-open probe
+ROUTE_P95_MS = float(os.environ.get("ROUTE_P95_MS", "15000"))  # rolling p95 above this prefers other targets
+ROUTE_WINDOW = 20  # latency samples kept per target
+ROUTE_MIN_SAMPLES = 5  # samples needed before a target is first passed over as slow
+ROUTE_SAMPLE_MAX_AGE = float(os.environ.get("ROUTE_SAMPLE_MAX_AGE", "300"))  # seconds a latency sample counts
+CONTEXT_MAX_MESSAGES = int(os.environ.get("CONTEXT_MAX_MESSAGES", "20"))
+# Long-term memory - earlier user messages recalled by embedding similarity
+MEMORY_ENABLED = os.environ.get("MEMORY_ENABLED", "").lower() in ("1", "true", "yes")
+EMBED_MODEL = os.environ.get("EMBED_MODEL", "nomic-embed-text")
+MEMORY_TOP_K = int(os.environ.get("MEMORY_TOP_K", "3"))
+MEMORY_MIN_SCORE = float(os.environ.get("MEMORY_MIN_SCORE", "0.5"))  # cosine similarity
+MEMORY_BATCH = int(os.environ.get("MEMORY_BATCH", "16"))  # pending messages embedded together
+MEMORY_MIN_CHARS = 20  # shorter messages ("ok", "thanks") are not worth remembering
+MEMORY_SCAN_LIMIT = 5000  # most recent vectors searched without NumPy (about 0.3s at 768 dimensions)
+MEMORY_MAX_SEGMENTS = int(os.environ.get("MEMORY_MAX_SEGMENTS", "16"))  # more are merged into one
+MEMORY_CACHE_BYTES = int(os.environ.get("MEMORY_CACHE_BYTES", str(32 * 1024 * 1024)))  # loaded indexes kept per container
+MEMORY_SK = 'MEMORY'
+MEMORY_PREFIX = 'memory'
+# Full-text search - per-user inverted index over session and archive messages
+SEARCH_ENABLED = os.environ.get("SEARCH_ENABLED", "1").lower() in ("1", "true", "yes")
+SEARCH_BATCH = int(os.environ.get("SEARCH_BATCH", "32"))  # pending messages indexed together
+SEARCH_MAX_SEGMENTS = int(os.environ.get("SEARCH_MAX_SEGMENTS", "16"))  # more are merged into one
+SEARCH_CACHE_BYTES = int(os.environ.get("SEARCH_CACHE_BYTES", str(32 * 1024 * 1024)))  # decoded segments kept per container
+SEARCH_MAX_DOC_CHARS = 2000  # indexed prefix of long messages
+SEARCH_SNIPPET_CHARS = 80
+SEARCH_MAX_RESULTS = 5
+SEARCH_SK = 'SEARCH'
+SEARCH_PREFIX = 'search'
+
+# Usage counters - totals per user, per model and per day, kept with ADD so /stats never scans
+USAGE_ENABLED = os.environ.get("USAGE_ENABLED", "1").lower() in ("1", "true", "yes")
+USAGE_SHARDS = int(os.environ.get("USAGE_SHARDS", "8"))  # items per bot-wide counter; only ever raise it
+USAGE_SK = 'USAGE'
+USAGE_PK = -1  # bot-wide counter shards live at pk -1 .. -USAGE_SHARDS, away from user partitions
+USAGE_MAX_DAYS = 31
+ADMIN_USER_IDS = frozenset(int(u) for u in os.environ.get("ADMIN_USER_IDS", "").split(",") if u.strip().isdigit())
+
+# Storage - 'aws' (DynamoDB + S3), or 'sqlite' / 'memory' for single-node runs (see storage.py)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'aws').lower()
+STORAGE_PATH = os.environ.get('STORAGE_PATH', 'chatbot-data')  # sqlite: items.db and objects/ live here
 
 # DynamoDB setup - use environment variable for region if set
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table('chatbot-sessions')
+TABLE_NAME = os.environ.get('TABLE_NAME', 'chatbot-sessions')
 OFFSET_PK = 0
 OFFSET_SK = 'last_update_id'
+ACTIVE_SK = 'ACTIVE'  # per-user pointer to the active session's sk, read by the polling prefetch
+UPDATE_SK = 'UPDATE'  # pk=user, sk=UPDATE#<update_id>: an update whose handling has started
+UPDATE_CLAIM_TTL = 24 * 3600  # Telegram drops undelivered updates after a day
+POLL_LIMIT = int(os.environ.get('POLL_LIMIT', '100'))  # updates per getUpdates call (Telegram allows 1-100)
 
 # S3 setup - bucket name can come from environment variable
 S3_BUCKET_NAME = os.environ.get('S3_BUCKET_NAME', 'chatbot-conversations')
-s3_client = boto3.client('s3')
 ARCHIVE_BUCKET = S3_BUCKET_NAME
 ARCHIVE_PREFIX = 'archives'
 
+# Multiple bots - TELEGRAM_BOTS adds comma-separated bot tokens next to TELEGRAM_TOKEN.
+# All bots share TABLE_NAME and S3_BUCKET_NAME, each extra bot under keys of its own;
+# polling workers share the bots out through leases in TABLE_NAME (see BOTS)
+TELEGRAM_BOTS = os.environ.get("TELEGRAM_BOTS", "")
+BOT_PK_SPAN = 10 ** 16  # an extra bot's pks are bot id * span + pk; Telegram ids stay below 2**52
+BOT_LEASE_TTL = float(os.environ.get('BOT_LEASE_TTL', '30'))  # seconds a lease outlives its last heartbeat
+POLL_MAX_BOTS = int(os.environ.get('POLL_MAX_BOTS', '0'))  # bots one polling worker holds at most, 0 = even share
+POLL_WORKER_PREFIX = 'POLL#WORKER#'
+POLL_LEASE_PREFIX = 'POLL#LEASE#'
 
-def get_last_offset() -> int:
-    """Fetch the last processed update_id from DynamoDB (default 0 if none)."""
-    try:
-        response = table.get_item(Key={'pk': OFFSET_PK, 'sk': OFFSET_SK})
-        if 'Item' in response:
-            return int(response['Item'].get('last_offset', 0))
-    except Exception as e:
-        print(f"Error getting offset: {e}")
-    return 0
+# Archive page index - lets restored sessions read old history a page at a time
+ARCHIVE_INDEX_PREFIX = 'archive-index'
+ARCHIVE_PAGE_SIZE = int(os.environ.get('ARCHIVE_PAGE_SIZE', '50'))
+RESTORE_TAIL_MESSAGES = int(os.environ.get('RESTORE_TAIL_MESSAGES', '20'))
+COLD_PAGE_CACHE_SIZE = 64
+
+# Hot/cold tiering - older turns of long sessions spill into immutable S3 segments
+SEGMENT_PREFIX = 'segments'
+INLINE_MAX_MESSAGES = int(os.environ.get('INLINE_MAX_MESSAGES', '50'))
+INLINE_MAX_BYTES = int(os.environ.get('INLINE_MAX_BYTES', str(200 * 1024)))
+SPILL_BATCH_MESSAGES = int(os.environ.get('SPILL_BATCH_MESSAGES', '50'))
+SEGMENT_MAX_MESSAGES = int(os.environ.get('SEGMENT_MAX_MESSAGES', '1000'))
+
+# Archive bundles - compaction packs many small per-session archives into one object
+BUNDLE_DIR = 'bundles'
+BUNDLE_MANIFEST_PREFIX = 'bundle-index'  # outside archives/, so the lifecycle rule never moves it to Glacier
+BUNDLE_MANIFEST_RETRIES = 5
+BUNDLE_FOOTER = struct.Struct('>QI4s')  # index offset, index length, magic
+BUNDLE_MAGIC = b'CAB1'
+COMPACT_MIN_ARCHIVES = int(os.environ.get('COMPACT_MIN_ARCHIVES', '10'))
+COMPACT_MAX_BUNDLE_BYTES = int(os.environ.get('COMPACT_MAX_BUNDLE_BYTES', str(32 * 1024 * 1024)))
+
+# Archive import limits - uploads are streamed and rejected as soon as a cap is hit
+IMPORT_MAX_BYTES = int(os.environ.get('IMPORT_MAX_BYTES', str(5 * 1024 * 1024)))
+IMPORT_MAX_MESSAGES = int(os.environ.get('IMPORT_MAX_MESSAGES', '10000'))
+IMPORT_MAX_ENTRY_BYTES = int(os.environ.get('IMPORT_MAX_ENTRY_BYTES', str(64 * 1024)))
+IMPORT_CHUNK_SIZE = 64 * 1024
+IMPORT_ROLES = ('user', 'assistant', 'system')
+
+# /export all - archives are zipped as they arrive and sent in parts; bots may upload at most 50 MB
+EXPORT_PART_BYTES = int(os.environ.get('EXPORT_PART_BYTES', str(48 * 1024 * 1024)))
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', '8'))  # concurrent archive fetches
+EXPORT_ZIP_LEVEL = 6
+
+# Outbound sends - Telegram allows about 1 msg/s per chat (short bursts are fine)
+# and about 30 msg/s per bot, and rejects texts over 4096 characters
+TELEGRAM_MAX_TEXT = 4096
+SEND_CHAT_RATE = float(os.environ.get('SEND_CHAT_RATE', '1'))  # messages per second, 0 = unlimited
+SEND_CHAT_BURST = int(os.environ.get('SEND_CHAT_BURST', '3'))
+SEND_GLOBAL_RATE = float(os.environ.get('SEND_GLOBAL_RATE', '30'))
+SEND_GLOBAL_BURST = int(os.environ.get('SEND_GLOBAL_BURST', '30'))
+SEND_MAX_WAIT = float(os.environ.get('SEND_MAX_WAIT', '10'))  # seconds an invocation waits to drain its replies
+SEND_MAX_ATTEMPTS = 5
+OUTBOX_SK = 'OUTBOX'  # at pk OFFSET_PK: replies an invocation ran out of time to send
+OUTBOX_TTL = 24 * 3600
+OUTBOX_CHECK_INTERVAL = float(os.environ.get('OUTBOX_CHECK_INTERVAL', '5'))  # seconds between checks per container
+
+# Per-user rate limits per command class, as "class=count/seconds": each user
+# may burst `count` requests and then gets `count` more per `seconds`
+RATE_LIMITS = os.environ.get('RATE_LIMITS', 'chat=10/60,command=30/60,heavy=5/300')
+RATE_LIMIT_SHARED = os.environ.get('RATE_LIMIT_SHARED', '').lower() in ('1', 'true', 'yes')  # count in DynamoDB too
+RATE_NOTICE_INTERVAL = 10  # seconds between "slow down" replies to the same user
+HEAVY_COMMANDS = ('/export', '/restore', '/archive')
+MODEL_MAX_IN_FLIGHT = int(os.environ.get('MODEL_MAX_IN_FLIGHT', '4'))  # concurrent model calls, 0 = unlimited
+MODEL_SLOT_TTL = 120  # seconds before a shared model slot held by a crashed invocation is reclaimed
+
+# JSON - 'auto' uses orjson when it is installed (optional, see JSON), 'stdlib' always uses json
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto').lower()
+
+# Set PRIME_ON_INIT to build clients during init (SnapStart / provisioned concurrency)
+PRIME_ON_INIT = os.environ.get('PRIME_ON_INIT', '').lower() in ('1', 'true', 'yes')
+# Connections kept per host by each client (raised by server.py to match its worker pool)
+POOL_CONNECTIONS = int(os.environ.get('POOL_CONNECTIONS', '10'))
+# Time budget - taken from the Lambda context; none when run outside Lambda
+DEADLINE_MARGIN = 0.5  # seconds before the Lambda timeout that count as the deadline
+DEADLINE_RESERVE_MS = int(os.environ.get('DEADLINE_RESERVE_MS', '3000'))  # kept back for saving, replies, metrics
+UPDATE_MIN_BUDGET_MS = int(os.environ.get('UPDATE_MIN_BUDGET_MS', '5000'))  # polling starts no update with less left
+
+
+# Observability - leveled logging and per-invocation stage timings
+LOG_LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+LOG_LEVEL = LOG_LEVELS.get(os.environ.get('LOG_LEVEL', 'INFO').upper(), 20)
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0'))  # share of invocations logged at DEBUG
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'TelegramChatbot')
+# emf: CloudWatch Embedded Metric Format on stdout, file: JSON lines in METRICS_FILE, off
+METRICS_SINK = os.environ.get('METRICS_SINK', 'emf' if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') else 'file').lower()
+METRICS_FILE = os.environ.get('METRICS_FILE', '/tmp/chatbot-metrics.jsonl')
+
+
+# ==================== OBSERVABILITY ====================
+#
+# Logging is leveled and lazily formatted: callers pass a %-format string and
+# arguments, and nothing is formatted unless the line is actually written.
+# A sampled share of invocations logs at DEBUG regardless of LOG_LEVEL.
+#
+# Every DynamoDB, S3, Telegram and Ollama call goes through a traced client
+# (see CLIENTS) that adds its duration to a per-invocation stage total. At the
+# end of each invocation lambda_handler emits one metrics record with those
+# totals. State is thread-local so concurrent invocations in one process
+# (local replay, self-hosted servers) keep separate breakdowns, and so does
+# the DEBUG sampling decision.
+
+_trace = threading.local()
+_cold_start = True
+
+
+def _log(level: int, name: str, msg: str, args: tuple):
+    if level >= getattr(_trace, 'log_threshold', LOG_LEVEL):
+        print(f"[{name}] {msg % args if args else msg}")
+
+
+def log_debug(msg: str, *args):
+    _log(10, 'DEBUG', msg, args)
+
+
+def log_info(msg: str, *args):
+    _log(20, 'INFO', msg, args)
+
+
+def log_warning(msg: str, *args):
+    _log(30, 'WARNING', msg, args)
+
+
+def log_error(msg: str, *args, exc_info: bool = False):
+    """Log at ERROR; also counted in the invocation's `errors` metric."""
+    _trace.errors = getattr(_trace, 'errors', 0) + 1
+    _log(40, 'ERROR', msg, args)
+    if exc_info:
+        import traceback
+        traceback.print_exc()
 
 
-def save_offset(update_id: int):
-    """Save the new last processed update_id to DynamoDB."""
+def record_span(stage: str, elapsed_ms: float):
+    """Add one call of elapsed_ms to the current invocation's total for stage."""
+    stages = getattr(_trace, 'stages', None)
+    if stages is None:
+        stages = _trace.stages = {}
+    entry = stages.get(stage)
+    if entry is None:
+        stages[stage] = [1, elapsed_ms]
+    else:
+        entry[0] += 1
+        entry[1] += elapsed_ms
+
+
+class span:
+    """Time a block of code as one call of a stage: `with span('encode'): ...`."""
+    __slots__ = ('stage', 'started')
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_span(self.stage, (time.perf_counter() - self.started) * 1000.0)
+        return False
+
+
+def begin_invocation(remaining_ms: Optional[int] = None):
+    """
+    Reset stage timings, set the deadline `remaining_ms` from now (none if
+    None) and decide whether this invocation is sampled for DEBUG logs.
+    """
+    _trace.stages = {}
+    _trace.counters = {}
+    _trace.command = None
+    _trace.errors = 0
+    _trace.usage = {}
+    _trace.deadline = time.monotonic() + remaining_ms / 1000.0 - DEADLINE_MARGIN if remaining_ms is not None else None
+    _trace.log_threshold = LOG_LEVEL
+    if LOG_SAMPLE_RATE > 0:
+        import random
+        _trace.log_threshold = 10 if random.random() < LOG_SAMPLE_RATE else LOG_LEVEL
+
+
+class DeadlineExceeded(Exception):
+    """The invocation ran out of time before a backend call could start."""
+
+
+def time_left() -> float:
+    """Seconds until this invocation's deadline (infinite without one)."""
+    deadline = getattr(_trace, 'deadline', None)
+    return deadline - time.monotonic() if deadline is not None else float('inf')
+
+
+def budget_timeout(timeout: Any) -> Any:
+    """Clamp a requests timeout (seconds or (connect, read)) to the time left; DeadlineExceeded if none is."""
+    left = time_left()
+    if left <= 0:
+        incr_metric('deadline_exceeded')
+        raise DeadlineExceeded("invocation deadline passed")
+    if isinstance(timeout, tuple):
+        return tuple(min(t, left) for t in timeout)
+    return min(timeout, left)
+
+
+def incr_metric(name: str, value: int = 1):
+    """Add to a per-invocation counter, emitted alongside the stage timings."""
+    counters = getattr(_trace, 'counters', None)
+    if counters is None:
+        counters = _trace.counters = {}
+    counters[name] = counters.get(name, 0) + value
+
+
+def set_trace_command(command: str):
+    """Label the invocation (command name, 'chat' or 'document') for the metrics record."""
+    _trace.command = command
+
+
+_emf_directives: Dict[tuple, Dict[str, Any]] = {}
+
+
+def _emf_directive(names: tuple) -> Dict[str, Any]:
+    """EMF metric declaration for a set of metric names (few distinct sets, so cached)."""
+    directive = _emf_directives.get(names)
+    if directive is None:
+        directive = _emf_directives[names] = {
+            'Namespace': METRICS_NAMESPACE,
+            'Dimensions': [['mode', 'command']],
+            'Metrics': [{'Name': n, 'Unit': 'Milliseconds' if n.endswith('_ms') else 'Count'} for n in names],
+        }
+    return directive
+
+
+def emit_metrics(mode: str, handler_ms: float, updates: int, errors: int):
+    """Write the invocation's stage breakdown to the configured metrics sink."""
+    global _cold_start
+    if METRICS_SINK == 'off':
+        _cold_start = False
+        return
+    stages = getattr(_trace, 'stages', None) or {}
+    record = {
+        'mode': mode,
+        'command': 'batch' if mode == 'polling' else (getattr(_trace, 'command', None) or 'none'),
+        'handler_ms': round(handler_ms, 3),
+        'updates': updates,
+        'errors': errors,
+        'cold_start': 1 if _cold_start else 0,
+    }
+    _cold_start = False
+    traced_ms = 0.0
+    for stage, (calls, total_ms) in stages.items():
+        record[f"{stage}_ms"] = round(total_ms, 3)
+        record[f"{stage}_calls"] = calls
+        traced_ms += total_ms
+    record['compute_ms'] = round(max(handler_ms - traced_ms, 0.0), 3)
+    record.update(getattr(_trace, 'counters', None) or {})
+
     try:
-        table.put_item(
-            Item={
-                'pk': OFFSET_PK,
-                'sk': OFFSET_SK,
-                'last_offset': update_id,
-                'last_updated_ts': int(time.time())
+        if METRICS_SINK == 'emf':
+            record['_aws'] = {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [_emf_directive(tuple(k for k in record if k not in ('mode', 'command')))],
             }
-        )
-        print(f"Saved offset: {update_id}")
+            print(json_text(record))
+        else:
+            record['ts'] = round(time.time(), 3)
+            with open(METRICS_FILE, 'ab') as f:
+                f.write(json_dumps(record) + b'\n')
     except Exception as e:
-        print(f"Error saving offset: {e}")
+        log_warning("Error writing metrics: %s", e)
 
 
-def poll_messages(offset: int = 0) -> Dict[str, Any]:
-    """Poll Telegram getUpdates with offset to avoid reprocessing."""
-    if not TELEGRAM_TOKEN:
-        return {"ok": False, "error": "TELEGRAM_TOKEN not set"}
-    try:
-        params = {"limit": 5, "timeout": 0}
-        if offset > 0:
-            params["offset"] = offset
+def _io_stage(service: str, operation: str) -> str:
+    read = operation.startswith(('get', 'head', 'list', 'query', 'scan', 'batch_get'))
+    return f"{service}_{'read' if read else 'write'}"
 
-        print(f"Polling with offset: {offset}")
-        resp = requests.get(f"{TELEGRAM_API}/getUpdates", params=params, timeout=10)
-        return resp.json()
-    except Exception as e:
-        return {"ok": False, "error": str(e)}
 
+class TracedClient:
+    """Proxy for a boto3 client that records every API call as a span.
 
-def send_message(chat_id: int, text: str) -> Optional[Dict[str, Any]]:
-    """Send a message back to Telegram."""
-    if not TELEGRAM_TOKEN:
-        return None
-    payload = {"chat_id": chat_id, "text": text}
-    try:
-        resp = requests.post(f"{TELEGRAM_API}/sendMessage", json=payload, timeout=10)
-        return resp.json()
-    except Exception:
-        return None
+    DynamoDB and S3 calls are split into `<service>_read` and `<service>_write`
+    stages. Wrapped methods are cached on the proxy, so after the first call
+    the only overhead is two perf_counter() reads.
+    """
 
+    def __init__(self, client, service: str):
+        self._client = client
+        self._service = service
 
-def send_document(chat_id: int, file_content: bytes, filename: str, caption: str = "") -> Optional[Dict[str, Any]]:
-    """Send a document/file to Telegram chat."""
-    if not TELEGRAM_TOKEN:
-        return None
-    try:
-        files = {'document': (filename, file_content, 'application/json')}
-        data = {'chat_id': chat_id}
-        if caption:
-            data['caption'] = caption
-        resp = requests.post(f"{TELEGRAM_API}/sendDocument", data=data, files=files, timeout=30)
-        return resp.json()
-    except Exception as e:
-        print(f"Error sending document: {e}")
-        return None
+    def __getattr__(self, name: str):
+        attr = getattr(self._client, name)
+        if name in ('exceptions', 'meta') or name.startswith('_') or not callable(attr):
+            return attr
+        if name == 'get_paginator':
+            def get_paginator(operation):
+                return _TracedPaginator(attr(operation), _io_stage(self._service, operation))
+            wrapped = get_paginator
+        else:
+            stage = _io_stage(self._service, name)
 
+            def wrapped(*args, **kwargs):
+                if getattr(_trace, 'deadline', None) is not None and time_left() <= 0:
+                    incr_metric('deadline_exceeded')
+                    raise DeadlineExceeded(f"no time left for {self._service}.{name}")
+                started = time.perf_counter()
+                try:
+                    return attr(*args, **kwargs)
+                finally:
+                    record_span(stage, (time.perf_counter() - started) * 1000.0)
+        self.__dict__[name] = wrapped
+        return wrapped
 
-def get_telegram_file(file_id: str) -> Optional[bytes]:
-    """Download a file from Telegram by file_id."""
-    if not TELEGRAM_TOKEN:
-        return None
+
+class _TracedPaginator:
+    def __init__(self, paginator, stage: str):
+        self._paginator = paginator
+        self._stage = stage
+
+    def paginate(self, **kwargs):
+        pages = iter(self._paginator.paginate(**kwargs))
+        while True:
+            started = time.perf_counter()
+            try:
+                page = next(pages)
+            except StopIteration:
+                return
+            finally:
+                record_span(self._stage, (time.perf_counter() - started) * 1000.0)
+            yield page
+
+
+class TracedHTTP:
+    """
+    Proxy for the requests session; Bot API calls are 'telegram', the rest (Ollama) 'ollama'.
+
+    Timeouts are cut down to the invocation's remaining time.
+    """
+
+    def __init__(self, session):
+        self._session = session
+
+    def _call(self, method: str, url: str, **kwargs):
+        stage = 'telegram' if url.startswith('https://api.telegram.org') else 'ollama'
+        if kwargs.get('timeout') is not None:
+            kwargs['timeout'] = budget_timeout(kwargs['timeout'])
+        started = time.perf_counter()
+        try:
+            return getattr(self._session, method)(url, **kwargs)
+        finally:
+            record_span(stage, (time.perf_counter() - started) * 1000.0)
+
+    def get(self, url: str, **kwargs):
+        return self._call('get', url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self._call('post', url, **kwargs)
+
+    def close(self):
+        self._session.close()
+
+
+# ==================== JSON ====================
+#
+# JSON goes through json_dumps() (bytes out; json_text() where an API wants
+# str) and json_loads() (bytes or str in). orjson is used when it is installed, the standard library otherwise.
+# Both produce the same compact UTF-8 output, not \u-escaped. json_default
+# covers the types neither encoder knows: Decimals from DynamoDB, Message, and
+# datetime for the standard library (orjson encodes datetime itself, also as
+# ISO 8601). orjson is optional; add it to requirements.txt to bundle it.
+#
+# Log lines take Preview(value) instead of a serialized copy. It renders only
+# when the line is written, and only as much of the value as fits the limit.
+#
+# The incremental archive import parser needs json.JSONDecoder.raw_decode,
+# which orjson has no counterpart for, so it always uses the standard library.
+
+_orjson = None
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+
+def json_default(value: Any) -> Any:
+    """Encoder fallback: DynamoDB Decimals become numbers, Messages dicts, datetimes ISO 8601, anything else a string."""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, Message):
+        return value.as_dict()
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+_json_compact = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False, default=json_default)
+_json_pretty = json.JSONEncoder(indent=2, ensure_ascii=False, default=json_default)
+_encode_json_str = json.encoder.encode_basestring  # quoted and escaped like _json_compact does
+
+
+def get_orjson():
+    """orjson if it is installed and JSON_BACKEND allows it, else None (it is optional)."""
+    global _orjson
+    if _orjson is None:
+        _orjson = False
+        if JSON_BACKEND != 'stdlib':
+            try:
+                import orjson
+                _orjson = orjson
+            except ImportError:
+                if JSON_BACKEND == 'orjson':
+                    log_warning("JSON_BACKEND=orjson but orjson is not installed; using json")
+    return _orjson or None
+
+
+def json_dumps(value: Any, pretty: bool = False) -> bytes:
+    """Encode as UTF-8 JSON, compact or indented by two spaces."""
+    orjson = get_orjson()
+    if orjson:
+        try:
+            return orjson.dumps(value, default=json_default,
+                                option=orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0))
+        except TypeError:
+            pass  # integers past 64 bits and the like; the standard library copes
+    return (_json_pretty if pretty else _json_compact).encode(value).encode('utf-8')
+
+
+def json_text(value: Any) -> str:
+    """json_dumps as a str, for APIs that want text (Lambda proxy bodies, log lines, DynamoDB strings)."""
+    if get_orjson():
+        return json_dumps(value).decode('utf-8')
+    return _json_compact.encode(value)
+
+
+def json_loads(data: Any) -> Any:
+    """Decode JSON from bytes or str. Errors are json.JSONDecodeError (orjson's subclasses it)."""
+    orjson = get_orjson()
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class Preview:
+    """Log argument: `value` as JSON, cut at `limit` characters and rendered only when logged."""
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value: Any, limit: int = 500):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self) -> str:
+        parts: List[str] = []
+        _preview_into(self.value, parts, self.limit)
+        text = ''.join(parts)
+        return text if len(text) <= self.limit else text[:self.limit] + '...'
+
+
+def _preview_into(value: Any, parts: List[str], budget: int) -> int:
+    """Append value's JSON to parts until budget characters are used; returns what is left."""
+    if budget <= 0:
+        return budget
+    if isinstance(value, Message):
+        value = value.as_dict()
+    if isinstance(value, dict):
+        parts.append('{')
+        budget -= 1
+        for i, (key, item) in enumerate(value.items()):
+            if budget <= 0:
+                break
+            key = _encode_json_str(str(key))
+            parts.append(f"{', ' if i else ''}{key}: ")
+            budget = _preview_into(item, parts, budget - len(key) - (4 if i else 2))
+        parts.append('}')
+        return budget - 1
+    if isinstance(value, (list, tuple)):
+        parts.append('[')
+        budget -= 1
+        for i, item in enumerate(value):
+            if budget <= 0:
+                break
+            if i:
+                parts.append(', ')
+                budget -= 2
+            budget = _preview_into(item, parts, budget)
+        parts.append(']')
+        return budget - 1
+    if isinstance(value, (str, bytes)):
+        if isinstance(value, bytes):
+            value = value[:budget + 1].decode('utf-8', 'replace')
+        text = _encode_json_str(value[:budget + 1])  # no need to encode what will be cut off
+    elif value is None or isinstance(value, (bool, int)):
+        text = 'null' if value is None else ('true' if value is True else 'false' if value is False else str(value))
+    else:
+        text = _json_compact.encode(value)
+    parts.append(text)
+    return budget - len(text)
+
+
+# ==================== CLIENTS ====================
+#
+# Clients are created on first use and cached for the life of the container.
+# DynamoDB goes through the low-level client with boto3's type (de)serializer,
+# which avoids building the much heavier boto3 resource model.
+
+_dynamodb_client = None
+_s3_client = None
+_http_session = None
+_serializer = None
+_deserializer = None
+# Traced proxies, rebuilt if the underlying client is replaced (e.g. by local stand-ins)
+_traced: Dict[str, Any] = {}
+
+
+def _traced_proxy(name: str, client, wrap):
+    proxy = _traced.get(name)
+    if proxy is None or proxy[0] is not client:
+        proxy = _traced[name] = (client, wrap(client))
+    return proxy[1]
+
+
+def _aws_config(Config):
+    # Bounded timeouts and retries, so one stuck call cannot use up the invocation's time budget
+    return Config(max_pool_connections=POOL_CONNECTIONS, connect_timeout=2, read_timeout=10,
+                  retries={'max_attempts': 3, 'mode': 'standard'})
+
+
+def _open_local_storage():
+    """Item and object stores standing in for DynamoDB and S3 (STORAGE_BACKEND sqlite or memory)."""
+    global _dynamodb_client, _s3_client
+    import storage
+    _dynamodb_client, _s3_client = storage.open_storage(STORAGE_BACKEND, STORAGE_PATH)
+    log_info("Using %s storage", STORAGE_BACKEND)
+
+
+def get_dynamodb_client(shared: bool = False):
+    """
+    Low-level DynamoDB client, created on first use, scoped to the active bot
+    (see BOTS) unless `shared` (bot leases and model slots).
+    """
+    global _dynamodb_client
+    if _dynamodb_client is None and STORAGE_BACKEND != 'aws':
+        _open_local_storage()
+    if _dynamodb_client is None:
+        import boto3
+        from botocore.config import Config
+        _dynamodb_client = boto3.client('dynamodb', config=_aws_config(Config))
+    traced = _traced_proxy('dynamodb', _dynamodb_client, lambda c: TracedClient(c, 'dynamodb'))
+    return traced if shared else _bot_client('dynamodb', traced)
+
+
+def get_s3_client():
+    """S3 client, created on first use, scoped to the active bot (see BOTS)."""
+    global _s3_client
+    if _s3_client is None and STORAGE_BACKEND != 'aws':
+        _open_local_storage()
+    if _s3_client is None:
+        import boto3
+        from botocore.config import Config
+        _s3_client = boto3.client('s3', config=_aws_config(Config))
+    return _bot_client('s3', _traced_proxy('s3', _s3_client, lambda c: TracedClient(c, 's3')))
+
+
+def s3_error_code(e: Exception) -> str:
+    """The error code of a botocore ClientError (or a storage.py S3Error), '' for anything else."""
+    response = getattr(e, 'response', None)
+    return response.get('Error', {}).get('Code', '') if isinstance(response, dict) else ''
+
+
+def get_http():
+    """Shared requests session (keeps connections to Telegram and Ollama alive)."""
+    global _http_session
+    if _http_session is None:
+        import requests
+        _http_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=POOL_CONNECTIONS)
+        _http_session.mount('https://', adapter)
+        _http_session.mount('http://', adapter)
+    return _traced_proxy('http', _http_session, TracedHTTP)
+
+
+def prime():
+    """Create every client up front so the first request does not pay for it."""
+    get_dynamodb_client()
+    get_s3_client()
+    get_http()
+    _load_type_codecs()
+
+
+def _reset_connections():
+    """Drop pooled connections captured in a snapshot; they are stale after restore."""
+    global _http_session
+    if _http_session is not None:
+        _http_session.close()
+        _http_session = None
+
+
+def _load_type_codecs():
+    global _serializer, _deserializer
+    from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+    _serializer, _deserializer = TypeSerializer(), TypeDeserializer()
+
+
+class Message:
+    """
+    One conversation turn as held in memory: interned role, content and an integer ts.
+
+    Supports the read side of the dict interface (m['role'], m.get('ts', 0), dict(m)) so
+    code written against plain message dicts keeps working; as_dict() (and
+    json_default) convert at the JSON boundary. Fields other than role,
+    content and ts are kept in `extra`.
+    """
+    __slots__ = ('role', 'content', 'ts', 'extra')
+    FIELDS = ('role', 'content', 'ts')
+
+    def __init__(self, role: str, content: str, ts: int = 0, extra: Optional[Dict[str, Any]] = None):
+        self.role = sys.intern(role)
+        self.content = content
+        self.ts = ts
+        self.extra = extra
+
+    def __getitem__(self, key: str) -> Any:
+        if key in Message.FIELDS:
+            return getattr(self, key)
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in Message.FIELDS or (self.extra is not None and key in self.extra)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self) -> List[str]:
+        return list(Message.FIELDS) + list(self.extra or ())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def as_dict(self) -> Dict[str, Any]:
+        message = {'role': self.role, 'content': self.content, 'ts': self.ts}
+        if self.extra:
+            message.update(self.extra)
+        return message
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, (Message, dict)):
+            return self.as_dict() == (other.as_dict() if isinstance(other, Message) else other)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"Message({self.as_dict()!r})"
+
+
+def _number(text: str) -> Any:
+    return int(text) if text.lstrip('-').isdigit() else Decimal(text)
+
+
+def _decode_message(av: Dict[str, Any]) -> Any:
+    """Conversation entry -> Message; entries that do not fit the schema go through the generic path."""
+    fields = av.get('M')
     try:
-        resp = requests.get(f"{TELEGRAM_API}/getFile", params={"file_id": file_id}, timeout=10)
-        data = resp.json()
-        if not data.get("ok"):
-            print(f"Failed to get file info: {data}")
-            return None
+        role, content, ts = fields['role']['S'], fields['content']['S'], _number(fields['ts']['N'])
+    except (TypeError, KeyError):
+        return _deserializer.deserialize(av)
+    extra = None
+    if len(fields) > 3:
+        extra = {k: _deserializer.deserialize(v) for k, v in fields.items() if k not in Message.FIELDS}
+    return Message(role, content, ts, extra)
 
-        file_path = data["result"]["file_path"]
-        download_url = f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{file_path}"
-        file_resp = requests.get(download_url, timeout=30)
-        if file_resp.status_code == 200:
-            return file_resp.content
+
+def _encode_message(message: Any) -> Dict[str, Any]:
+    if isinstance(message, Message):
+        fields = {'role': {'S': message.role}, 'content': {'S': message.content}, 'ts': {'N': str(message.ts)}}
+        if message.extra:
+            fields.update((k, _serializer.serialize(v)) for k, v in message.extra.items())
+        return {'M': fields}
+    return _serializer.serialize(message)
+
+
+def to_dynamo(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Plain dict -> DynamoDB attribute-value map (conversation entries may be Messages)."""
+    if _serializer is None:
+        _load_type_codecs()
+    encoded = {k: _serializer.serialize(v) for k, v in item.items() if k != 'conversation'}
+    if 'conversation' in item:
+        encoded['conversation'] = {'L': [_encode_message(m) for m in item['conversation']]}
+    return encoded
+
+
+def from_dynamo(item: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    DynamoDB attribute-value map -> plain dict (numbers come back as Decimal).
+
+    Session conversations are decoded by a schema-specific path into Message
+    objects instead of one dict of Decimals per turn.
+    """
+    if _deserializer is None:
+        _load_type_codecs()
+    decoded = {k: _deserializer.deserialize(v) for k, v in item.items() if k != 'conversation'}
+    conversation = item.get('conversation')
+    if conversation is not None:
+        if 'L' in conversation:
+            decoded['conversation'] = [_decode_message(av) for av in conversation['L']]
         else:
-            print(f"Failed to download file: {file_resp.status_code}")
-            return None
-    except Exception as e:
-        print(f"Error downloading file: {e}")
-        return None
+            decoded['conversation'] = _deserializer.deserialize(conversation)
+    return decoded
 
 
-def get_user_items(user_id: int) -> List[Dict[str, Any]]:
-    """Query all items for a user (sessions)."""
+# Inside a read_scope (one update), identical get_item/query calls are served
+# from a cache of the attribute-value maps DynamoDB returned, and the scope's
+# own puts, simple SET updates and deletes are applied to it, so later reads
+# see them. Every hit is deserialized afresh, so callers can mutate what they
+# get. Writes made straight through the client (counters, leases, index
+# bookkeeping) bypass the cache; none of them are re-read in the same update.
+
+_read_local = threading.local()
+_SIMPLE_SET = re.compile(r'^\s*SET\s+(\w+\s*=\s*:\w+(?:\s*,\s*\w+\s*=\s*:\w+)*)\s*$', re.IGNORECASE)
+
+
+class read_scope:
+    """Deduplicate DynamoDB reads for one update: `with read_scope() as reads: ...; reads.saved`."""
+    __slots__ = ('cache', 'saved', 'outer')
+
+    def __init__(self, seed: Optional[Dict[tuple, Any]] = None):
+        # seed: cache entries already read for this update, e.g. by prefetch_active_sessions
+        self.cache: Dict[tuple, Any] = dict(seed) if seed else {}
+        self.saved = 0
+
+    def __enter__(self):
+        self.outer = getattr(_read_local, 'scope', None)
+        _read_local.scope = self
+        return self
+
+    def __exit__(self, *exc):
+        _read_local.scope = self.outer
+        if self.saved:
+            incr_metric('reads_saved', self.saved)
+        return False
+
+
+def _scope_write(pk: Any, sk: str, av: Optional[Dict[str, Any]]):
+    """Record a write of item (pk, sk) - its new attribute-value map, or None if deleted."""
+    scope = getattr(_read_local, 'scope', None)
+    if scope is None:
+        return
+    scope.cache[('item', pk, sk)] = av
+    for key, items in scope.cache.items():
+        if key[0] != 'query' or key[1] != pk or not sk.startswith(key[2]):
+            continue
+        rest = [it for it in items if it['sk'].get('S') != sk]
+        if av is not None:
+            rest.append(av)
+            rest.sort(key=lambda it: it['sk'].get('S', ''))
+        scope.cache[key] = rest
+
+
+def _scope_forget(pk: Any, sk: str):
+    """Drop cached reads that an update we cannot replay may have changed."""
+    scope = getattr(_read_local, 'scope', None)
+    if scope is not None:
+        for key in [k for k in scope.cache if k[1] == pk and (k[0] == 'query' and sk.startswith(k[2]) or k[2] == sk)]:
+            del scope.cache[key]
+
+
+def db_get_item(key: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    scope = getattr(_read_local, 'scope', None)
+    cache_key = ('item', key['pk'], key['sk'])
+    if scope is not None and cache_key in scope.cache:
+        scope.saved += 1
+        av = scope.cache[cache_key]
+        return from_dynamo(av) if av is not None else None
+    response = get_dynamodb_client().get_item(TableName=TABLE_NAME, Key=to_dynamo(key))
+    if scope is not None:
+        scope.cache[cache_key] = response.get('Item')
+    return from_dynamo(response['Item']) if 'Item' in response else None
+
+
+def db_put_item(item: Dict[str, Any]):
+    av = to_dynamo(item)
+    get_dynamodb_client().put_item(TableName=TABLE_NAME, Item=av)
+    _scope_write(item['pk'], item['sk'], av)
+
+
+def db_update_item(key: Dict[str, Any], update_expression: str, values: Dict[str, Any]):
+    av_values = to_dynamo(values)
+    get_dynamodb_client().update_item(
+        TableName=TABLE_NAME,
+        Key=to_dynamo(key),
+        UpdateExpression=update_expression,
+        ExpressionAttributeValues=av_values
+    )
+    scope = getattr(_read_local, 'scope', None)
+    if scope is None:
+        return
+    cached = scope.cache.get(('item', key['pk'], key['sk']), False)
+    match = _SIMPLE_SET.match(update_expression)
+    if match and cached is False:
+        # Not fetched as an item; patch it from any cached query that holds it
+        for cache_key, items in scope.cache.items():
+            if cache_key[0] == 'query' and cache_key[1] == key['pk']:
+                cached = next((it for it in items if it['sk'].get('S') == key['sk']), False)
+                if cached is not False:
+                    break
+    if match and cached:
+        patched = dict(cached)
+        for assignment in match.group(1).split(','):
+            name, placeholder = (part.strip() for part in assignment.split('='))
+            patched[name] = av_values[placeholder]
+        _scope_write(key['pk'], key['sk'], patched)
+    else:
+        _scope_forget(key['pk'], key['sk'])
+
+
+def db_delete_item(key: Dict[str, Any]):
+    get_dynamodb_client().delete_item(TableName=TABLE_NAME, Key=to_dynamo(key))
+    _scope_write(key['pk'], key['sk'], None)
+
+
+def db_query(pk: int, sk_prefix: Optional[str] = None) -> List[Dict[str, Any]]:
+    scope = getattr(_read_local, 'scope', None)
+    cache_key = ('query', pk, sk_prefix or '')
+    if scope is not None and cache_key in scope.cache:
+        scope.saved += 1
+        return [from_dynamo(item) for item in scope.cache[cache_key]]
+    if sk_prefix:
+        condition, values = 'pk = :pk AND begins_with(sk, :prefix)', {':pk': pk, ':prefix': sk_prefix}
+    else:
+        condition, values = 'pk = :pk', {':pk': pk}
+    response = get_dynamodb_client().query(
+        TableName=TABLE_NAME,
+        KeyConditionExpression=condition,
+        ExpressionAttributeValues=to_dynamo(values)
+    )
+    items = response.get('Items', [])
+    if scope is not None:
+        scope.cache[cache_key] = items
+    return [from_dynamo(item) for item in items]
+
+
+if PRIME_ON_INIT:
     try:
-        response = table.query(
-            KeyConditionExpression=Key('pk').eq(user_id)
-        )
-        return response.get('Items', [])
-    except Exception as e:
-        print(f"Error querying user items for {user_id}: {e}")
-        return []
+        from snapshot_restore_py import register_after_restore, register_before_snapshot
+        register_before_snapshot(prime)
+        register_after_restore(_reset_connections)
+    except ImportError:
+        prime()
 
 
-def get_active_session(user_id: int) -> Optional[Dict[str, Any]]:
-    """Get the active session for a user."""
-    items = get_user_items(user_id)
-    for item in items:
-        if item.get('is_active', 0) == 1:
-            print(f"Found active session for user {user_id}: {item['sk']}")
-            return item
-    print(f"No active session found for user {user_id}")
-    return None
+# ==================== BOTS ====================
+#
+# TELEGRAM_TOKEN is the home bot, whose data stays where it always was. Every
+# TELEGRAM_BOTS entry adds a bot whose data lives in the same table and bucket
+# under keys of its own, so users, sessions, offsets and usage counters of
+# different bots never share keys and nothing extra has to be provisioned:
+#   DynamoDB: pk -> bot id * BOT_PK_SPAN + pk (the offset item at pk 0 and the
+#             usage shards at negative pks included)
+#   S3:       <prefix>/<rest> -> <prefix>/bot-<bot id>/<rest>, so lifecycle
+#             rules on archives/ cover every bot
+# get_dynamodb_client() and get_s3_client() hand out proxies (BotTable,
+# BotBucket) that rewrite keys on the way in and out, so the rest of the
+# handler keeps using plain user ids and keys. The proxies refuse calls they
+# do not know how to rewrite instead of passing them through unscoped.
+#
+# A process serves one bot at a time. Each Bot carries a BotState with its
+# caches and queues (outbox, rate buckets, pending and cached indexes, archive
+# indexes and pages), and code reaches them through _active_bot.state, so a
+# per-bot cache is a BotState attribute and a module-level one is shared by
+# every bot. use_bot() finishes the active bot's pending work (replies,
+# counters, indexing) before switching. Lambda runs one invocation per
+# container at a time; server.py only serves the home bot.
+#
+# Polling workers (polling invocations, or poller.py processes) split the
+# bots between them through items at pk 0 of the table, outside any bot's
+# keys (get_dynamodb_client(shared=True)):
+#   POLL#WORKER#<worker id>  {expires_at}                - workers alive now
+#   POLL#LEASE#<bot id>      {owner, expires_at, fence}  - who polls the bot
+# Times are epoch milliseconds. A heartbeat thread renews a worker's items
+# every BOT_LEASE_TTL / 3 seconds; when a worker dies its leases expire and
+# the others claim them. rebalance() aims for an even share per worker and
+# hands leases back while the worker holds more than its share and another
+# holds less. Each claim increments `fence`, and the bot's offset only
+# accepts writes carrying the newest fence, so a worker that stalled past
+# its lease cannot move the offset under the new holder.
 
+class BotState:
+    """One bot's caches and queues; code reaches the active bot's through _active_bot.state."""
+    __slots__ = ('outbox', 'outbox_busy', 'send_bucket_cache', 'rate_bucket_cache', 'rate_notice_cache',
+                 'memory_pending', 'memory_index_cache', 'search_pending', 'search_index_cache',
+                 'archive_index_cache', 'cold_page_cache', 'bundle_manifest_cache')
 
-def create_session(user_id: int, model_name: str = "llama3") -> Dict[str, Any]:
-    """Create a new session, deactivate old active ones."""
-    session_id = str(uuid.uuid4())
-    sk = f"MODEL#{model_name}#SESSION#{session_id}"
-    now = int(time.time())
-    item = {
-        'pk': user_id,
-        'sk': sk,
-        'model_name': model_name,
-        'session_id': session_id,
-        'is_active': 1,
-        'last_message_ts': now,
-        'conversation': [],
-        'user_id': user_id,
-        's3_path': '',
-    }
-    existing_items = get_user_items(user_id)
-    for it in existing_items:
-        if it.get('is_active', 0) == 1 and it['sk'] != sk:
-            print(f"Deactivating existing session for user {user_id}: {it['sk']}")
-            table.update_item(
-                Key={'pk': user_id, 'sk': it['sk']},
-                UpdateExpression='SET is_active = :val',
-                ExpressionAttributeValues={':val': 0}
+    def __init__(self):
+        self.outbox: Dict[int, List[str]] = {}  # see OUTBOUND
+        self.outbox_busy: set = set()
+        self.send_bucket_cache: Dict[Any, 'TokenBucket'] = {}
+        self.rate_bucket_cache: Dict[Tuple[int, str], 'TokenBucket'] = {}  # see RATE LIMITING
+        self.rate_notice_cache: Dict[int, float] = {}
+        self.memory_pending: Dict[int, List[str]] = {}  # texts said during this invocation, per user
+        self.memory_index_cache: Dict[int, 'MemoryIndex'] = {}
+        self.search_pending: Dict[int, List[str]] = {}  # docs added during this invocation, per user
+        self.search_index_cache: Dict[int, Dict[str, 'SearchSegment']] = {}
+        self.archive_index_cache: Dict[str, Dict[str, Any]] = {}
+        self.cold_page_cache: Dict[Tuple[str, str, int], List[Dict[str, Any]]] = {}  # (key, ETag, page) -> messages
+        self.bundle_manifest_cache: Dict[int, Dict[str, Dict[str, Any]]] = {}
+
+
+class Bot:
+    __slots__ = ('bot_id', 'token', 'pk_base', 'key_segment', 'state')
+
+    def __init__(self, bot_id: str, token: str, home: bool = False):
+        self.bot_id = bot_id
+        self.token = token
+        self.pk_base = 0 if home else int(bot_id) * BOT_PK_SPAN
+        self.key_segment = '' if home else f"bot-{bot_id}"
+        self.state = BotState()
+
+    def __repr__(self):
+        return f"Bot({self.bot_id}{', home' if not self.key_segment else ''})"
+
+
+def parse_bots(spec: str) -> Dict[str, Bot]:
+    """The home bot (if TELEGRAM_TOKEN is set), then each token of spec."""
+    bots = {HOME_BOT.bot_id: HOME_BOT} if HOME_BOT.token else {}
+    for entry in spec.split(','):
+        token, _, where = entry.strip().partition('@')
+        if not token:
+            continue
+        bot_id = token.split(':', 1)[0]
+        if not bot_id.isdigit() or bot_id in bots or bot_id == HOME_BOT.bot_id:
+            log_warning("Ignoring TELEGRAM_BOTS entry for bot %s: not a bot token, or already in use", bot_id)
+            continue
+        if where:
+            log_warning("Bot %s: '@%s' ignored, every bot uses %s and %s", bot_id, where, TABLE_NAME, S3_BUCKET_NAME)
+        bots[bot_id] = Bot(bot_id, token)
+    return bots
+
+
+class BotTable:
+    """DynamoDB client of an extra bot: moves every pk into the bot's range (see BOTS)."""
+
+    def __init__(self, client, pk_base: int):
+        self._client = client
+        self._base = pk_base
+
+    def __getattr__(self, name: str):
+        if name in ('exceptions', 'meta'):
+            return getattr(self._client, name)
+        raise AttributeError(f"DynamoDB {name} is not scoped to a bot; add it to BotTable")
+
+    def _key(self, av: Dict[str, Any]) -> Dict[str, Any]:
+        return dict(av, pk={'N': str(int(av['pk']['N']) + self._base)})
+
+    def _item(self, av: Dict[str, Any]) -> Dict[str, Any]:
+        return dict(av, pk={'N': str(int(av['pk']['N']) - self._base)}) if 'pk' in av else av
+
+    def _response(self, response: Dict[str, Any]) -> Dict[str, Any]:
+        response = dict(response)
+        for name in ('Item', 'Attributes'):
+            if name in response:
+                response[name] = self._item(response[name])
+        if 'Items' in response:
+            response['Items'] = [self._item(av) for av in response['Items']]
+        return response
+
+    def get_item(self, **kwargs):
+        return self._response(self._client.get_item(**dict(kwargs, Key=self._key(kwargs['Key']))))
+
+    def put_item(self, **kwargs):
+        return self._response(self._client.put_item(**dict(kwargs, Item=self._key(kwargs['Item']))))
+
+    def update_item(self, **kwargs):
+        return self._response(self._client.update_item(**dict(kwargs, Key=self._key(kwargs['Key']))))
+
+    def delete_item(self, **kwargs):
+        return self._response(self._client.delete_item(**dict(kwargs, Key=self._key(kwargs['Key']))))
+
+    def query(self, **kwargs):
+        # Every query names its partition as 'pk = :pk'
+        values = dict(kwargs['ExpressionAttributeValues'])
+        values[':pk'] = {'N': str(int(values[':pk']['N']) + self._base)}
+        return self._response(self._client.query(**dict(kwargs, ExpressionAttributeValues=values)))
+
+    def batch_get_item(self, **kwargs):
+        request = {table: dict(spec, Keys=[self._key(k) for k in spec['Keys']])
+                   for table, spec in kwargs['RequestItems'].items()}
+        response = dict(self._client.batch_get_item(**dict(kwargs, RequestItems=request)))
+        response['Responses'] = {table: [self._item(av) for av in items]
+                                 for table, items in response.get('Responses', {}).items()}
+        response['UnprocessedKeys'] = {table: dict(spec, Keys=[self._item(k) for k in spec['Keys']])
+                                       for table, spec in (response.get('UnprocessedKeys') or {}).items()}
+        return response
+
+
+class BotBucket:
+    """S3 client of an extra bot: puts a bot-<id> segment after each key's first prefix (see BOTS)."""
+
+    def __init__(self, client, segment: str):
+        self._client = client
+        self._segment = segment
+
+    def __getattr__(self, name: str):
+        if name in ('exceptions', 'meta'):
+            return getattr(self._client, name)
+        raise AttributeError(f"S3 {name} is not scoped to a bot; add it to BotBucket")
+
+    def _key(self, key: str) -> str:
+        prefix, sep, rest = key.partition('/')
+        return f"{prefix}/{self._segment}/{rest}" if sep else f"{self._segment}/{key}"
+
+    def _unkey(self, key: str) -> str:
+        prefix, _, rest = key.partition('/')
+        if prefix == self._segment:
+            return rest
+        return f"{prefix}/{rest[len(self._segment) + 1:]}"
+
+    def get_object(self, **kwargs):
+        return self._client.get_object(**dict(kwargs, Key=self._key(kwargs['Key'])))
+
+    def head_object(self, **kwargs):
+        return self._client.head_object(**dict(kwargs, Key=self._key(kwargs['Key'])))
+
+    def put_object(self, **kwargs):
+        return self._client.put_object(**dict(kwargs, Key=self._key(kwargs['Key'])))
+
+    def delete_object(self, **kwargs):
+        return self._client.delete_object(**dict(kwargs, Key=self._key(kwargs['Key'])))
+
+    def delete_objects(self, **kwargs):
+        delete = dict(kwargs['Delete'], Objects=[dict(o, Key=self._key(o['Key'])) for o in kwargs['Delete']['Objects']])
+        response = dict(self._client.delete_objects(**dict(kwargs, Delete=delete)))
+        for name in ('Deleted', 'Errors'):
+            if name in response:
+                response[name] = [dict(o, Key=self._unkey(o['Key'])) for o in response[name]]
+        return response
+
+    def get_paginator(self, operation: str):
+        if operation != 'list_objects_v2':
+            raise AttributeError(f"S3 {operation} pages are not scoped to a bot; add them to BotBucket")
+        return _BotPaginator(self._client.get_paginator(operation), self)
+
+
+class _BotPaginator:
+    def __init__(self, paginator, bucket: BotBucket):
+        self._paginator = paginator
+        self._bucket = bucket
+
+    def paginate(self, **kwargs):
+        for name in ('Prefix', 'StartAfter'):
+            if kwargs.get(name):
+                kwargs[name] = self._bucket._key(kwargs[name])
+        for page in self._paginator.paginate(**kwargs):
+            page = dict(page)
+            if 'Contents' in page:
+                page['Contents'] = [dict(o, Key=self._bucket._unkey(o['Key'])) for o in page['Contents']]
+            if 'CommonPrefixes' in page:
+                page['CommonPrefixes'] = [{'Prefix': self._bucket._unkey(p['Prefix'])} for p in page['CommonPrefixes']]
+            yield page
+
+
+def _bot_client(service: str, client, name: str = ''):
+    """
+    The active bot's view of a storage client: the client itself for the home
+    bot. `name` keeps views of different wrappings of one service apart.
+    """
+    bot = _active_bot
+    if not bot.key_segment:
+        return client
+    if service == 'dynamodb':
+        return _traced_proxy(f"{name or service}#{bot.bot_id}", client, lambda c: BotTable(c, bot.pk_base))
+    return _traced_proxy(f"{name or service}#{bot.bot_id}", client, lambda c: BotBucket(c, bot.key_segment))
+
+
+HOME_BOT = Bot(TELEGRAM_TOKEN.split(':', 1)[0], TELEGRAM_TOKEN, home=True)
+BOTS = parse_bots(TELEGRAM_BOTS)
+
+_active_bot = HOME_BOT
+_active_bot_id = HOME_BOT.bot_id
+
+
+def use_bot(bot: Bot):
+    """Make `bot` the one this process serves; a no-op if it already is."""
+    global _active_bot, _active_bot_id, TELEGRAM_TOKEN, TELEGRAM_API
+    if bot.bot_id == _active_bot_id:
+        return
+    drain_pending_work()
+    TELEGRAM_TOKEN = bot.token
+    TELEGRAM_API = f"https://api.telegram.org/bot{bot.token}"
+    _active_bot, _active_bot_id = bot, bot.bot_id
+    log_debug("Serving bot %s", bot.bot_id)
+
+
+def active_bot_id() -> str:
+    return _active_bot_id
+
+
+class LeaseLost(Exception):
+    """This worker no longer holds the lease of the bot it is polling."""
+
+
+class BotLeases:
+    """A polling worker's registration and bot leases (see BOTS)."""
+
+    def __init__(self, worker_id: Optional[str] = None, bot_ids: Optional[List[str]] = None,
+                 max_bots: int = POLL_MAX_BOTS, ttl: float = BOT_LEASE_TTL):
+        if worker_id is None:
+            import socket
+            worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.worker_id = worker_id
+        self.bot_ids = list(BOTS) if bot_ids is None else list(bot_ids)
+        self.max_bots = max_bots
+        self.ttl_ms = int(ttl * 1000)
+        self.fences: Dict[str, int] = {}
+        self.expires: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # ---- items ----
+
+    def _update(self, bot_id: str, expression: str, condition: str, values: Dict[str, Any], **kwargs):
+        return get_dynamodb_client(shared=True).update_item(
+            TableName=TABLE_NAME,
+            Key=to_dynamo({'pk': OFFSET_PK, 'sk': f"{POLL_LEASE_PREFIX}{bot_id}"}),
+            UpdateExpression=expression,
+            ConditionExpression=condition,
+            ExpressionAttributeNames={'#owner': 'owner', '#ttl': 'ttl'},
+            ExpressionAttributeValues=to_dynamo(values),
+            **kwargs
+        )
+
+    def _register(self, now: int):
+        get_dynamodb_client(shared=True).put_item(TableName=TABLE_NAME, Item=to_dynamo({
+            'pk': OFFSET_PK, 'sk': f"{POLL_WORKER_PREFIX}{self.worker_id}",
+            'expires_at': now + self.ttl_ms, 'ttl': (now + self.ttl_ms) // 1000 + 3600
+        }))
+
+    def _scan(self) -> Tuple[List[str], Dict[str, Dict[str, Any]]]:
+        """(worker ids, {bot id: lease item}) as stored now."""
+        response = get_dynamodb_client(shared=True).query(
+            TableName=TABLE_NAME,
+            KeyConditionExpression='pk = :pk AND begins_with(sk, :prefix)',
+            ExpressionAttributeValues=to_dynamo({':pk': OFFSET_PK, ':prefix': 'POLL#'})
+        )
+        workers, leases = [], {}
+        for item in map(from_dynamo, response.get('Items', [])):
+            if item['sk'].startswith(POLL_WORKER_PREFIX):
+                workers.append((item['sk'][len(POLL_WORKER_PREFIX):], int(item.get('expires_at', 0))))
+            else:
+                leases[item['sk'][len(POLL_LEASE_PREFIX):]] = item
+        now = int(time.time() * 1000)
+        return [w for w, expires_at in workers if expires_at > now], leases
+
+    def _claim(self, bot_id: str, now: int) -> bool:
+        try:
+            response = self._update(
+                bot_id, 'SET #owner = :me, expires_at = :expires, #ttl = :ttl ADD fence :one',
+                'attribute_not_exists(expires_at) OR expires_at < :now OR #owner = :me',
+                {':me': self.worker_id, ':expires': now + self.ttl_ms, ':ttl': (now + self.ttl_ms) // 1000 + 3600,
+                 ':one': 1, ':now': now},
+                ReturnValues='ALL_NEW'
+            )
+        except get_dynamodb_client().exceptions.ConditionalCheckFailedException:
+            return False
+        with self._lock:
+            self.fences[bot_id] = int(from_dynamo(response['Attributes'])['fence'])
+            self.expires[bot_id] = now + self.ttl_ms
+        log_info("Worker %s leased bot %s (fence %s)", self.worker_id, bot_id, self.fences[bot_id])
+        return True
+
+    def _renew(self, bot_id: str, now: int):
+        fence = self.fences.get(bot_id)
+        if fence is None:
+            return
+        try:
+            self._update(bot_id, 'SET expires_at = :expires, #ttl = :ttl', '#owner = :me AND fence = :fence',
+                         {':me': self.worker_id, ':fence': fence, ':expires': now + self.ttl_ms,
+                          ':ttl': (now + self.ttl_ms) // 1000 + 3600})
+        except get_dynamodb_client().exceptions.ConditionalCheckFailedException:
+            log_warning("Worker %s lost the lease of bot %s", self.worker_id, bot_id)
+            self._forget(bot_id)
+            return
+        with self._lock:
+            if self.fences.get(bot_id) == fence:
+                self.expires[bot_id] = now + self.ttl_ms
+
+    def _forget(self, bot_id: str):
+        with self._lock:
+            self.fences.pop(bot_id, None)
+            self.expires.pop(bot_id, None)
+
+    def release(self, bot_id: str):
+        """Hand a lease back so another worker can claim it straight away."""
+        fence = self.fences.get(bot_id)
+        self._forget(bot_id)
+        if fence is None:
+            return
+        try:
+            self._update(bot_id, 'SET expires_at = :zero', '#owner = :me AND fence = :fence',
+                         {':me': self.worker_id, ':fence': fence, ':zero': 0})
+            log_info("Worker %s released bot %s", self.worker_id, bot_id)
+        except Exception as e:
+            log_debug("Lease of bot %s was already gone: %s", bot_id, e)
+
+    # ---- worker ----
+
+    def held(self) -> List[str]:
+        with self._lock:
+            return sorted(self.fences)
+
+    def fence(self, bot_id: str) -> Optional[int]:
+        return self.fences.get(bot_id)
+
+    def valid(self, bot_id: str) -> bool:
+        """True while the lease has more than a heartbeat interval left, i.e. it is safe to start an update."""
+        with self._lock:
+            expires_at = self.expires.get(bot_id)
+        return expires_at is not None and int(time.time() * 1000) < expires_at - self.ttl_ms // 3
+
+    def heartbeat(self):
+        now = int(time.time() * 1000)
+        try:
+            self._register(now)
+            for bot_id in self.held():
+                self._renew(bot_id, now)
+        except Exception as e:
+            log_warning("Lease heartbeat of worker %s failed: %s", self.worker_id, e)
+
+    def rebalance(self) -> List[str]:
+        """Register, then claim or hand back leases towards an even share. Returns the bots held."""
+        now = int(time.time() * 1000)
+        try:
+            self._register(now)
+            workers, leases = self._scan()
+        except Exception as e:
+            log_warning("Lease scan of worker %s failed: %s", self.worker_id, e)
+            return self.held()
+        owners = {bot_id: item.get('owner') for bot_id, item in leases.items()
+                  if bot_id in self.bot_ids and int(item.get('expires_at', 0)) > now}
+        for bot_id in self.held():
+            if owners.get(bot_id) != self.worker_id:
+                self._forget(bot_id)  # expired before it could be renewed
+        counts = {worker: 0 for worker in set(workers) | {self.worker_id}}
+        for owner in owners.values():
+            counts[owner] = counts.get(owner, 0) + 1
+        low, high = len(self.bot_ids) // len(counts), -(-len(self.bot_ids) // len(counts))
+        if self.max_bots:
+            low, high = min(low, self.max_bots), min(high, self.max_bots)
+        starved = any(count < low for worker, count in counts.items() if worker != self.worker_id)
+        target = low if starved else high
+
+        for bot_id in self.held()[target:]:
+            self.release(bot_id)
+        free = [b for b in self.bot_ids if b not in owners]
+        import random
+        random.shuffle(free)
+        for bot_id in free:
+            if len(self.held()) >= target:
+                break
+            self._claim(bot_id, now)
+        return self.held()
+
+    def start(self) -> List[str]:
+        """Rebalance once and start the heartbeat thread. Returns the bots held."""
+        held = self.rebalance()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._beat, name='bot-leases', daemon=True)
+        self._thread.start()
+        return held
+
+    def _beat(self):
+        while not self._stop.wait(self.ttl_ms / 3000.0):
+            self.heartbeat()
+
+    def stop(self):
+        """Stop heartbeating, release every lease and deregister."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for bot_id in self.held():
+            self.release(bot_id)
+        try:
+            get_dynamodb_client(shared=True).delete_item(
+                TableName=TABLE_NAME, Key=to_dynamo({'pk': OFFSET_PK, 'sk': f"{POLL_WORKER_PREFIX}{self.worker_id}"})
+            )
+        except Exception as e:
+            log_warning("Could not deregister worker %s: %s", self.worker_id, e)
+
+
+def get_last_offset() -> int:
+    """Fetch the last processed update_id from DynamoDB (default 0 if none)."""
+    try:
+        item = db_get_item({'pk': OFFSET_PK, 'sk': OFFSET_SK})
+        if item:
+            return int(item.get('last_offset', 0))
+    except Exception as e:
+        log_error("Error getting offset: %s", e)
+    return 0
+
+
+def save_offset(update_id: int, fence: Optional[int] = None):
+    """
+    Save the new last processed update_id to DynamoDB.
+
+    With a lease fence the write only goes through if no later lease holder
+    has written the offset; LeaseLost is raised otherwise.
+    """
+    item = {'pk': OFFSET_PK, 'sk': OFFSET_SK, 'last_offset': update_id, 'last_updated_ts': int(time.time())}
+    try:
+        if fence is None:
+            db_put_item(item)
+        else:
+            item['fence'] = fence
+            get_dynamodb_client().put_item(
+                TableName=TABLE_NAME,
+                Item=to_dynamo(item),
+                ConditionExpression='attribute_not_exists(fence) OR fence <= :fence',
+                ExpressionAttributeValues=to_dynamo({':fence': fence})
+            )
+        log_debug("Saved offset: %s", update_id)
+    except get_dynamodb_client().exceptions.ConditionalCheckFailedException:
+        raise LeaseLost(f"a newer lease holder has written the offset of bot {_active_bot_id}")
+    except Exception as e:
+        log_error("Error saving offset: %s", e)
+
+
+def poll_messages(offset: int = 0) -> Dict[str, Any]:
+    """Poll Telegram getUpdates with offset to avoid reprocessing."""
+    if not TELEGRAM_TOKEN:
+        return {"ok": False, "error": "TELEGRAM_TOKEN not set"}
+    try:
+        params = {"limit": POLL_LIMIT, "timeout": 0}
+        if offset > 0:
+            params["offset"] = offset
+
+        log_debug("Polling with offset: %s", offset)
+        resp = get_http().get(f"{TELEGRAM_API}/getUpdates", params=params, timeout=10)
+        return json_loads(resp.content)
+    except Exception as e:
+        return {"ok": False, "error": str(e)}
+
+
+def send_message(chat_id: int, text: str):
+    """Queue a message for chat_id; it is delivered by the next flush_outbox()."""
+    if not TELEGRAM_TOKEN:
+        return
+    with _outbox_lock:
+        _active_bot.state.outbox.setdefault(chat_id, []).append(text)
+
+
+def send_document(chat_id: int, file_content: bytes, filename: str, caption: str = "",
+                  mime_type: str = 'application/json') -> Optional[Dict[str, Any]]:
+    """Send a document/file to Telegram chat (after any messages queued before it)."""
+    if not TELEGRAM_TOKEN:
+        return None
+    flush_outbox(wait=True, chat_id=chat_id)
+    deadline = time.monotonic() + min(SEND_MAX_WAIT, max(time_left(), 0.0))
+    result = None
+    for attempt in range(SEND_MAX_ATTEMPTS):
+        # Documents count against the same limits; past the wait budget the first try goes anyway,
+        # a retry after a 429 does not
+        if not _wait_for_send_slot(chat_id, deadline) and attempt:
+            break
+        try:
+            files = {'document': (filename, file_content, mime_type)}
+            data = {'chat_id': chat_id}
+            if caption:
+                data['caption'] = caption
+            resp = get_http().post(f"{TELEGRAM_API}/sendDocument", data=data, files=files, timeout=30)
+            result = json_loads(resp.content)
+        except Exception as e:
+            log_error("Error sending document: %s", e)
+            return None
+        if resp.status_code != 429 and result.get('error_code') != 429:
+            return result
+        retry_after = float((result.get('parameters') or {}).get('retry_after', 1))
+        log_warning("Telegram rate limit for chat %s, retrying document in %.1fs", chat_id, retry_after)
+        incr_metric('send_throttled')
+        _send_bucket(chat_id).pause(time.monotonic(), retry_after)
+    log_error("Giving up on document %s for chat %s, still rate limited", filename, chat_id)
+    return result
+
+
+# ==================== OUTBOUND ====================
+#
+# send_message() only queues. Queued messages for a chat are coalesced while
+# they fit in one Telegram message, long ones are split on paragraph, line,
+# sentence or word boundaries, and delivery is paced by a per-chat and a
+# global token bucket. process_telegram_update() flushes without waiting
+# (whatever the buckets allow goes out now), lambda_handler() flushes with
+# waiting at the end of the invocation. A 429 pauses the chat for the
+# retry_after Telegram asks for; the message is retried, not dropped.
+# Anything still queued after SEND_MAX_WAIT is written to the bot's OUTBOX
+# item (one attribute per deferring flush, {chat_id: [texts]}), since a
+# frozen or recycled container would lose it. Every container checks that
+# item at the start of an invocation, at most every OUTBOX_CHECK_INTERVAL
+# seconds, claims it with a delete that returns the old item and sends the
+# texts ahead of newer replies. Buckets are per container, so the global limit
+# is approximate across concurrent Lambdas and 429s handle the rest.
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `capacity`."""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now: float, tokens: float = 1.0) -> float:
+        """Seconds until `tokens` are available (0.0 if they are now)."""
+        paused = max(self.updated - now, 0.0)
+        if self.rate <= 0:
+            return paused  # unlimited, except while paused for a 429
+        self._refill(now)
+        if not paused and self.tokens >= tokens:
+            return 0.0
+        return paused + max(tokens - self.tokens, 0.0) / self.rate
+
+    def take(self, now: float, tokens: float = 1.0) -> bool:
+        if self.delay(now, tokens) > 0:
+            return False
+        if self.rate > 0:
+            self.tokens -= tokens
+        return True
+
+    def pause(self, now: float, seconds: float):
+        """Hold the bucket for `seconds`, then allow a single send (used for 429 retry_after)."""
+        self.tokens = 1.0
+        self.updated = max(self.updated, now + seconds)
+
+
+_outbox_lock = threading.Lock()
+_outbox_checked: Dict[str, float] = {}  # bot id -> when its OUTBOX item was last checked (monotonic)
+
+
+def _send_bucket(chat_id: Optional[int]) -> TokenBucket:
+    """Per-chat bucket, or the global one for chat_id None."""
+    cache = _active_bot.state.send_bucket_cache
+    bucket = cache.get(chat_id)
+    if bucket is None:
+        if len(cache) > 10000:
+            cache.clear()
+        if chat_id is None:
+            bucket = TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_BURST)
+        else:
+            bucket = TokenBucket(SEND_CHAT_RATE, SEND_CHAT_BURST)
+        cache[chat_id] = bucket
+    return bucket
+
+
+def telegram_length(text: str) -> int:
+    """Length as Telegram counts it (UTF-16 code units)."""
+    if text.isascii():
+        return len(text)
+    return len(text.encode('utf-16-le')) // 2
+
+
+def split_message(text: str, limit: int = TELEGRAM_MAX_TEXT) -> List[str]:
+    """Split text into chunks of at most `limit`, preferring natural boundaries."""
+    chunks = []
+    while telegram_length(text) > limit:
+        window = text[:limit]
+        while telegram_length(window) > limit:
+            # Astral characters count twice, so drop half the excess each round
+            window = window[:len(window) - max((telegram_length(window) - limit + 1) // 2, 1)]
+        cut = -1
+        for boundary in ('\n\n', '\n', '. ', ' '):
+            at = window.rfind(boundary, len(window) // 2)
+            if at > 0:
+                cut = at + len(boundary)
+                break
+        if cut <= 0:
+            cut = len(window)
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip('\n')
+    if text.strip() or not chunks:
+        chunks.append(text)
+    return chunks
+
+
+def coalesce_messages(texts: List[str], limit: int = TELEGRAM_MAX_TEXT) -> List[str]:
+    """Merge consecutive short messages while they fit in one; split long ones."""
+    parts: List[str] = []
+    for text in texts:
+        for piece in split_message(text, limit):
+            if parts and telegram_length(parts[-1]) + 2 + telegram_length(piece) <= limit:
+                parts[-1] = f"{parts[-1]}\n\n{piece}"
+                incr_metric('send_coalesced')
+            else:
+                parts.append(piece)
+    return parts
+
+
+def _wait_for_send_slot(chat_id: int, deadline: Optional[float]) -> bool:
+    """Take a token from the chat and global buckets, sleeping until deadline if needed.
+
+    deadline None means do not wait at all.
+    """
+    chat_bucket, global_bucket = _send_bucket(chat_id), _send_bucket(None)
+    while True:
+        now = time.monotonic()
+        with _outbox_lock:
+            delay = max(chat_bucket.delay(now), global_bucket.delay(now))
+            if delay <= 0:
+                chat_bucket.take(now)
+                global_bucket.take(now)
+                return True
+        if deadline is None or now + delay > deadline:
+            return False
+        with span('send_wait'):
+            time.sleep(delay)
+
+
+def _post_message(chat_id: int, text: str, attempt: int) -> str:
+    """One sendMessage call: 'sent', 'retry' (bucket already paused) or 'drop'."""
+    try:
+        resp = get_http().post(f"{TELEGRAM_API}/sendMessage", data=json_dumps({"chat_id": chat_id, "text": text}),
+                               headers=JSON_HEADERS, timeout=10)
+        data = json_loads(resp.content)
+    except Exception as e:
+        log_warning("Error sending message to chat %s (attempt %d): %s", chat_id, attempt, e)
+        _send_bucket(chat_id).pause(time.monotonic(), 0.5 * 2 ** attempt)
+        return 'retry'
+    if data.get('ok'):
+        return 'sent'
+    if resp.status_code == 429 or data.get('error_code') == 429:
+        retry_after = float((data.get('parameters') or {}).get('retry_after', 1))
+        log_warning("Telegram rate limit for chat %s, retrying in %.1fs", chat_id, retry_after)
+        incr_metric('send_throttled')
+        _send_bucket(chat_id).pause(time.monotonic(), retry_after)
+        return 'retry'
+    if resp.status_code >= 500:
+        _send_bucket(chat_id).pause(time.monotonic(), 0.5 * 2 ** attempt)
+        return 'retry'
+    log_warning("Telegram rejected message to chat %s: %s", chat_id, data.get('description', data))
+    return 'drop'
+
+
+def _drain_chat(chat_id: int, deadline: Optional[float]):
+    outbox = _active_bot.state.outbox
+    parts: List[str] = []
+    attempts = 0
+    while True:
+        if not parts:
+            with _outbox_lock:
+                queued = outbox.get(chat_id)
+                if not queued:
+                    return
+                outbox[chat_id] = []
+            parts = coalesce_messages(queued)
+            attempts = 0
+        if not _wait_for_send_slot(chat_id, deadline):
+            with _outbox_lock:
+                outbox[chat_id] = parts + outbox.get(chat_id, [])
+            return
+        outcome = _post_message(chat_id, parts[0], attempts)
+        attempts += 1
+        if outcome == 'sent':
+            incr_metric('send_parts')
+        elif outcome == 'drop' or attempts >= SEND_MAX_ATTEMPTS:
+            if outcome != 'drop':
+                log_error("Giving up on message to chat %s after %d attempts", chat_id, attempts)
+            incr_metric('send_dropped')
+        else:
+            continue
+        parts.pop(0)
+        attempts = 0
+
+
+def flush_outbox(wait: bool, chat_id: Optional[int] = None):
+    """Deliver queued messages: what the rate limits allow now, or (wait=True) up to SEND_MAX_WAIT."""
+    deadline = time.monotonic() + min(SEND_MAX_WAIT, max(time_left(), 0.0)) if wait else None
+    state = _active_bot.state
+    chats = [chat_id] if chat_id is not None else list(state.outbox)
+    for chat in chats:
+        with _outbox_lock:
+            # Another thread draining this chat will also send what we queued
+            if chat in state.outbox_busy or not state.outbox.get(chat):
+                continue
+            state.outbox_busy.add(chat)
+        try:
+            _drain_chat(chat, deadline)
+        finally:
+            with _outbox_lock:
+                state.outbox_busy.discard(chat)
+                if not state.outbox.get(chat):
+                    state.outbox.pop(chat, None)
+    if wait and chat_id is None and state.outbox:
+        pending = defer_outbox()
+        if pending:
+            log_warning("%d messages still queued after %.0fs, saved for the next invocation", pending, SEND_MAX_WAIT)
+            incr_metric('send_deferred', pending)
+
+
+def defer_outbox() -> int:
+    """Move what is still queued into the OUTBOX item. Returns how many texts were saved."""
+    state = _active_bot.state
+    with _outbox_lock:
+        pending = {chat: texts for chat, texts in state.outbox.items() if texts and chat not in state.outbox_busy}
+        for chat in pending:
+            del state.outbox[chat]
+    if not pending:
+        return 0
+    try:
+        get_dynamodb_client().update_item(
+            TableName=TABLE_NAME,
+            Key=to_dynamo({'pk': OFFSET_PK, 'sk': OUTBOX_SK}),
+            UpdateExpression='SET #batch = :batch, #ttl = :ttl',
+            ExpressionAttributeNames={'#batch': f"batch_{time.time_ns():020d}_{uuid.uuid4().hex[:8]}", '#ttl': 'ttl'},
+            ExpressionAttributeValues=to_dynamo({
+                ':batch': {str(chat): texts for chat, texts in pending.items()},
+                ':ttl': int(time.time()) + OUTBOX_TTL,
+            })
+        )
+    except Exception as e:
+        log_error("Error saving unsent replies, keeping them in this container: %s", e)
+        with _outbox_lock:
+            for chat, texts in pending.items():
+                state.outbox[chat] = texts + state.outbox.get(chat, [])
+        return 0
+    _outbox_checked.pop(_active_bot_id, None)  # this container's next invocation picks them up at once
+    return sum(len(texts) for texts in pending.values())
+
+
+def resume_deferred_replies():
+    """Claim the OUTBOX item, if there is one, and queue its texts ahead of anything newer."""
+    now = time.monotonic()
+    if not TELEGRAM_TOKEN or now - _outbox_checked.get(_active_bot_id, -OUTBOX_CHECK_INTERVAL) < OUTBOX_CHECK_INTERVAL:
+        return
+    _outbox_checked[_active_bot_id] = now
+    key = to_dynamo({'pk': OFFSET_PK, 'sk': OUTBOX_SK})
+    try:
+        if 'Item' not in get_dynamodb_client().get_item(TableName=TABLE_NAME, Key=key, ProjectionExpression='pk'):
+            return
+        # The delete hands the item to exactly one claimer; later deferrals start a new item
+        old = get_dynamodb_client().delete_item(TableName=TABLE_NAME, Key=key, ReturnValues='ALL_OLD')
+    except Exception as e:
+        log_error("Error reading unsent replies: %s", e)
+        return
+    attributes = from_dynamo(old.get('Attributes') or {})
+    resumed: Dict[int, List[str]] = {}
+    for name in sorted(n for n in attributes if n.startswith('batch_')):
+        for chat, texts in attributes[name].items():
+            resumed.setdefault(int(chat), []).extend(texts)
+    outbox = _active_bot.state.outbox
+    with _outbox_lock:
+        for chat, texts in resumed.items():
+            outbox[chat] = texts + outbox.get(chat, [])
+    count = sum(len(texts) for texts in resumed.values())
+    if count:
+        log_info("Resuming %d unsent replies for %d chats", count, len(resumed))
+        incr_metric('send_resumed', count)
+
+
+# ==================== RATE LIMITING ====================
+#
+# Every update is charged to a command class: 'chat' (goes to the model),
+# 'heavy' (exports, restores, archiving, imports) or 'command'. Each user has
+# an in-memory token bucket per class. With RATE_LIMIT_SHARED the request is
+# also counted in a fixed-window DynamoDB counter (pk=user, sk=RATE#class#window,
+# expiring via ttl), so the limit holds across concurrent Lambdas. The local
+# bucket is checked first, so floods are turned away without a DynamoDB call.
+#
+# Model calls additionally need one of MODEL_MAX_IN_FLIGHT slots: in-process
+# always, and with RATE_LIMIT_SHARED also as a leased DynamoDB item, so that
+# a burst across many Lambdas cannot pile onto the Ollama host. Shed requests
+# get a short "slow down" reply (at most one per RATE_NOTICE_INTERVAL) and are
+# counted in the shed_* metrics.
+
+_rate_limit_cache: Dict[str, Dict[str, Tuple[int, float]]] = {}
+_rate_lock = threading.Lock()
+_model_in_flight = 0
+_model_lock = threading.Lock()
+
+
+def parse_rate_limits(spec: str) -> Dict[str, Tuple[int, float]]:
+    """'chat=10/60,heavy=5/300' -> {'chat': (10, 60.0), 'heavy': (5, 300.0)}"""
+    limits = {}
+    for part in spec.split(','):
+        if '=' not in part:
+            continue
+        klass, rule = part.split('=', 1)
+        count, _, seconds = rule.partition('/')
+        try:
+            limits[klass.strip()] = (int(count), float(seconds or 1))
+        except ValueError:
+            log_warning("Ignoring malformed rate limit %r", part)
+    return limits
+
+
+def request_class(text: str, document: Optional[Dict[str, Any]]) -> str:
+    if document:
+        return 'heavy'
+    if text.startswith('/'):
+        cmd = text.split(" ", 1)[0].split("@", 1)[0].lower()
+        return 'heavy' if cmd in HEAVY_COMMANDS else 'command'
+    return 'chat'
+
+
+def _shared_rate_check(user_id: int, klass: str, count: int, seconds: float) -> float:
+    """Count this request in DynamoDB; returns seconds until the window resets if over the limit."""
+    now = time.time()
+    window = int(now // seconds)
+    window_end = (window + 1) * seconds
+    try:
+        get_dynamodb_client().update_item(
+            TableName=TABLE_NAME,
+            Key=to_dynamo({'pk': user_id, 'sk': f"RATE#{klass}#{window}"}),
+            UpdateExpression='ADD hits :one SET #ttl = :ttl',
+            ConditionExpression='attribute_not_exists(hits) OR hits < :limit',
+            ExpressionAttributeNames={'#ttl': 'ttl'},
+            ExpressionAttributeValues=to_dynamo({':one': 1, ':limit': count, ':ttl': int(window_end) + 60})
+        )
+    except get_dynamodb_client().exceptions.ConditionalCheckFailedException:
+        return max(window_end - now, 1.0)
+    except Exception as e:
+        log_warning("Shared rate limit check failed for user %s, allowing: %s", user_id, e)
+    return 0.0
+
+
+def check_rate_limit(user_id: int, klass: str) -> float:
+    """0.0 if the request may proceed, else roughly how many seconds the user should wait."""
+    limits = _rate_limit_cache.get(RATE_LIMITS)
+    if limits is None:
+        limits = _rate_limit_cache[RATE_LIMITS] = parse_rate_limits(RATE_LIMITS)
+    limit = limits.get(klass)
+    if not limit or limit[0] <= 0:
+        return 0.0
+    count, seconds = limit
+    key = (user_id, klass)
+    cache = _active_bot.state.rate_bucket_cache
+    bucket = cache.get(key)
+    if bucket is None:
+        if len(cache) > 50000:
+            cache.clear()
+        bucket = cache[key] = TokenBucket(count / seconds, count)
+    now = time.monotonic()
+    with _rate_lock:
+        wait = bucket.delay(now)
+        if not wait:
+            bucket.take(now)
+    if wait:
+        return wait
+    if RATE_LIMIT_SHARED:
+        return _shared_rate_check(user_id, klass, count, seconds)
+    return 0.0
+
+
+def shed_request(chat_id: int, user_id: int, reason: str, message: str):
+    """Count a shed request and tell the user, unless they were told very recently."""
+    incr_metric(f"shed_{reason}")
+    log_info("Shed %s request from user %s", reason, user_id)
+    now = time.monotonic()
+    notices = _active_bot.state.rate_notice_cache
+    if now - notices.get(user_id, -RATE_NOTICE_INTERVAL) >= RATE_NOTICE_INTERVAL:
+        notices[user_id] = now
+        send_message(chat_id, message)
+
+
+def _lease_model_slot() -> Optional[Tuple[str, str]]:
+    """Claim a free or expired MODEL_SLOT item; returns (sk, lease_id) or None if all are held."""
+    import random
+    now = int(time.time())
+    lease_id = uuid.uuid4().hex
+    slots = list(range(MODEL_MAX_IN_FLIGHT))
+    random.shuffle(slots)
+    for slot in slots:
+        sk = f"MODEL_SLOT#{slot}"
+        try:
+            get_dynamodb_client(shared=True).put_item(
+                TableName=TABLE_NAME,
+                Item=to_dynamo({'pk': OFFSET_PK, 'sk': sk, 'lease_id': lease_id,
+                                'expires_at': now + MODEL_SLOT_TTL, 'ttl': now + MODEL_SLOT_TTL + 3600}),
+                ConditionExpression='attribute_not_exists(sk) OR expires_at < :now',
+                ExpressionAttributeValues=to_dynamo({':now': now})
+            )
+            return sk, lease_id
+        except get_dynamodb_client().exceptions.ConditionalCheckFailedException:
+            continue
+        except Exception as e:
+            log_warning("Model slot lease failed, allowing call: %s", e)
+            return '', ''
+    return None
+
+
+def acquire_model_slot() -> Optional[Tuple[str, str]]:
+    """Reserve capacity for one model call; None means the model is saturated."""
+    global _model_in_flight
+    if MODEL_MAX_IN_FLIGHT <= 0:
+        return '', ''
+    with _model_lock:
+        if _model_in_flight >= MODEL_MAX_IN_FLIGHT:
+            return None
+        _model_in_flight += 1
+    lease = _lease_model_slot() if RATE_LIMIT_SHARED else ('', '')
+    if lease is None:
+        with _model_lock:
+            _model_in_flight -= 1
+    return lease
+
+
+def release_model_slot(lease: Tuple[str, str]):
+    global _model_in_flight
+    if MODEL_MAX_IN_FLIGHT <= 0:
+        return
+    with _model_lock:
+        _model_in_flight = max(_model_in_flight - 1, 0)
+    sk, lease_id = lease
+    if sk:
+        try:
+            get_dynamodb_client(shared=True).delete_item(
+                TableName=TABLE_NAME,
+                Key=to_dynamo({'pk': OFFSET_PK, 'sk': sk}),
+                ConditionExpression='lease_id = :lease',
+                ExpressionAttributeValues=to_dynamo({':lease': lease_id})
+            )
+        except Exception as e:
+            log_debug("Model slot %s already reclaimed: %s", sk, e)
+
+
+def get_telegram_file(file_id: str) -> Optional[bytes]:
+    """Download a file from Telegram by file_id."""
+    if not TELEGRAM_TOKEN:
+        return None
+    try:
+        resp = get_http().get(f"{TELEGRAM_API}/getFile", params={"file_id": file_id}, timeout=10)
+        data = json_loads(resp.content)
+        if not data.get("ok"):
+            log_warning("Failed to get file info: %s", data)
+            return None
+
+        file_path = data["result"]["file_path"]
+        download_url = f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{file_path}"
+        file_resp = get_http().get(download_url, timeout=30)
+        if file_resp.status_code == 200:
+            return file_resp.content
+        else:
+            log_warning("Failed to download file: %s", file_resp.status_code)
+            return None
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        log_error("Error downloading file: %s", e)
+        return None
+
+
+def stream_telegram_file(file_id: str, max_bytes: int = IMPORT_MAX_BYTES):
+    """Yield a Telegram file in chunks, aborting once more than max_bytes arrive."""
+    if not TELEGRAM_TOKEN:
+        raise ArchiveImportError("download_error", "Failed to download file. Please try again.")
+    try:
+        resp = get_http().get(f"{TELEGRAM_API}/getFile", params={"file_id": file_id}, timeout=10)
+        data = json_loads(resp.content)
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        log_error("Error getting file info: %s", e)
+        raise ArchiveImportError("download_error", "Failed to download file. Please try again.")
+    if not data.get("ok"):
+        log_warning("Failed to get file info: %s", data)
+        raise ArchiveImportError("download_error", "Failed to download file. Please try again.")
+
+    result = data["result"]
+    if result.get("file_size", 0) > max_bytes:
+        raise ArchiveImportError.too_large(max_bytes)
+
+    download_url = f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{result['file_path']}"
+    try:
+        with get_http().get(download_url, stream=True, timeout=30) as file_resp:
+            if file_resp.status_code != 200:
+                log_warning("Failed to download file: %s", file_resp.status_code)
+                raise ArchiveImportError("download_error", "Failed to download file. Please try again.")
+            if int(file_resp.headers.get("Content-Length") or 0) > max_bytes:
+                raise ArchiveImportError.too_large(max_bytes)
+            received = 0
+            for chunk in file_resp.iter_content(chunk_size=IMPORT_CHUNK_SIZE):
+                received += len(chunk)
+                if received > max_bytes:
+                    raise ArchiveImportError.too_large(max_bytes)
+                yield chunk
+    except ArchiveImportError:
+        raise
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        log_error("Error downloading file: %s", e)
+        raise ArchiveImportError("download_error", "Failed to download file. Please try again.")
+
+
+def get_user_items(user_id: int) -> List[Dict[str, Any]]:
+    """Query all session items for a user (skips rate-limit counters and other bookkeeping)."""
+    try:
+        return db_query(user_id, 'MODEL#')
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        log_error("Error querying user items for %s: %s", user_id, e)
+        return []
+
+
+def get_active_session(user_id: int) -> Optional[Dict[str, Any]]:
+    """Get the active session for a user."""
+    scope = getattr(_read_local, 'scope', None)
+    prefetched = scope is not None and ('item', user_id, ACTIVE_SK) in scope.cache
+    if prefetched:
+        # Seeded by the polling prefetch: following the pointer costs no round trips
+        pointer = db_get_item({'pk': user_id, 'sk': ACTIVE_SK})
+        if pointer:
+            item = db_get_item({'pk': user_id, 'sk': pointer['session_sk']})
+            if item and item.get('is_active', 0) == 1:
+                return item
+    items = get_user_items(user_id)
+    for item in items:
+        if item.get('is_active', 0) == 1:
+            log_debug("Found active session for user %s: %s", user_id, item['sk'])
+            if prefetched:
+                set_active_pointer(user_id, item['sk'])  # missing or stale; repair for the next batch
+            return item
+    log_debug("No active session found for user %s", user_id)
+    return None
+
+
+def set_active_pointer(user_id: int, session_sk: str):
+    db_put_item({'pk': user_id, 'sk': ACTIVE_SK, 'session_sk': session_sk})
+
+
+def _batch_get_chunk(client, deadline: Optional[float], keys: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], float]:
+    """
+    One BatchGetItem of up to 100 keys, retrying unprocessed keys; returns items and elapsed ms.
+
+    Runs on pool threads, which see neither the invocation's deadline nor its
+    spans: the caller passes the deadline in and records the elapsed time.
+    """
+    started = time.perf_counter()
+    request = {TABLE_NAME: {'Keys': [to_dynamo(k) for k in keys]}}
+    items = []
+    for attempt in range(5):
+        if deadline is not None and time.monotonic() >= deadline:
+            raise DeadlineExceeded("no time left for dynamodb.batch_get_item")
+        response = client.batch_get_item(RequestItems=request)
+        items.extend(response.get('Responses', {}).get(TABLE_NAME, []))
+        request = response.get('UnprocessedKeys') or {}
+        if not request:
+            break
+        pause = min(0.05 * 2 ** attempt, 1.0)
+        if deadline is not None and time.monotonic() + pause >= deadline:
+            raise DeadlineExceeded("no time left to retry dynamodb.batch_get_item")
+        time.sleep(pause)
+    return items, (time.perf_counter() - started) * 1000.0
+
+
+def db_batch_get(keys: List[Dict[str, Any]]) -> Dict[Tuple[int, str], Dict[str, Any]]:
+    """Fetch keys with BatchGetItem, 100 per call and the calls in parallel; returns raw items by (pk, sk)."""
+    get_dynamodb_client()
+    client = _bot_client('dynamodb', _dynamodb_client, 'dynamodb-batch')  # spans recorded below
+    deadline = getattr(_trace, 'deadline', None)
+
+    def fetch(chunk):
+        return _batch_get_chunk(client, deadline, chunk)
+
+    chunks = [keys[i:i + 100] for i in range(0, len(keys), 100)]
+    try:
+        if len(chunks) == 1:
+            results = [fetch(chunks[0])]
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=min(len(chunks), 8)) as pool:
+                results = list(pool.map(fetch, chunks))
+    except DeadlineExceeded:
+        incr_metric('deadline_exceeded')
+        raise
+    found = {}
+    for items, elapsed_ms in results:
+        record_span('dynamodb_read', elapsed_ms)
+        for item in items:
+            found[(int(item['pk']['N']), item['sk']['S'])] = item
+    return found
+
+
+def prefetch_active_sessions(user_ids: List[int]) -> Dict[int, Dict[tuple, Any]]:
+    """
+    Read the active session of every user in a polling batch in two rounds of BatchGetItem:
+    the ACTIVE pointers, then the sessions they name. Returns read_scope seeds per user.
+    """
+    seeds: Dict[int, Dict[tuple, Any]] = {user_id: {} for user_id in user_ids}
+    try:
+        pointers = db_batch_get([{'pk': user_id, 'sk': ACTIVE_SK} for user_id in user_ids])
+        session_keys = []
+        for user_id in user_ids:
+            pointer = pointers.get((user_id, ACTIVE_SK))
+            seeds[user_id][('item', user_id, ACTIVE_SK)] = pointer
+            if pointer:
+                session_keys.append({'pk': user_id, 'sk': pointer['session_sk']['S']})
+        sessions = db_batch_get(session_keys) if session_keys else {}
+        for key in session_keys:
+            seeds[key['pk']][('item', key['pk'], key['sk'])] = sessions.get((key['pk'], key['sk']))
+    except Exception as e:
+        log_warning("Session prefetch failed, reading per update: %s", e)
+        return {}
+    log_debug("Prefetched %d active sessions for %d users", len(session_keys), len(user_ids))
+    return seeds
+
+
+def create_session(user_id: int, model_name: str = "llama3") -> Dict[str, Any]:
+    """Create a new session, deactivate old active ones."""
+    session_id = str(uuid.uuid4())
+    sk = f"MODEL#{model_name}#SESSION#{session_id}"
+    now = int(time.time())
+    item = {
+        'pk': user_id,
+        'sk': sk,
+        'model_name': model_name,
+        'session_id': session_id,
+        'is_active': 1,
+        'last_message_ts': now,
+        'conversation': [],
+        'user_id': user_id,
+        's3_path': '',
+    }
+    deactivate_other_sessions(user_id, sk)
+    db_put_item(item)
+    set_active_pointer(user_id, sk)
+    count_usage(user_id, 'sessions', model_name)
+    log_info("Created new session for user %s: %s", user_id, sk)
+    return item
+
+
+def deactivate_other_sessions(user_id: int, keep_sk: str):
+    """Clear is_active on every session of the user except keep_sk."""
+    existing_items = get_user_items(user_id)
+    for it in existing_items:
+        if it.get('is_active', 0) == 1 and it['sk'] != keep_sk:
+            log_debug("Deactivating existing session for user %s: %s", user_id, it['sk'])
+            db_update_item({'pk': user_id, 'sk': it['sk']}, 'SET is_active = :val', {':val': 0})
+
+
+def get_current_session(user_id: int) -> Dict[str, Any]:
+    """Get active session or create one if none exists."""
+    session = get_active_session(user_id)
+    if not session:
+        log_debug("No active session, creating new for user %s", user_id)
+        session = create_session(user_id)
+    else:
+        log_debug("Using existing active session for user %s", user_id)
+    return session
+
+
+def append_to_conversation(session: Dict[str, Any], message_dict: Dict[str, Any]):
+    """Append a message to the session's conversation and update timestamp."""
+    session['conversation'].append(message_dict)
+    session['last_message_ts'] = int(time.time())
+    position = int(session.get('cold_count', 0)) + len(session['conversation']) - 1
+    note_for_search(int(session['pk']), [search_doc(session['session_id'], position, message_dict.get('ts', 0),
+                                                    message_dict.get('content', ''))])
+    merged_away = spill_cold_turns(session)
+    db_put_item(session)
+    delete_segments(merged_away)
+    count_usage(int(session['pk']), 'messages', session['model_name'])
+    log_debug("Appended message to session %s, conversation length: %d", session['sk'], len(session['conversation']))
+
+
+# ==================== MODEL ROUTING ====================
+#
+# Each (endpoint, model) pair is a target with its own circuit breaker and a
+# rolling window of call latencies. A breaker opens after BREAKER_FAILURES
+# consecutive failures (errors, or calls slower than BREAKER_SLOW_MS), fails
+# fast while open, and after BREAKER_COOLDOWN lets a single half-open probe
+# through: success closes it, failure opens it again.
+#
+# Targets are tried in preference order: the session's model on OLLAMA_URL,
+# then on each of OLLAMA_URLS, then OLLAMA_FALLBACK_MODEL on the same
+# endpoints. Targets whose rolling p95 is above ROUTE_P95_MS are passed over
+# while a faster one is available. Samples older than ROUTE_SAMPLE_MAX_AGE
+# are dropped, so a passed-over target that has had no calls since is tried
+# again: that one call decides whether it stays passed over. State is per
+# container.
+
+class CircuitBreaker:
+    """closed -> open on repeated failures -> half_open after a cooldown -> closed on success."""
+    __slots__ = ('state', 'failures', 'opened_at', 'probing', 'last_error')
+
+    def __init__(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.last_error = ''
+
+    def allow(self, now: float) -> bool:
+        if self.state == 'open' and now - self.opened_at >= BREAKER_COOLDOWN:
+            self.state = 'half_open'
+        if self.state == 'half_open':
+            if self.probing:
+                return False
+            self.probing = True
+        return self.state != 'open'
+
+    def release(self):
+        """Give back a half-open probe that ended without telling whether the target recovered."""
+        self.probing = False
+
+    def record_success(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.probing = False
+
+    def record_failure(self, now: float, error: str):
+        self.failures += 1
+        self.probing = False
+        self.last_error = error
+        if self.state == 'half_open' or self.failures >= BREAKER_FAILURES:
+            if self.state != 'open':
+                log_warning("Circuit breaker opened after %d failures: %s", self.failures, error)
+            self.state = 'open'
+            self.opened_at = now
+
+
+class ModelTarget:
+    __slots__ = ('url', 'model', 'breaker', 'latencies', 'slow')
+
+    def __init__(self, url: str, model: str):
+        self.url = url
+        self.model = model
+        self.breaker = CircuitBreaker()
+        self.latencies: List[Tuple[float, float]] = []  # (monotonic time, ms), oldest first
+        self.slow = False  # passed over when it last had recent samples
+
+    def observe(self, elapsed_ms: float):
+        self.latencies.append((time.monotonic(), elapsed_ms))
+        if len(self.latencies) > ROUTE_WINDOW:
+            del self.latencies[0]
+
+    def recent(self) -> List[float]:
+        """Latencies of the last ROUTE_SAMPLE_MAX_AGE seconds; older samples are dropped."""
+        cutoff = time.monotonic() - ROUTE_SAMPLE_MAX_AGE
+        while self.latencies and self.latencies[0][0] < cutoff:
+            del self.latencies[0]
+        return [ms for _, ms in self.latencies]
+
+    def percentile(self, pct: float) -> Optional[float]:
+        ordered = sorted(self.recent())
+        if not ordered:
+            return None
+        return ordered[min(int(len(ordered) * pct / 100.0), len(ordered) - 1)]
+
+
+_model_target_cache: Dict[Tuple[str, str], ModelTarget] = {}
+_routing_lock = threading.Lock()
+
+
+def model_targets(model: str) -> List[ModelTarget]:
+    """All targets for a model in preference order (primary endpoint first, fallback model last)."""
+    urls = [OLLAMA_URL.rstrip('/')] + [u for u in OLLAMA_URLS if u != OLLAMA_URL.rstrip('/')]
+    models = [model] + ([OLLAMA_FALLBACK_MODEL] if OLLAMA_FALLBACK_MODEL and OLLAMA_FALLBACK_MODEL != model else [])
+    targets = []
+    for name in models:
+        for url in urls:
+            target = _model_target_cache.get((url, name))
+            if target is None:
+                target = _model_target_cache[(url, name)] = ModelTarget(url, name)
+            targets.append(target)
+    return targets
+
+
+def route_model_call(model: str) -> List[ModelTarget]:
+    """Targets for this call, best first: healthy ones in preference order, then slow ones by p95."""
+    fast, slow = [], []
+    with _routing_lock:
+        for target in model_targets(model):
+            p95 = target.percentile(95)
+            if p95 is not None:
+                # Once passed over, one slow sample after the old ones aged out keeps it there
+                target.slow = p95 > ROUTE_P95_MS and (target.slow or len(target.latencies) >= ROUTE_MIN_SAMPLES)
+            if p95 is not None and target.slow:
+                slow.append((p95, target))
+            else:
+                fast.append(target)
+    slow.sort(key=lambda pair: pair[0])
+    return fast + [target for _, target in slow]
+
+
+def call_ollama(model: str, messages: List[Dict[str, Any]]) -> str:
+    """Call Ollama API for chat completion, routed around slow or failing targets."""
+    if not OLLAMA_URL:
+        log_warning("OLLAMA_URL not configured.")
+        return "Ollama URL not configured. Set OLLAMA_URL env var."
+    attempts = 0
+    last_error = ''
+    for target in route_model_call(model):
+        if attempts >= OLLAMA_MAX_ATTEMPTS:
+            break
+        # Leave enough time to save the turn and send the reply; checked before
+        # allow(), which may hand out the target's only half-open probe
+        budget = time_left() - DEADLINE_RESERVE_MS / 1000.0
+        if budget < 1.0:
+            incr_metric('deadline_cut')
+            last_error = 'out of time'
+            break
+        with _routing_lock:
+            allowed = target.breaker.allow(time.monotonic())
+        if not allowed:
+            continue
+        attempts += 1
+        if target.model != model or target.url != OLLAMA_URL.rstrip('/'):
+            incr_metric('model_fallback')
+        log_debug("Calling Ollama at %s with model '%s' (context length: %d)", target.url, target.model, len(messages))
+        payload = {
+            "model": target.model,
+            "messages": messages,
+            "stream": False
+        }
+        started = time.monotonic()
+        error = ''
+        try:
+            resp = get_http().post(f"{target.url}/api/chat", data=json_dumps(payload), headers=JSON_HEADERS,
+                                   timeout=(3.05, min(OLLAMA_TIMEOUT, budget)))
+            if resp.status_code == 200:
+                response_content = json_loads(resp.content)['message']['content']
+            else:
+                error = f"error {resp.status_code}"
+                log_error("Ollama API error: %s - %.500s", resp.status_code, resp.text)
+        except Exception as e:
+            error = 'connection error'
+            log_error("Ollama call error at %s: %s", target.url, e)
+        elapsed_ms = (time.monotonic() - started) * 1000.0
+        if error and budget < OLLAMA_TIMEOUT and elapsed_ms >= budget * 1000.0 * 0.9:
+            # Our own budget ran out, not the target's fault: leave its breaker alone
+            with _routing_lock:
+                target.breaker.release()
+            incr_metric('deadline_cut')
+            last_error = 'out of time'
+            break
+
+        with _routing_lock:
+            target.observe(elapsed_ms)
+            if not error and elapsed_ms > BREAKER_SLOW_MS:
+                target.breaker.record_failure(time.monotonic(), f"slow response ({elapsed_ms:.0f}ms)")
+            elif error:
+                target.breaker.record_failure(time.monotonic(), error)
+            else:
+                target.breaker.record_success()
+        if not error:
+            log_debug("Ollama success: Response length %d chars", len(response_content))
+            return response_content
+        last_error = error
+
+    if last_error == 'out of time':
+        log_warning("No time left for a model reply in this invocation")
+        return "Sorry, I ran out of time on that one. Please send it again."
+    if not attempts:
+        incr_metric('model_breaker_open')
+        log_warning("All model targets for '%s' are unavailable, failing fast", model)
+        return "Sorry, the AI is temporarily unavailable. Please try again in a minute. Use /status to check connection."
+    return f"Sorry, AI response unavailable ({last_error}). Use /status to check connection."
+
+
+def model_status_lines() -> List[str]:
+    """Breaker state and latency for every target this container has used or would use."""
+    lines = []
+    with _routing_lock:
+        targets = list(_model_target_cache.values()) or model_targets("llama3")
+        for target in targets:
+            p50, p95 = target.percentile(50), target.percentile(95)
+            latency = (f"p50 {p50:.0f}ms, p95 {p95:.0f}ms ({len(target.latencies)} recent calls)"
+                       if p50 is not None else "no recent calls")
+            state = target.breaker.state.replace('_', '-')
+            if target.breaker.state != 'closed' and target.breaker.last_error:
+                state += f" ({target.breaker.last_error})"
+            lines.append(f"- {target.model} @ {target.url}: {state}, {latency}")
+    return lines
+
+
+# ==================== LONG-TERM MEMORY ====================
+#
+# Users' messages are remembered across sessions as embedding vectors. A chat
+# turn only notes the text; after the replies have been sent, lambda_handler
+# calls embed_pending_memory(), which adds the texts to a pending string set
+# on the user's MEMORY item. Once MEMORY_BATCH texts are pending they are
+# embedded with one /api/embed call and written to S3 as a segment:
+#
+#   memory/{user_id}/{segment}.bin = [header JSON]\n[count x dim float32, unit length]
+#
+# and the segment name moves into the item's `segments` set in the same
+# conditional update that removes the batch from `pending`, so two Lambdas
+# flushing at once cannot both commit it (see commit_segment; the search
+# index below uses the same scheme). Once a user has more than
+# MEMORY_MAX_SEGMENTS segments they are merged into one, so a cold container
+# needs few GETs. At prompt time a user's segments are loaded once per
+# container into one matrix and the current message's embedding is scored
+# against every row with a single matrix-vector product when NumPy is
+# installed. Loaded indexes are kept least recently used first and evicted
+# past MEMORY_CACHE_BYTES. NumPy is optional; without it the plain-Python
+# scan only covers the newest MEMORY_SCAN_LIMIT vectors.
+
+_numpy = None
+_memory_lock = threading.Lock()
+
+
+def get_numpy():
+    """NumPy if it is installed, else None (it is optional)."""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+
+def trim_cache(cache: Dict[Any, Any], max_bytes: int, size: Callable[[Any], int], keep: Any = None):
+    """Evict from the front of cache (least recently used first) until its entries fit in max_bytes."""
+    total = sum(size(value) for value in cache.values())
+    for key in list(cache):
+        if total <= max_bytes:
+            break
+        if key != keep:
+            total -= size(cache.pop(key))
+
+
+def unit_vector(values: List[float]) -> List[float]:
+    norm = sum(v * v for v in values) ** 0.5
+    return [v / norm for v in values] if norm else list(values)
+
+
+def encode_memory_segment(texts: List[str], vectors: List[List[float]]) -> bytes:
+    from array import array
+    matrix = array('f', [v for vec in vectors for v in unit_vector(vec)])
+    if matrix.itemsize != 4:
+        raise ValueError("float32 arrays are not available on this platform")
+    return memory_segment_body(texts, len(vectors[0]), matrix.tobytes())
+
+
+def memory_segment_body(texts: List[str], dim: int, raw: bytes) -> bytes:
+    header = json_dumps({'model': EMBED_MODEL, 'dim': dim, 'count': len(texts), 'texts': texts})
+    return header + b'\n' + raw
+
+
+def decode_memory_segment(data: bytes) -> Tuple[Dict[str, Any], bytes]:
+    """Split a segment into its header and raw float32 matrix."""
+    newline = data.index(b'\n')
+    return json_loads(data[:newline]), data[newline + 1:]
+
+
+class MemoryIndex:
+    """A user's remembered texts and their unit vectors, searchable by cosine similarity."""
+    __slots__ = ('texts', 'dim', 'rows', 'blocks', 'matrix', 'segments', 'nbytes')
+
+    def __init__(self):
+        self.texts: List[str] = []
+        self.dim = 0
+        self.rows: List[Any] = []  # float32 arrays, one per text (no NumPy)
+        self.blocks: List[Any] = []  # segment matrices not yet joined into matrix (NumPy)
+        self.matrix = None  # count x dim float32 matrix (NumPy)
+        self.segments: set = set()
+        self.nbytes = 0  # roughly what the vectors and texts take in memory
+
+    def add(self, texts: List[str], raw: bytes, dim: int):
+        if self.dim and dim != self.dim:
+            log_warning("Skipping memory segment with %d dimensions (index has %d)", dim, self.dim)
+            return
+        self.dim = dim
+        np = get_numpy()
+        if np is not None:
+            self.blocks.append(np.frombuffer(raw, dtype='<f4').reshape(len(texts), dim))
+        else:
+            from array import array
+            flat = array('f', raw)
+            self.rows.extend(flat[i * dim:(i + 1) * dim] for i in range(len(texts)))
+        self.texts.extend(texts)
+        self.nbytes += len(raw) + sum(len(t) for t in texts)
+
+    def search(self, query: List[float], k: int) -> List[Tuple[float, str]]:
+        """Top-k (score, text) pairs, best first."""
+        if not self.texts or len(query) != self.dim:
+            return []
+        query = unit_vector(query)
+        np = get_numpy()
+        if np is not None:
+            if self.blocks:
+                # Join once per batch of new segments rather than copying the matrix per segment
+                self.matrix = np.concatenate(([self.matrix] if self.matrix is not None else []) + self.blocks)
+                self.blocks = []
+            scores = self.matrix @ np.asarray(query, dtype='<f4')
+            if len(scores) > k:
+                top = np.argpartition(scores, -k)[-k:]
+            else:
+                top = np.arange(len(scores))
+            return sorted(((float(scores[i]), self.texts[i]) for i in top), reverse=True)
+        offset = max(len(self.rows) - MEMORY_SCAN_LIMIT, 0)
+        scores = [sum(map(mul, row, query)) for row in self.rows[offset:]]
+        best = heapq.nlargest(k, range(len(scores)), key=scores.__getitem__)
+        return [(scores[i], self.texts[offset + i]) for i in best]
+
+
+def embed_texts(texts: List[str]) -> Optional[List[List[float]]]:
+    """Embed a batch of texts with one Ollama call; None if the embedding model is unavailable."""
+    with _routing_lock:
+        target = _model_target_cache.get((OLLAMA_URL.rstrip('/'), EMBED_MODEL))
+        if target is None:
+            target = _model_target_cache[(OLLAMA_URL.rstrip('/'), EMBED_MODEL)] = ModelTarget(OLLAMA_URL.rstrip('/'), EMBED_MODEL)
+        if not target.breaker.allow(time.monotonic()):
+            return None
+    started = time.monotonic()
+    vectors, error = None, ''
+    try:
+        resp = get_http().post(f"{target.url}/api/embed", data=json_dumps({"model": EMBED_MODEL, "input": texts}),
+                               headers=JSON_HEADERS, timeout=(3.05, OLLAMA_TIMEOUT))
+        if resp.status_code == 200:
+            vectors = json_loads(resp.content).get('embeddings') or []
+            if len(vectors) != len(texts) or not all(vectors):
+                vectors, error = None, 'bad embedding response'
+        else:
+            error = f"error {resp.status_code}"
+    except Exception as e:
+        error = 'connection error'
+        log_warning("Embedding call error: %s", e)
+    with _routing_lock:
+        target.observe((time.monotonic() - started) * 1000.0)
+        if error:
+            target.breaker.record_failure(time.monotonic(), error)
+        else:
+            target.breaker.record_success()
+    return vectors
+
+
+def queue_pending(user_id: int, sk: str, values: set) -> Dict[str, Any]:
+    """Add values to the `pending` set of the user's sk item; returns the updated item."""
+    response = get_dynamodb_client().update_item(
+        TableName=TABLE_NAME,
+        Key=to_dynamo({'pk': user_id, 'sk': sk}),
+        UpdateExpression='ADD pending :values',
+        ExpressionAttributeValues=to_dynamo({':values': values}),
+        ReturnValues='ALL_NEW'
+    )
+    return from_dynamo(response['Attributes'])
+
+
+def commit_segment(user_id: int, sk: str, key: str, body: bytes, batch: Optional[List[str]] = None) -> bool:
+    """
+    Write a segment to S3 and add its name to the `segments` set of the user's sk item.
+
+    With batch, the same update removes those values from `pending`, on
+    condition that every one of them is still there; if another Lambda
+    committed any of them first the segment is deleted again and False is
+    returned.
+    """
+    name = key.rsplit('/', 1)[-1].split('.', 1)[0]
+    get_s3_client().put_object(Bucket=ARCHIVE_BUCKET, Key=key, Body=body, ContentType='application/octet-stream')
+    if not batch:
+        db_update_item({'pk': user_id, 'sk': sk}, 'ADD segments :segment', {':segment': {name}})
+        return True
+    try:
+        condition = ' AND '.join(f"contains(pending, :p{i})" for i in range(len(batch)))
+        values = {f":p{i}": v for i, v in enumerate(batch)}
+        values.update({':batch': set(batch), ':segment': {name}})
+        get_dynamodb_client().update_item(
+            TableName=TABLE_NAME,
+            Key=to_dynamo({'pk': user_id, 'sk': sk}),
+            UpdateExpression='DELETE pending :batch ADD segments :segment',
+            ConditionExpression=condition,
+            ExpressionAttributeValues=to_dynamo(values)
+        )
+    except get_dynamodb_client().exceptions.ConditionalCheckFailedException:
+        get_s3_client().delete_object(Bucket=ARCHIVE_BUCKET, Key=key)
+        return False
+    return True
+
+
+def replace_segments(user_id: int, sk: str, prefix: str, suffix: str, names: List[str], name: str) -> bool:
+    """
+    Swap the named segments for the one merged from them in the `segments`
+    set of the user's sk item, then delete the old objects.
+
+    Only swaps if nobody else merged these segments meanwhile; otherwise the
+    merged object is deleted again and False is returned.
+    """
+    try:
+        condition = ' AND '.join(f"contains(segments, :s{i})" for i in range(len(names)))
+        values = {f":s{i}": n for i, n in enumerate(names)}
+        values.update({':old': set(names), ':new': {name}})
+        get_dynamodb_client().update_item(
+            TableName=TABLE_NAME,
+            Key=to_dynamo({'pk': user_id, 'sk': sk}),
+            UpdateExpression='DELETE segments :old ADD segments :new',
+            ConditionExpression=condition,
+            ExpressionAttributeValues=to_dynamo(values)
+        )
+    except get_dynamodb_client().exceptions.ConditionalCheckFailedException:
+        get_s3_client().delete_object(Bucket=ARCHIVE_BUCKET, Key=f"{prefix}/{user_id}/{name}{suffix}")
+        return False
+    get_s3_client().delete_objects(Bucket=ARCHIVE_BUCKET, Delete={
+        'Objects': [{'Key': f"{prefix}/{user_id}/{n}{suffix}"} for n in names], 'Quiet': True
+    })
+    return True
+
+
+def get_memory_item_key(user_id: int) -> Dict[str, Any]:
+    return {'pk': user_id, 'sk': MEMORY_SK}
+
+
+def load_memory_index(user_id: int) -> MemoryIndex:
+    """The user's memory, fetching only segments this container has not loaded yet."""
+    item = db_get_item(get_memory_item_key(user_id)) or {}
+    segments = set(item.get('segments', ()))
+    cache = _active_bot.state.memory_index_cache
+    index = cache.pop(user_id, None)
+    if index is None or index.segments - segments:
+        index = MemoryIndex()  # new, or some of its segments were merged away: start over
+    cache[user_id] = index  # most recently used last
+    for name in sorted(segments - index.segments):
+        try:
+            response = get_s3_client().get_object(Bucket=ARCHIVE_BUCKET, Key=f"{MEMORY_PREFIX}/{user_id}/{name}.bin")
+            header, raw = decode_memory_segment(response['Body'].read())
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            log_warning("Could not load memory segment %s for user %s: %s", name, user_id, e)
+            continue
+        index.segments.add(name)
+        if header.get('model') == EMBED_MODEL:
+            index.add(header['texts'], raw, int(header['dim']))
+    trim_cache(cache, MEMORY_CACHE_BYTES, lambda cached: cached.nbytes, keep=user_id)
+    return index
+
+
+def recall_memories(user_id: int, text: str, context: List[Dict[str, Any]]) -> List[str]:
+    """Earlier messages most similar to text, leaving out anything already in the context."""
+    if not MEMORY_ENABLED:
+        return []
+    try:
+        index = load_memory_index(user_id)
+        if not index.texts:
+            return []
+        query = embed_texts([text])
+        if not query:
+            return []
+        in_context = {m['content'] for m in context}
+        with span('memory_search'):
+            hits = index.search(query[0], MEMORY_TOP_K + len(in_context))
+        recalled = [t for score, t in hits if score >= MEMORY_MIN_SCORE and t not in in_context][:MEMORY_TOP_K]
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        log_warning("Memory recall failed for user %s: %s", user_id, e)
+        return []
+    incr_metric('memory_recalled', len(recalled))
+    return recalled
+
+
+def memory_prompt(memories: List[str]) -> List[Dict[str, Any]]:
+    """System message carrying recalled memories, to go before the chat context."""
+    if not memories:
+        return []
+    lines = "\n".join(f"- {m}" for m in memories)
+    return [{'role': 'system', 'content': f"Things the user said in earlier conversations:\n{lines}"}]
+
+
+def remember(user_id: int, text: str):
+    """Note a user message for embedding once the invocation's replies are out."""
+    if MEMORY_ENABLED and len(text) >= MEMORY_MIN_CHARS and not text.startswith('/'):
+        with _memory_lock:
+            _active_bot.state.memory_pending.setdefault(user_id, []).append(text)
+
+
+def embed_pending_memory():
+    """Queue this invocation's messages and embed full batches (runs after replies are sent)."""
+    state = _active_bot.state
+    with _memory_lock:
+        pending = dict(state.memory_pending)
+        state.memory_pending.clear()
+    for user_id, texts in pending.items():
+        try:
+            queued = queue_pending(user_id, MEMORY_SK, set(texts)).get('pending', set())
+            if len(queued) >= MEMORY_BATCH:
+                flush_memory_batch(user_id, sorted(queued))
+        except Exception as e:
+            log_warning("Memory update failed for user %s: %s", user_id, e)
+
+
+def flush_memory_batch(user_id: int, texts: List[str]):
+    """Embed pending texts into a new segment and commit it unless another Lambda got there first."""
+    vectors = embed_texts(texts)
+    if vectors is None:
+        return  # still pending; the next flush retries
+    key = f"{MEMORY_PREFIX}/{user_id}/{uuid.uuid4().hex[:12]}.bin"
+    if commit_segment(user_id, MEMORY_SK, key, encode_memory_segment(texts, vectors), texts):
+        incr_metric('memory_embedded', len(texts))
+        log_debug("Committed memory segment %s for user %s (%d texts)", key, user_id, len(texts))
+        segments = (db_get_item(get_memory_item_key(user_id)) or {}).get('segments', ())
+        if len(segments) > MEMORY_MAX_SEGMENTS:
+            merge_memory_segments(user_id, sorted(segments))
+
+
+def merge_memory_segments(user_id: int, names: List[str]):
+    """Rewrite a user's memory segments as one, leaving out vectors from another embedding model."""
+    texts: List[str] = []
+    blocks: List[bytes] = []
+    dim = 0
+    for name in names:
+        response = get_s3_client().get_object(Bucket=ARCHIVE_BUCKET, Key=f"{MEMORY_PREFIX}/{user_id}/{name}.bin")
+        header, raw = decode_memory_segment(response['Body'].read())
+        if header.get('model') != EMBED_MODEL or (dim and int(header['dim']) != dim):
+            continue
+        dim = int(header['dim'])
+        texts.extend(header['texts'])
+        blocks.append(raw)
+    name = uuid.uuid4().hex[:12]
+    get_s3_client().put_object(Bucket=ARCHIVE_BUCKET, Key=f"{MEMORY_PREFIX}/{user_id}/{name}.bin",
+                               Body=memory_segment_body(texts, dim, b''.join(blocks)),
+                               ContentType='application/octet-stream')
+    if replace_segments(user_id, MEMORY_SK, MEMORY_PREFIX, '.bin', names, name):
+        log_info("Merged %d memory segments for user %s (%d texts)", len(names), user_id, len(texts))
+
+
+# ==================== SEARCH INDEX ====================
+#
+# /search runs against a per-user inverted index over every message appended
+# to a session or imported as an archive; archiving does not change it, since
+# an archive keeps its session_id and message positions. A message is a doc
+# keyed by (session_id, position). New docs wait in the `pending` set of the
+# user's SEARCH item and are indexed SEARCH_BATCH at a time, after the replies
+# have been sent, into a gzip segment:
+#
+#   search/{user_id}/{segment}.idx = [header JSON]\n[postings]
+#
+# The header holds the doc table ([session_id, position, ts, length, snippet])
+# and, per term, the offset, byte length and doc count of its postings list:
+# (doc number delta, term frequency) varint pairs in doc order. Segments are
+# committed like memory segments, and once there are more than
+# SEARCH_MAX_SEGMENTS they are merged into one. Queries read the SEARCH item
+# and any segments this container has not cached yet, decode only the
+# postings of the query terms and rank docs with BM25; conversation bodies
+# are never read. Cached segments are evicted per user, least recently used
+# first, past SEARCH_CACHE_BYTES.
+
+_search_lock = threading.Lock()
+_SEARCH_STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have i if in is it its me my of on or so that the this to "
+    "was we were what when with you your".split()
+)
+_SEARCH_TOKEN_RE = re.compile(r'\w+')
+
+
+def search_terms(text: str) -> List[str]:
+    """Lowercased word tokens of text, without stopwords or single characters."""
+    return [t[:32] for t in _SEARCH_TOKEN_RE.findall(text.lower()) if len(t) > 1 and t not in _SEARCH_STOPWORDS]
+
+
+def _put_varint(out: bytearray, value: int):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varints(data: bytes, start: int, end: int) -> List[int]:
+    chunk = data[start:end]
+    if not chunk or max(chunk) < 0x80:
+        return list(chunk)  # every value fits in one byte, the common case for dense postings
+    values, value, shift = [], 0, 0
+    for byte in chunk:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value, shift = 0, 0
+    return values
+
+
+def search_doc(session_id: str, position: int, ts: int, content: str) -> str:
+    """A pending doc, as the JSON string stored in the SEARCH item's `pending` set."""
+    return json_text([session_id, position, ts, content[:SEARCH_MAX_DOC_CHARS]])
+
+
+def encode_search_segment(docs: List[List[Any]]) -> bytes:
+    """Index docs ([session_id, position, ts, content]) into a compressed segment."""
+    table, inverted = [], {}
+    for number, (session_id, position, ts, content) in enumerate(docs):
+        terms = search_terms(content)
+        table.append([session_id, position, ts, len(terms), ' '.join(content.split())[:SEARCH_SNIPPET_CHARS]])
+        counts: Dict[str, int] = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        for term, tf in counts.items():
+            inverted.setdefault(term, []).append((number, tf))
+    return _encode_index(table, inverted)
+
+
+def _encode_index(table: List[List[Any]], inverted: Dict[str, List[Tuple[int, int]]]) -> bytes:
+    postings = bytearray()
+    directory = {}
+    for term in sorted(inverted):
+        start, previous = len(postings), 0
+        for number, tf in inverted[term]:
+            _put_varint(postings, number - previous)
+            _put_varint(postings, tf)
+            previous = number
+        directory[term] = [start, len(postings) - start, len(inverted[term])]
+    header = json_dumps({'docs': table, 'terms': directory})
+    return gzip.compress(header + b'\n' + bytes(postings))
+
+
+class SearchSegment:
+    """A decoded segment: the doc table, term directory and raw postings."""
+    __slots__ = ('docs', 'terms', 'postings', 'total_length', 'nbytes')
+
+    def __init__(self, data: bytes):
+        data = gzip.decompress(data)
+        newline = data.index(b'\n')
+        header = json_loads(data[:newline])
+        self.docs: List[List[Any]] = header['docs']
+        self.terms: Dict[str, List[int]] = header['terms']
+        self.postings = data[newline + 1:]
+        self.total_length = sum(doc[3] for doc in self.docs)
+        self.nbytes = len(data)  # decompressed size, a rough measure of what the decoded segment holds
+
+    def lookup(self, term: str) -> List[Tuple[int, int]]:
+        """(doc number, term frequency) pairs for term."""
+        entry = self.terms.get(term)
+        if entry is None:
+            return []
+        values = _read_varints(self.postings, entry[0], entry[0] + entry[1])
+        return list(zip(accumulate(values[0::2]), values[1::2]))
+
+
+def note_for_search(user_id: int, docs: List[str]):
+    """Queue docs (see search_doc) for indexing once the invocation's replies are out."""
+    if SEARCH_ENABLED and docs:
+        with _search_lock:
+            _active_bot.state.search_pending.setdefault(user_id, []).extend(docs)
+
+
+def index_pending_search():
+    """Index this invocation's messages: full batches become segments, the rest wait in DynamoDB."""
+    state = _active_bot.state
+    with _search_lock:
+        pending = dict(state.search_pending)
+        state.search_pending.clear()
+    for user_id, docs in pending.items():
+        try:
+            if len(docs) >= SEARCH_BATCH:
+                # Imports: index straight into a segment rather than through the item
+                key = f"{SEARCH_PREFIX}/{user_id}/{uuid.uuid4().hex[:12]}.idx"
+                commit_segment(user_id, SEARCH_SK, key, encode_search_segment([json_loads(d) for d in docs]))
+                incr_metric('search_indexed', len(docs))
+                item = db_get_item({'pk': user_id, 'sk': SEARCH_SK}) or {}
+            else:
+                item = queue_pending(user_id, SEARCH_SK, set(docs))
+                queued = item.get('pending', set())
+                if len(queued) >= SEARCH_BATCH:
+                    batch = sorted(queued)
+                    key = f"{SEARCH_PREFIX}/{user_id}/{uuid.uuid4().hex[:12]}.idx"
+                    if commit_segment(user_id, SEARCH_SK, key,
+                                      encode_search_segment([json_loads(d) for d in batch]), batch):
+                        incr_metric('search_indexed', len(batch))
+                        item['segments'] = set(item.get('segments', ())) | {key.rsplit('/', 1)[-1][:-4]}
+            if len(item.get('segments', ())) > SEARCH_MAX_SEGMENTS:
+                merge_search_segments(user_id, sorted(item['segments']))
+        except Exception as e:
+            log_warning("Search indexing failed for user %s: %s", user_id, e)
+
+
+def merge_search_segments(user_id: int, names: List[str]):
+    """Rewrite a user's segments as one, dropping docs indexed more than once."""
+    segments = load_search_segments(user_id, names)
+    table: List[List[Any]] = []
+    inverted: Dict[str, List[Tuple[int, int]]] = {}
+    seen = set()
+    for name in names:
+        if name not in segments:
+            continue
+        # Renumber docs in order; postings stay sorted because new numbers only grow
+        segment, renumber = segments[name], {}
+        for number, doc in enumerate(segment.docs):
+            if (doc[0], doc[1]) not in seen:
+                seen.add((doc[0], doc[1]))
+                renumber[number] = len(table)
+                table.append(doc)
+        for term in segment.terms:
+            pairs = [(renumber[n], tf) for n, tf in segment.lookup(term) if n in renumber]
+            if pairs:
+                inverted.setdefault(term, []).extend(pairs)
+    name = uuid.uuid4().hex[:12]
+    get_s3_client().put_object(Bucket=ARCHIVE_BUCKET, Key=f"{SEARCH_PREFIX}/{user_id}/{name}.idx",
+                               Body=_encode_index(table, inverted), ContentType='application/octet-stream')
+    if replace_segments(user_id, SEARCH_SK, SEARCH_PREFIX, '.idx', names, name):
+        log_info("Merged %d search segments for user %s (%d docs)", len(names), user_id, len(table))
+
+
+def load_search_segments(user_id: int, names: List[str]) -> Dict[str, SearchSegment]:
+    """The named segments, from the container cache where possible."""
+    cache = _active_bot.state.search_index_cache
+    cached = cache.pop(user_id, None) or {}
+    cache[user_id] = cached  # most recently used last
+    for name in names:
+        if name in cached:
+            continue
+        try:
+            response = get_s3_client().get_object(Bucket=ARCHIVE_BUCKET, Key=f"{SEARCH_PREFIX}/{user_id}/{name}.idx")
+            cached[name] = SearchSegment(response['Body'].read())
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            log_warning("Could not load search segment %s for user %s: %s", name, user_id, e)
+    for name in [n for n in cached if n not in names]:
+        del cached[name]  # merged away
+    trim_cache(cache, SEARCH_CACHE_BYTES,
+               lambda segments: sum(segment.nbytes for segment in segments.values()), keep=user_id)
+    return cached
+
+
+def search_messages(user_id: int, query: str, k1: float = 1.2, b: float = 0.75) -> List[Dict[str, Any]]:
+    """Rank the user's indexed messages against query with BM25, best session first."""
+    terms = list(dict.fromkeys(search_terms(query)))
+    if not terms:
+        return []
+    item = db_get_item({'pk': user_id, 'sk': SEARCH_SK}) or {}
+    segments = list(load_search_segments(user_id, sorted(item.get('segments', ()))).values())
+    if item.get('pending'):
+        segments.append(SearchSegment(encode_search_segment([json_loads(d) for d in item['pending']])))
+
+    with span('search_query'):
+        total_docs = sum(len(seg.docs) for seg in segments)
+        if not total_docs:
+            return []
+        average_length = max(sum(seg.total_length for seg in segments) / total_docs, 1.0)
+        base, slope = k1 * (1 - b), k1 * b / average_length
+        plan = []
+        for term in terms:
+            postings = [seg.lookup(term) for seg in segments]
+            df = sum(map(len, postings))
+            if df:
+                plan.append((math.log(1 + (total_docs - df + 0.5) / (df + 0.5)) * (k1 + 1), postings))
+        # Rarest terms first. A term can add at most its weight to a doc, so once
+        # the current top sessions beat everything the remaining terms could give
+        # a new doc, common terms only re-score docs that are already candidates.
+        plan.sort(key=lambda p: -p[0])
+        remaining = sum(weight for weight, _ in plan)
+        scores: Dict[Tuple[int, int], float] = {}  # (segment, doc number) -> score
+        for weight, postings in plan:
+            prune = _kth_session_score(scores, segments, SEARCH_MAX_RESULTS) >= remaining
+            remaining -= weight
+            for s, pairs in enumerate(postings):
+                docs = segments[s].docs
+                if prune:
+                    tfs = dict(pairs)
+                    pairs = [(n, tfs[n]) for seg, n in scores if seg == s and n in tfs]
+                for number, tf in pairs:
+                    key = (s, number)
+                    scores[key] = scores.get(key, 0.0) + weight * tf / (tf + base + slope * docs[number][3])
+
+        # Best message per session; a doc indexed twice (e.g. imported again) counts once
+        sessions: Dict[str, List[Any]] = {}  # session_id -> [score, ts, snippet, matches]
+        seen = set()
+        for (s, number), score in scores.items():
+            session_id, position, ts, _, snippet = segments[s].docs[number]
+            if (session_id, position) in seen:
+                continue
+            seen.add((session_id, position))
+            best = sessions.get(session_id)
+            if best is None:
+                sessions[session_id] = [score, ts, snippet, 1]
+            else:
+                best[3] += 1
+                if score > best[0]:
+                    best[0:3] = [score, ts, snippet]
+        ranked = heapq.nsmallest(SEARCH_MAX_RESULTS, sessions.items(), key=lambda kv: (-kv[1][0], -kv[1][1]))
+    return [{'session_id': session_id, 'score': score, 'ts': ts, 'snippet': snippet, 'matches': matches}
+            for session_id, (score, ts, snippet, matches) in ranked]
+
+
+def _kth_session_score(scores: Dict[Tuple[int, int], float], segments: List[SearchSegment], k: int) -> float:
+    """Score of the k-th best session so far (a session scores as its best doc), 0 if fewer."""
+    best: Dict[str, float] = {}
+    for (s, number), score in scores.items():
+        session_id = segments[s].docs[number][0]
+        if score > best.get(session_id, 0.0):
+            best[session_id] = score
+    if len(best) < k:
+        return 0.0
+    return heapq.nlargest(k, best.values())[-1]
+
+
+def reindex_search(user_id: int) -> Dict[str, Any]:
+    """Rebuild a user's index from their archives and sessions (for data from before the index)."""
+    docs = []
+    for archive in list_user_archives(user_id):
+        data = get_archive_from_s3(user_id, archive['session_id']) or {}
+        docs.extend([archive['session_id'], i, m.get('ts', 0), m.get('content', '')]
+                    for i, m in enumerate(data.get('conversation', [])))
+    for session in get_user_items(user_id):
+        try:
+            conversation = get_full_conversation(session)
+        except ColdHistoryError as e:
+            log_warning("Indexing only the inline turns of %s: %s", session.get('sk', ''), e)
+            conversation = session.get('conversation', [])
+        docs.extend([session['session_id'], i, m.get('ts', 0), m.get('content', '')]
+                    for i, m in enumerate(conversation))
+    item = db_get_item({'pk': user_id, 'sk': SEARCH_SK}) or {}
+    name = uuid.uuid4().hex[:12]
+    get_s3_client().put_object(Bucket=ARCHIVE_BUCKET, Key=f"{SEARCH_PREFIX}/{user_id}/{name}.idx",
+                               Body=encode_search_segment(docs), ContentType='application/octet-stream')
+    db_put_item({'pk': user_id, 'sk': SEARCH_SK, 'segments': {name}})
+    stale = item.get('segments', set())
+    if stale:
+        get_s3_client().delete_objects(Bucket=ARCHIVE_BUCKET, Delete={
+            'Objects': [{'Key': f"{SEARCH_PREFIX}/{user_id}/{n}.idx"} for n in stale], 'Quiet': True
+        })
+    _active_bot.state.search_index_cache.pop(user_id, None)
+    log_info("Reindexed %d messages for user %s", len(docs), user_id)
+    return {'user_id': user_id, 'docs': len(docs)}
+
+
+# ==================== ARCHIVE FUNCTIONS ====================
+
+def get_archive_s3_key(user_id: int, session_id: str) -> str:
+    """Generate S3 key for archived session: archives/{user_id}/{session_id}.json"""
+    return f"{ARCHIVE_PREFIX}/{user_id}/{session_id}.json"
+
+
+def get_archive_index_key(user_id: int, session_id: str) -> str:
+    """Generate S3 key for an archive's page index: archive-index/{user_id}/{session_id}.json"""
+    return f"{ARCHIVE_INDEX_PREFIX}/{user_id}/{session_id}.json"
+
+
+def encode_archive(archive_data: Dict[str, Any]) -> Tuple[bytes, Dict[str, Any]]:
+    """
+    Serialize an archive and build its page index.
+
+    The body is ordinary indented JSON, but each message is written on its own
+    line so the byte range of every ARCHIVE_PAGE_SIZE messages can be recorded.
+    A page can then be fetched with an S3 range GET and parsed as `[<range>]`.
+    """
+    header = {k: v for k, v in archive_data.items() if k != 'conversation'}
+    conversation = archive_data.get('conversation', [])
+
+    parts = [json_dumps(header, pretty=True)[:-2], b',\n  "conversation": [\n']
+    offset = len(parts[0]) + len(parts[1])
+    pages = []
+    page_start = offset
+    for i, message in enumerate(conversation):
+        if i:
+            if i % ARCHIVE_PAGE_SIZE == 0:
+                pages.append([page_start, offset])
+            parts.append(b',\n')
+            offset += 2
+            if i % ARCHIVE_PAGE_SIZE == 0:
+                page_start = offset
+        encoded = b'    ' + json_dumps(message)
+        parts.append(encoded)
+        offset += len(encoded)
+    if conversation:
+        pages.append([page_start, offset])
+    parts.append(b'\n  ]\n}')
+
+    index = {
+        'session_id': archive_data.get('session_id', ''),
+        'model_name': archive_data.get('model_name', 'unknown'),
+        'message_count': len(conversation),
+        'page_size': ARCHIVE_PAGE_SIZE,
+        'pages': pages,
+        'tail': conversation[-RESTORE_TAIL_MESSAGES:] if RESTORE_TAIL_MESSAGES > 0 else [],
+    }
+    return b''.join(parts), index
+
+
+def put_archive(user_id: int, archive_data: Dict[str, Any], metadata: Dict[str, str]) -> Optional[str]:
+    """Write an archive and its page index to S3. Returns the archive key."""
+    session_id = archive_data['session_id']
+    s3_key = get_archive_s3_key(user_id, session_id)
+    body, index = encode_archive(archive_data)
+
+    try:
+        response = get_s3_client().put_object(
+            Bucket=ARCHIVE_BUCKET,
+            Key=s3_key,
+            Body=body,
+            ContentType='application/json',
+            Metadata=metadata
+        )
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        log_error("Error writing archive to S3: %s", e)
+        return None
+    # Ties the index to this version of the archive; ranged reads check it with IfMatch
+    index['etag'] = response.get('ETag', '')
+    drop_from_bundle_manifest(user_id, session_id)
+
+    # The index is an optimisation; restore rebuilds it if this write is lost
+    try:
+        get_s3_client().put_object(
+            Bucket=ARCHIVE_BUCKET,
+            Key=get_archive_index_key(user_id, session_id),
+            Body=json_dumps(index),
+            ContentType='application/json'
+        )
+        _active_bot.state.archive_index_cache[s3_key] = index
+    except Exception as e:
+        log_error("Error writing archive index to S3: %s", e)
+    return s3_key
+
+
+def archive_session_to_s3(user_id: int, session: Dict[str, Any]) -> Optional[str]:
+    """Archive a session from DynamoDB to S3."""
+    session_id = session.get('session_id', '')
+    if not session_id:
+        log_warning("Session missing session_id: %s", Preview(session))
+        return None
+
+    try:
+        conversation = get_full_conversation(session)
+    except ColdHistoryError as e:
+        # Archiving only the inline turns would overwrite the full history with part of it
+        log_error("Not archiving %s, older turns are unreadable: %s", session.get('sk', ''), e)
+        return None
+
+    archive_data = {
+        'user_id': user_id,
+        'session_id': session_id,
+        'model_name': session.get('model_name', 'unknown'),
+        'conversation': conversation,
+        'original_sk': session.get('sk', ''),
+        'last_message_ts': session.get('last_message_ts', 0),
+        'archived_at': datetime.utcnow().isoformat() + 'Z',
+        'archive_version': '1.0'
+    }
+
+    s3_key = put_archive(user_id, archive_data, {
+        'user_id': str(user_id),
+        'session_id': session_id,
+        'model_name': session.get('model_name', 'unknown')
+    })
+    if s3_key:
+        count_usage(user_id, 'archives', archive_data['model_name'])
+        log_info("Archived session to S3: s3://%s/%s", ARCHIVE_BUCKET, s3_key)
+    return s3_key
+
+
+def delete_session_from_dynamodb(user_id: int, sk: str) -> bool:
+    """Delete a session from DynamoDB after archiving."""
+    try:
+        db_delete_item({'pk': user_id, 'sk': sk})
+        log_info("Deleted session from DynamoDB: pk=%s, sk=%s", user_id, sk)
+        return True
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        log_error("Error deleting session from DynamoDB: %s", e)
+        return False
+
+
+def scan_user_archives(user_id: int) -> List[Dict[str, Any]]:
+    """List all archived sessions for a user, both loose objects and packed bundles; raises on errors."""
+    prefix = f"{ARCHIVE_PREFIX}/{user_id}/"
+    archives = []
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=ARCHIVE_BUCKET, Prefix=prefix, Delimiter='/'):
+        for obj in page.get('Contents', []):
+            key = obj['Key']
+            if not key.endswith('.json'):
+                continue
+            session_id = key.split('/')[-1].replace('.json', '')
+            archives.append({
+                'session_id': session_id,
+                's3_key': key,
+                'size': obj['Size'],
+                'last_modified': obj['LastModified'].isoformat() if obj.get('LastModified') else ''
+            })
+
+    loose = {a['session_id'] for a in archives}
+    for session_id, entry in load_bundle_manifest(user_id).items():
+        if session_id not in loose:
+            archives.append({
+                'session_id': session_id,
+                's3_key': entry['bundle'],
+                'size': entry['length'],
+                'last_modified': entry.get('last_modified', ''),
+                'bundle_key': entry['bundle']
+            })
+    archives.sort(key=lambda a: a['session_id'])
+    log_debug("Found %d archives for user %s", len(archives), user_id)
+    return archives
+
+
+def list_user_archives(user_id: int) -> List[Dict[str, Any]]:
+    """scan_user_archives, or an empty list (logged) if the listing fails."""
+    try:
+        return scan_user_archives(user_id)
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        log_error("Error listing archives: %s", e)
+        return []
+
+
+def get_archive_from_s3(user_id: int, session_id: str) -> Optional[Dict[str, Any]]:
+    """Retrieve an archived session from S3, with a range GET if it has been packed."""
+    body = get_archive_bytes(user_id, session_id)
+    if body is None:
+        return None
+    try:
+        return json_loads(body)
+    except Exception as e:
+        log_error("Error retrieving archive: %s", e)
+        return None
+
+
+def get_archive_bytes(user_id: int, session_id: str) -> Optional[bytes]:
+    """An archive's JSON as stored, without parsing it."""
+    for refresh in (False, True):
+        s3_key, offset, length = locate_archive(user_id, session_id, refresh)
+        try:
+            if length is None:
+                response = get_s3_client().get_object(Bucket=ARCHIVE_BUCKET, Key=s3_key)
+            else:
+                response = get_s3_client().get_object(
+                    Bucket=ARCHIVE_BUCKET, Key=s3_key, Range=f"bytes={offset}-{offset + length - 1}"
+                )
+            return response['Body'].read()
+        except get_s3_client().exceptions.NoSuchKey:
+            # The archive may have been packed by another container since the manifest was cached
+            if refresh:
+                log_warning("Archive not found: %s", s3_key)
+                return None
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            log_error("Error retrieving archive: %s", e)
+            return None
+
+
+def import_archive_to_s3(user_id: int, archive_data: Dict[str, Any]) -> Optional[str]:
+    """Import an archive file to S3 for a user."""
+    new_session_id = str(uuid.uuid4())
+
+    imported_data = {
+        'user_id': user_id,
+        'session_id': new_session_id,
+        'model_name': archive_data.get('model_name', 'imported'),
+        'conversation': archive_data.get('conversation', []),
+        'original_session_id': archive_data.get('session_id', 'unknown'),
+        'original_user_id': archive_data.get('user_id', 'unknown'),
+        'last_message_ts': archive_data.get('last_message_ts', 0),
+        'archived_at': archive_data.get('archived_at', datetime.utcnow().isoformat() + 'Z'),
+        'imported_at': datetime.utcnow().isoformat() + 'Z',
+        'archive_version': '1.0'
+    }
+
+    s3_key = put_archive(user_id, imported_data, {
+        'user_id': str(user_id),
+        'session_id': new_session_id,
+        'imported': 'true'
+    })
+    if not s3_key:
+        log_error("Error importing archive to S3")
+        return None
+    note_for_search(user_id, [search_doc(new_session_id, i, m.get('ts', 0), m.get('content', ''))
+                              for i, m in enumerate(imported_data['conversation'])])
+    count_usage(user_id, 'imports', imported_data['model_name'])
+    count_usage(user_id, 'imported_messages', imported_data['model_name'], len(imported_data['conversation']))
+    log_info("Imported archive to S3: s3://%s/%s", ARCHIVE_BUCKET, s3_key)
+    return new_session_id
+
+
+# ==================== RESTORE AND COLD HISTORY ====================
+#
+# `conversation` on a session item only holds the hot, most recent turns.
+# `cold_extents` lists where the older ones live, oldest first:
+#   {'kind': 'archive', 'session_id': ..., 'count': n}  - first n messages of an S3 archive
+#   {'kind': 'segment', 'seq': ..., 'count': n}         - an immutable gzip segment
+# `cold_count` is their total. Restored sessions start with an archive extent;
+# long-running sessions grow segment extents as old turns are spilled. A spill
+# rewrites the trailing segments together with the new turns while they fit in
+# SEGMENT_MAX_MESSAGES, so a session has about one segment per that many messages.
+
+
+class ColdHistoryError(Exception):
+    """Older turns of a session could not be read back from S3."""
+
+
+def get_archive_index(user_id: int, session_id: str, refresh: bool = False) -> Optional[Dict[str, Any]]:
+    """Load an archive's page index, building it first for archives that predate indexes."""
+    s3_key = get_archive_s3_key(user_id, session_id)
+    cache = _active_bot.state.archive_index_cache
+    if not refresh and s3_key in cache:
+        return cache[s3_key]
+
+    try:
+        response = get_s3_client().get_object(Bucket=ARCHIVE_BUCKET, Key=get_archive_index_key(user_id, session_id))
+        index = json_loads(response['Body'].read())
+        cache[s3_key] = index
+        return index
+    except get_s3_client().exceptions.NoSuchKey:
+        pass
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        log_error("Error reading archive index: %s", e)
+        return None
+
+    # One-off: rewrite the archive in the paged layout so later reads are ranged
+    log_info("No page index for %s, building it", s3_key)
+    archive_data = get_archive_from_s3(user_id, session_id)
+    if not archive_data:
+        return None
+    metadata = {'user_id': str(user_id), 'session_id': session_id,
+                'model_name': str(archive_data.get('model_name', 'unknown'))}
+    if not put_archive(user_id, archive_data, metadata):
+        return None
+    return cache.get(s3_key)
+
+
+def read_archive_page(user_id: int, session_id: str, page_no: int) -> List[Dict[str, Any]]:
+    """
+    Fetch one page of an archive's conversation with a range GET.
+
+    Offsets come from the cached index, so the GET of a loose archive carries
+    the index's ETag: if another container has re-archived the session since,
+    S3 answers PreconditionFailed and the index is read again. Raises
+    ColdHistoryError when the page cannot be read.
+    """
+    s3_key = get_archive_s3_key(user_id, session_id)
+    pages = _active_bot.state.cold_page_cache
+    for refresh in (False, True):
+        index = get_archive_index(user_id, session_id, refresh)
+        if not index:
+            raise ColdHistoryError(f"no page index for {s3_key}")
+        cache_key = (s3_key, index.get('etag', ''), page_no)
+        if cache_key in pages:
+            return pages[cache_key]
+        if page_no >= len(index['pages']):
+            return []
+        start, end = index['pages'][page_no]
+        object_key, base, length = locate_archive(user_id, session_id)
+        request = {'Bucket': ARCHIVE_BUCKET, 'Key': object_key, 'Range': f"bytes={base + start}-{base + end - 1}"}
+        if length is None and index.get('etag'):
+            request['IfMatch'] = index['etag']  # bundles never change once written
+        try:
+            response = get_s3_client().get_object(**request)
+            page = json_loads(b'[' + response['Body'].read() + b']')
+            break
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            if not refresh and s3_error_code(e) == 'PreconditionFailed':
+                log_info("Archive %s changed since its index was cached, reloading", s3_key)
+                continue
+            raise ColdHistoryError(f"reading page {page_no} of {s3_key}: {e}") from e
+    log_debug("Hydrated page %s of %s (%d messages)", page_no, s3_key, len(page))
+
+    if len(pages) >= COLD_PAGE_CACHE_SIZE:
+        pages.pop(next(iter(pages)))
+    pages[cache_key] = page
+    return page
+
+
+def archive_in_cold_storage(user_id: int, session_id: str) -> bool:
+    """True if the archive's object has moved to Glacier (by the bucket's lifecycle rule) and is not restored."""
+    object_key, _, _ = locate_archive(user_id, session_id)
+    head = get_s3_client().head_object(Bucket=ARCHIVE_BUCKET, Key=object_key)
+    return (head.get('StorageClass') in ('GLACIER', 'DEEP_ARCHIVE')
+            and 'ongoing-request="false"' not in head.get('Restore', ''))
+
+
+def restore_archived_session(user_id: int, session_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Make an archived session active again without copying its history.
+
+    Only the archive's page index is read, so the cost does not depend on how
+    many messages the archive holds.
+    """
+    index = get_archive_index(user_id, session_id)
+    if index is None:
+        return None
+    # The index sidecar is not under the lifecycle rule, but the archive may be
+    if archive_in_cold_storage(user_id, session_id):
+        raise ColdHistoryError(f"archive {session_id} is in Glacier")
+
+    tail = [dict(m, ts=int(float(m.get('ts', 0)))) for m in index.get('tail', [])]
+    cold_count = int(index['message_count']) - len(tail)
+    model_name = index.get('model_name', 'unknown')
+    sk = f"MODEL#{model_name}#SESSION#{session_id}"
+    item = {
+        'pk': user_id,
+        'sk': sk,
+        'model_name': model_name,
+        'session_id': session_id,
+        'is_active': 1,
+        'last_message_ts': int(tail[-1].get('ts', 0)) if tail else int(time.time()),
+        'conversation': tail,
+        'user_id': user_id,
+        's3_path': get_archive_s3_key(user_id, session_id),
+        'cold_count': cold_count,
+        'cold_extents': [{'kind': 'archive', 'session_id': session_id, 'count': cold_count}] if cold_count else [],
+        'restored_at': int(time.time()),
+    }
+    deactivate_other_sessions(user_id, sk)
+    db_put_item(item)
+    set_active_pointer(user_id, sk)
+    log_info("Restored session for user %s: %s (%d inline, %d cold)", user_id, sk, len(tail), cold_count)
+    return item
+
+
+def get_segment_s3_key(user_id: int, session_id: str, seq: int) -> str:
+    """Generate S3 key for a spilled segment: segments/{user_id}/{session_id}/{seq}.json.gz"""
+    return f"{SEGMENT_PREFIX}/{user_id}/{session_id}/{seq:06d}.json.gz"
+
+
+def content_bytes(messages: List[Dict[str, Any]]) -> int:
+    """UTF-8 size of the messages' content, which is what counts against the DynamoDB item limit."""
+    return sum(len(m.get('content', '').encode('utf-8')) for m in messages)
+
+
+def spill_cold_turns(session: Dict[str, Any]) -> List[str]:
+    """
+    Move the oldest inline turns of a session into an S3 segment.
+
+    Runs when the inline conversation passes INLINE_MAX_MESSAGES + SPILL_BATCH_MESSAGES
+    messages or INLINE_MAX_BYTES of content, and keeps the newest
+    INLINE_MAX_MESSAGES inline. The trailing segment extents are merged into the
+    new segment while the total stays within SEGMENT_MAX_MESSAGES. If a write or
+    read fails nothing is moved or merged.
+
+    Returns the keys of the segments that were merged away. The caller deletes
+    them once the session item pointing at the new segment is saved.
+    """
+    conversation = session['conversation']
+    if (len(conversation) <= INLINE_MAX_MESSAGES + SPILL_BATCH_MESSAGES
+            and content_bytes(conversation) <= INLINE_MAX_BYTES):
+        return []
+
+    keep = min(INLINE_MAX_MESSAGES, len(conversation) - 1)
+    while keep > 1 and content_bytes(conversation[-keep:]) > INLINE_MAX_BYTES // 2:
+        keep //= 2
+    spilled = conversation[:len(conversation) - keep]
+
+    user_id, session_id = session['pk'], session['session_id']
+    extents = session.setdefault('cold_extents', [])
+    merged = 0
+    while (merged < len(extents) and extents[-1 - merged]['kind'] == 'segment'
+           and sum(int(e['count']) for e in extents[len(extents) - 1 - merged:]) + len(spilled) <= SEGMENT_MAX_MESSAGES):
+        merged += 1
+    body = spilled
+    if merged:
+        try:
+            older = []
+            for extent in extents[len(extents) - merged:]:
+                older.extend(read_segment(user_id, session_id, int(extent['seq'])))
+            body = older + spilled
+        except ColdHistoryError as e:
+            log_warning("Not merging segments of %s: %s", session['sk'], e)
+            merged = 0
+
+    # A fresh seq, so neither a merged-away segment nor one still referenced is overwritten
+    seq = max((int(e['seq']) for e in extents if e['kind'] == 'segment'), default=-1) + 1
+    s3_key = get_segment_s3_key(user_id, session_id, seq)
+    try:
+        get_s3_client().put_object(
+            Bucket=ARCHIVE_BUCKET,
+            Key=s3_key,
+            Body=gzip.compress(json_dumps(body)),
+            ContentType='application/json',
+            ContentEncoding='gzip'
+        )
+    except Exception as e:
+        log_error("Error spilling segment to S3, keeping turns inline: %s", e)
+        return []
+
+    replaced = extents[len(extents) - merged:] if merged else []
+    del extents[len(extents) - merged:]
+    extents.append({'kind': 'segment', 'seq': seq, 'count': len(body)})
+    session['cold_count'] = int(session.get('cold_count', 0)) + len(spilled)
+    session['conversation'] = conversation[len(spilled):]
+    log_info("Spilled %d messages of %s to s3://%s/%s (%d segments merged)",
+             len(spilled), session['sk'], ARCHIVE_BUCKET, s3_key, len(replaced))
+    return [get_segment_s3_key(user_id, session_id, int(e['seq'])) for e in replaced]
+
+
+def read_segment(user_id: int, session_id: str, seq: int) -> List[Dict[str, Any]]:
+    """Fetch and decompress a spilled segment."""
+    s3_key = get_segment_s3_key(user_id, session_id, seq)
+    cache_key = (s3_key, '', 0)  # segments are written once and never change
+    pages = _active_bot.state.cold_page_cache
+    if cache_key in pages:
+        return pages[cache_key]
+
+    try:
+        response = get_s3_client().get_object(Bucket=ARCHIVE_BUCKET, Key=s3_key)
+        segment = json_loads(gzip.decompress(response['Body'].read()))
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        raise ColdHistoryError(f"reading segment {s3_key}: {e}") from e
+    log_debug("Hydrated segment %s (%d messages)", s3_key, len(segment))
+
+    if len(pages) >= COLD_PAGE_CACHE_SIZE:
+        pages.pop(next(iter(pages)))
+    pages[cache_key] = segment
+    return segment
+
+
+def delete_session_segments(user_id: int, session: Dict[str, Any]):
+    """Remove a session's spilled segments once its history lives in an archive."""
+    delete_segments([get_segment_s3_key(user_id, session['session_id'], int(extent['seq']))
+                     for extent in session.get('cold_extents', []) if extent['kind'] == 'segment'])
+
+
+def delete_segments(keys: List[str]):
+    """Delete segments that no session item references any more."""
+    for s3_key in keys:
+        try:
+            get_s3_client().delete_object(Bucket=ARCHIVE_BUCKET, Key=s3_key)
+            _active_bot.state.cold_page_cache.pop((s3_key, '', 0), None)
+        except Exception as e:
+            log_error("Error deleting segment %s: %s", s3_key, e)
+
+
+def session_message_count(session: Dict[str, Any]) -> int:
+    """Total messages in a session, including those not held inline."""
+    return int(session.get('cold_count', 0)) + len(session.get('conversation', []))
+
+
+def get_cold_messages(session: Dict[str, Any], start: int, end: int) -> List[Dict[str, Any]]:
+    """
+    Return cold messages [start, end) of a session, reading only the pages that overlap.
+
+    Raises ColdHistoryError if any of them cannot be read.
+    """
+    user_id = session['pk']
+    messages = []
+    base = 0
+    for extent in session.get('cold_extents', []):
+        count = int(extent['count'])
+        lo, hi = max(start, base), min(end, base + count)
+        if lo < hi and extent['kind'] == 'archive':
+            index = get_archive_index(user_id, extent['session_id'])
+            if not index:
+                raise ColdHistoryError(f"no page index for archive {extent['session_id']}")
+            page_size = int(index['page_size'])
+            for page_no in range((lo - base) // page_size, (hi - base - 1) // page_size + 1):
+                page = read_archive_page(user_id, extent['session_id'], page_no)
+                page_base = base + page_no * page_size
+                messages.extend(page[max(lo - page_base, 0):hi - page_base])
+        elif lo < hi and extent['kind'] == 'segment':
+            segment = read_segment(user_id, session['session_id'], int(extent['seq']))
+            messages.extend(segment[lo - base:hi - base])
+        base += count
+    return messages
+
+
+def get_conversation_window(session: Dict[str, Any], count: int) -> List[Dict[str, Any]]:
+    """Return the last `count` messages of a session, hydrating older pages if needed."""
+    conversation = session.get('conversation', [])
+    if count <= len(conversation):
+        return conversation[-count:] if count > 0 else []
+    cold_count = int(session.get('cold_count', 0))
+    needed = min(count - len(conversation), cold_count)
+    return get_cold_messages(session, cold_count - needed, cold_count) + conversation
+
+
+def get_full_conversation(session: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Materialize a session's entire history (used by archive and export paths); ColdHistoryError if it can't."""
+    return get_conversation_window(session, session_message_count(session))
+
+
+def build_chat_context(session: Dict[str, Any], max_messages: int = CONTEXT_MAX_MESSAGES) -> List[Dict[str, Any]]:
+    """Build the Ollama message list from the most recent turns of a session (inline turns only if S3 fails)."""
+    try:
+        window = get_conversation_window(session, max_messages)
+    except ColdHistoryError as e:
+        log_warning("Chat context without older turns: %s", e)
+        incr_metric('cold_read_errors')
+        window = session.get('conversation', [])[-max_messages:]
+    return [{'role': m['role'], 'content': m['content']} for m in window]
+
+
+# ==================== ARCHIVE BUNDLES ====================
+#
+# Compaction packs a user's loose archives into archives/{user_id}/bundles/*.bundle:
+#
+#   [archive 0 JSON][archive 1 JSON]...[index JSON][footer: index offset, index length, magic]
+#
+# The embedded index maps session_id -> offset/length, so each bundle is
+# self-describing. bundle-index/{user_id}/manifest.json merges the indexes of
+# all bundles so a lookup costs one cached GET; it can be rebuilt from the
+# bundle footers. It lives outside archives/ so the lifecycle rule leaves it
+# in STANDARD, and every write is a conditional put on the ETag that was read.
+# Archives that have not been packed keep their per-session key.
+
+
+def get_bundle_manifest_key(user_id: int) -> str:
+    """Generate S3 key for a user's bundle manifest: bundle-index/{user_id}/manifest.json"""
+    return f"{BUNDLE_MANIFEST_PREFIX}/{user_id}/manifest.json"
+
+
+def get_legacy_bundle_manifest_key(user_id: int) -> str:
+    """Where manifests were written before they moved out of archives/."""
+    return f"{ARCHIVE_PREFIX}/{user_id}/{BUNDLE_DIR}/manifest.json"
+
+
+def read_bundle_manifest(user_id: int) -> Tuple[Dict[str, Dict[str, Any]], Optional[str]]:
+    """
+    Fetch a user's manifest and its ETag.
+
+    The ETag is None when the manifest has not been written at its current key
+    yet; the content then comes from the legacy key, or is empty.
+    """
+    for key in (get_bundle_manifest_key(user_id), get_legacy_bundle_manifest_key(user_id)):
+        try:
+            response = get_s3_client().get_object(Bucket=ARCHIVE_BUCKET, Key=key)
+        except get_s3_client().exceptions.NoSuchKey:
+            continue
+        manifest = json_loads(response['Body'].read())
+        return manifest, response.get('ETag') if key == get_bundle_manifest_key(user_id) else None
+    return {}, None
+
+
+def load_bundle_manifest(user_id: int, refresh: bool = False) -> Dict[str, Dict[str, Any]]:
+    """Return {session_id: {'bundle', 'offset', 'length', 'last_modified'}} for packed archives."""
+    cache = _active_bot.state.bundle_manifest_cache
+    if not refresh and user_id in cache:
+        return cache[user_id]
+    manifest, _ = read_bundle_manifest(user_id)
+    cache[user_id] = manifest
+    return manifest
+
+
+def save_bundle_manifest(user_id: int, manifest: Dict[str, Dict[str, Any]], etag: Optional[str]):
+    """
+    Write the manifest only if it is still the version that was read (etag), or
+    still absent when etag is None. Raises PreconditionFailed otherwise.
+    """
+    condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+    get_s3_client().put_object(
+        Bucket=ARCHIVE_BUCKET,
+        Key=get_bundle_manifest_key(user_id),
+        Body=json_dumps(manifest),
+        ContentType='application/json',
+        **condition
+    )
+    _active_bot.state.bundle_manifest_cache[user_id] = manifest
+    if not etag:
+        try:
+            get_s3_client().delete_object(Bucket=ARCHIVE_BUCKET, Key=get_legacy_bundle_manifest_key(user_id))
+        except Exception as e:
+            log_warning("Could not remove legacy bundle manifest of user %s: %s", user_id, e)
+
+
+def update_bundle_manifest(user_id: int, change: Callable[[Dict[str, Dict[str, Any]]], Dict[str, Dict[str, Any]]]):
+    """
+    Read-modify-write the manifest with a conditional put.
+
+    `change` gets a copy of the stored manifest and returns the new one. If
+    another writer saved the manifest in between, it is read again and
+    `change` reapplied, up to BUNDLE_MANIFEST_RETRIES times.
+    """
+    for attempt in range(BUNDLE_MANIFEST_RETRIES):
+        manifest, etag = read_bundle_manifest(user_id)
+        updated = change(dict(manifest))
+        if updated == manifest:
+            _active_bot.state.bundle_manifest_cache[user_id] = manifest
+            return
+        try:
+            save_bundle_manifest(user_id, updated, etag)
+            return
+        except Exception as e:
+            if s3_error_code(e) not in ('PreconditionFailed', 'ConditionalRequestConflict') \
+                    or attempt == BUNDLE_MANIFEST_RETRIES - 1:
+                raise
+            log_debug("Bundle manifest of user %s changed underneath us, retrying", user_id)
+
+
+def drop_from_bundle_manifest(user_id: int, session_id: str):
+    """Forget a packed copy once a newer loose archive has been written for the session."""
+    try:
+        update_bundle_manifest(user_id, lambda manifest: {
+            sid: entry for sid, entry in manifest.items() if sid != session_id
+        })
+    except Exception as e:
+        log_error("Error updating bundle manifest: %s", e)
+
+
+def locate_archive(user_id: int, session_id: str, refresh: bool = False) -> Tuple[str, int, Optional[int]]:
+    """Return (object key, byte offset, length) of an archive; length is None for loose objects."""
+    try:
+        entry = load_bundle_manifest(user_id, refresh).get(session_id)
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        log_error("Error reading bundle manifest: %s", e)
+        entry = None
+    if entry:
+        return entry['bundle'], int(entry['offset']), int(entry['length'])
+    return get_archive_s3_key(user_id, session_id), 0, None
+
+
+def read_bundle_index(bundle_key: str) -> Dict[str, Dict[str, Any]]:
+    """Read the index embedded at the end of a bundle (two small range GETs)."""
+    footer = get_s3_client().get_object(
+        Bucket=ARCHIVE_BUCKET, Key=bundle_key, Range=f"bytes=-{BUNDLE_FOOTER.size}"
+    )['Body'].read()
+    index_offset, index_length, magic = BUNDLE_FOOTER.unpack(footer)
+    if magic != BUNDLE_MAGIC:
+        raise ValueError(f"{bundle_key} is not an archive bundle")
+    raw = get_s3_client().get_object(
+        Bucket=ARCHIVE_BUCKET, Key=bundle_key, Range=f"bytes={index_offset}-{index_offset + index_length - 1}"
+    )['Body'].read()
+    return json_loads(raw)
+
+
+def rebuild_bundle_manifest(user_id: int) -> Dict[str, Dict[str, Any]]:
+    """Recreate a user's manifest from the footers of their bundles."""
+    prefix = f"{ARCHIVE_PREFIX}/{user_id}/{BUNDLE_DIR}/"
+    manifest = {}
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=ARCHIVE_BUCKET, Prefix=prefix):
+        for obj in sorted(page.get('Contents', []), key=lambda o: o['Key']):
+            if obj['Key'].endswith('.bundle'):
+                for session_id, entry in read_bundle_index(obj['Key']).items():
+                    manifest[session_id] = dict(entry, bundle=obj['Key'])
+    return manifest
+
+
+def write_bundle(user_id: int, archives: List[Dict[str, Any]]) -> Tuple[str, Dict[str, Dict[str, Any]]]:
+    """
+    Pack the given loose archives into one new bundle object. Returns its key and index.
+
+    Sets each archive's 'etag' to that of the version that was packed.
+    """
+    parts = []
+    index = {}
+    offset = 0
+    for archive in archives:
+        response = get_s3_client().get_object(Bucket=ARCHIVE_BUCKET, Key=archive['s3_key'])
+        body = response['Body'].read()
+        archive['etag'] = response.get('ETag', '')
+        index[archive['session_id']] = {
+            'offset': offset,
+            'length': len(body),
+            'last_modified': archive.get('last_modified', '')
+        }
+        parts.append(body)
+        offset += len(body)
+
+    raw_index = json_dumps(index)
+    parts.append(raw_index)
+    parts.append(BUNDLE_FOOTER.pack(offset, len(raw_index), BUNDLE_MAGIC))
+
+    bundle_key = (f"{ARCHIVE_PREFIX}/{user_id}/{BUNDLE_DIR}/"
+                  f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}.bundle")
+    get_s3_client().put_object(
+        Bucket=ARCHIVE_BUCKET,
+        Key=bundle_key,
+        Body=b''.join(parts),
+        ContentType='application/octet-stream',
+        Metadata={'user_id': str(user_id), 'archive_count': str(len(index))}
+    )
+    return bundle_key, index
+
+
+def compact_user_archives(user_id: int) -> Dict[str, Any]:
+    """
+    Pack a user's loose archives into bundles once there are COMPACT_MIN_ARCHIVES of them.
+
+    Loose objects are only deleted after the bundle and the updated manifest
+    have both been written, so a failed run leaves every archive readable.
+    Each delete is conditional on the ETag that was packed: an archive
+    rewritten meanwhile keeps its loose key and loses its manifest entry, so
+    the newer copy is the one that is read.
+    """
+    loose = [a for a in list_user_archives(user_id) if 'bundle_key' not in a]
+    if len(loose) < COMPACT_MIN_ARCHIVES:
+        return {'user_id': user_id, 'packed': 0, 'bundles': 0}
+
+    try:
+        rebuilt = None if load_bundle_manifest(user_id, refresh=True) else rebuild_bundle_manifest(user_id)
+    except Exception as e:
+        log_error("Error loading bundle manifest for user %s: %s", user_id, e)
+        return {'user_id': user_id, 'packed': 0, 'bundles': 0, 'error': str(e)}
+
+    batches = [[]]
+    batch_bytes = 0
+    for archive in loose:
+        if batches[-1] and batch_bytes + archive['size'] > COMPACT_MAX_BUNDLE_BYTES:
+            batches.append([])
+            batch_bytes = 0
+        batches[-1].append(archive)
+        batch_bytes += archive['size']
+
+    packed = bundles = skipped = 0
+    for batch in batches:
+        try:
+            bundle_key, index = write_bundle(user_id, batch)
+
+            def add_bundle(manifest):
+                manifest = manifest or dict(rebuilt or {})
+                for session_id, entry in index.items():
+                    manifest[session_id] = dict(entry, bundle=bundle_key)
+                return manifest
+            update_bundle_manifest(user_id, add_bundle)
+        except Exception as e:
+            log_error("Error packing archives for user %s: %s", user_id, e)
+            break
+
+        rewritten = set()
+        for archive in batch:
+            try:
+                get_s3_client().delete_object(Bucket=ARCHIVE_BUCKET, Key=archive['s3_key'], IfMatch=archive['etag'])
+            except Exception as e:
+                if s3_error_code(e) not in ('PreconditionFailed', 'NoSuchKey'):
+                    log_error("Error deleting packed archive %s: %s", archive['s3_key'], e)
+                rewritten.add(archive['session_id'])
+        if rewritten:
+            # Keep whatever is at the loose key; the packed copy would shadow it in locate_archive
+            try:
+                update_bundle_manifest(user_id, lambda manifest: {
+                    sid: entry for sid, entry in manifest.items()
+                    if not (sid in rewritten and entry['bundle'] == bundle_key)
+                })
+            except Exception as e:
+                log_error("Error unlisting rewritten archives of user %s: %s", user_id, e)
+                break
+        packed += len(batch) - len(rewritten)
+        skipped += len(rewritten)
+        bundles += 1
+        log_info("Packed %d archives of user %s into s3://%s/%s (%d rewritten meanwhile)",
+                 len(batch) - len(rewritten), user_id, ARCHIVE_BUCKET, bundle_key, len(rewritten))
+
+    return {'user_id': user_id, 'packed': packed, 'bundles': bundles, 'skipped': skipped}
+
+
+def compact_archives(user_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Run compaction for one user, or for every user with archives."""
+    if user_id is not None:
+        return [compact_user_archives(int(user_id))]
+
+    results = []
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=ARCHIVE_BUCKET, Prefix=f"{ARCHIVE_PREFIX}/", Delimiter='/'):
+        for common in page.get('CommonPrefixes', []):
+            user = common['Prefix'].rstrip('/').split('/')[-1]
+            if user.lstrip('-').isdigit():  # not another bot's bot-<id>/ prefix
+                results.append(compact_user_archives(int(user)))
+    return results
+
+
+# ==================== ZIP EXPORT ====================
+#
+# /export all (and scripts/export_archives.py) stream a user's archives into
+# ZIP files. Archives are fetched and deflated EXPORT_WORKERS at a time, in
+# /listarchives order, and each one is appended to the current part as soon
+# as it is ready; only a few compressed archives are held at once. A part is
+# closed before the next archive would take it past EXPORT_PART_BYTES, so
+# each part is a complete ZIP that opens on its own:
+#
+#   [local header, name, deflated archive JSON] ... [central directory][end record]
+#
+# Sizes and CRCs are known before an entry is written, so parts are written
+# front to back without seeking, into memory for Telegram or to a file.
+# Parts stay under 4 GiB and 65535 entries, so ZIP64 is never needed.
+
+ZIP_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+ZIP_CENTRAL_HEADER = struct.Struct('<4s6H3L5H2L')
+ZIP_END_RECORD = struct.Struct('<4s4H2LH')
+ZIP_UTF8_NAMES = 0x0800
+ZIP_MAX_BYTES = 0xFFFFFFFF
+ZIP_MAX_ENTRIES = 0xFFFF
+
+
+class ZipEntry:
+    """One deflated file, ready to be appended to a ZipPart."""
+    __slots__ = ('name', 'data', 'crc', 'size', 'dos_time', 'dos_date')
+
+    def __init__(self, name: str, raw: bytes, modified: str = ''):
+        compressor = zlib.compressobj(EXPORT_ZIP_LEVEL, zlib.DEFLATED, -15)
+        self.name = name.encode('utf-8')
+        self.data = compressor.compress(raw) + compressor.flush()
+        self.crc = zlib.crc32(raw)
+        self.size = len(raw)
+        try:
+            when = datetime.fromisoformat(modified[:19])
+        except ValueError:
+            when = datetime.utcnow()
+        when = max(when, datetime(1980, 1, 1))
+        self.dos_time = when.hour << 11 | when.minute << 5 | when.second // 2
+        self.dos_date = (when.year - 1980) << 9 | when.month << 5 | when.day
+
+    @property
+    def footprint(self) -> int:
+        """Bytes the entry adds to a part: local header, data and central directory record."""
+        return ZIP_LOCAL_HEADER.size + ZIP_CENTRAL_HEADER.size + 2 * len(self.name) + len(self.data)
+
+
+class ZipPart:
+    """A ZIP file written front to back into `out`."""
+
+    def __init__(self, out):
+        self.out = out
+        self.offset = 0
+        self.central: List[bytes] = []
+        self.central_size = 0
+
+    @property
+    def count(self) -> int:
+        return len(self.central)
+
+    def size_with(self, entry: Optional[ZipEntry] = None) -> int:
+        """Size of the finished file if it were closed now, or after adding `entry`."""
+        return self.offset + self.central_size + ZIP_END_RECORD.size + (entry.footprint if entry else 0)
+
+    def add(self, entry: ZipEntry):
+        fields = (ZIP_UTF8_NAMES, zlib.DEFLATED, entry.dos_time, entry.dos_date, entry.crc, len(entry.data), entry.size)
+        self.out.write(ZIP_LOCAL_HEADER.pack(b'PK\x03\x04', 20, *fields, len(entry.name), 0))
+        self.out.write(entry.name)
+        self.out.write(entry.data)
+        record = ZIP_CENTRAL_HEADER.pack(b'PK\x01\x02', 20, 20, *fields, len(entry.name), 0, 0, 0, 0,
+                                         0o100644 << 16, self.offset) + entry.name
+        self.central.append(record)
+        self.central_size += len(record)
+        self.offset += ZIP_LOCAL_HEADER.size + len(entry.name) + len(entry.data)
+
+    def close(self) -> int:
+        """Write the central directory and end record. Returns the file size."""
+        self.out.write(b''.join(self.central))
+        self.out.write(ZIP_END_RECORD.pack(b'PK\x05\x06', 0, 0, self.count, self.count,
+                                           self.central_size, self.offset, 0))
+        return self.size_with()
+
+
+def export_entry_name(number: int, session_id: str) -> str:
+    """File name of an archive inside the export, numbered as in /listarchives."""
+    return f"archive_{number:03d}_{session_id[:8]}.json"
+
+
+def iter_export_entries(user_id: int, archives: List[Dict[str, Any]], start: int = 0,
+                        workers: int = EXPORT_WORKERS) -> Iterator[Tuple[int, Optional[ZipEntry]]]:
+    """
+    Yield (index, entry) for archives[start:] in order, fetching and deflating
+    up to `workers` ahead on a thread pool. entry is None if the fetch failed.
+    """
+    def fetch(index: int) -> Optional[ZipEntry]:
+        archive = archives[index]
+        body = get_archive_bytes(user_id, archive['session_id'])
+        if body is None:
+            return None
+        return ZipEntry(export_entry_name(index + 1, archive['session_id']), body, archive.get('last_modified', ''))
+
+    if start >= len(archives):
+        return
+    load_bundle_manifest(user_id)  # cached before the workers need it
+    from concurrent.futures import ThreadPoolExecutor
+    pool = ThreadPoolExecutor(max_workers=max(workers, 1))
+    pending = []
+    try:
+        indexes = iter(range(start, len(archives)))
+        for index in indexes:
+            pending.append((index, pool.submit(fetch, index)))
+            if len(pending) >= max(workers, 1) * 2:
+                break
+        while pending:
+            index, future = pending.pop(0)
+            try:
+                entry = future.result()
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                log_error("Error fetching archive %s for export: %s", archives[index]['session_id'], e)
+                entry = None
+            for following in indexes:
+                pending.append((following, pool.submit(fetch, following)))
+                break
+            yield index, entry
+    finally:
+        for _, future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
+
+
+def export_archives_zip(user_id: int, archives: List[Dict[str, Any]], new_part: Callable[[int], Any],
+                        finish_part: Callable[[int, Any, List[int]], bool], start: int = 0,
+                        part_bytes: int = EXPORT_PART_BYTES, workers: int = EXPORT_WORKERS,
+                        min_time_left: float = 0.0) -> Dict[str, Any]:
+    """
+    Stream archives[start:] into ZIP parts of at most `part_bytes`.
+
+    new_part(number) returns the writable for part `number` (from 1), and
+    finish_part(number, out, archive_numbers) is called once the part is
+    complete; returning False stops the export. The export also stops when
+    less than `min_time_left` seconds remain. `next` in the result is the
+    index to resume from, or None once every archive has been handled.
+    """
+    part_bytes = min(part_bytes, ZIP_MAX_BYTES)
+    result = {'parts': 0, 'exported': 0, 'failed': [], 'too_large': [], 'next': None}
+    part = None
+    numbers: List[int] = []
+
+    def finish() -> bool:
+        size = part.close()
+        log_info("Export part %d for user %s: %d archives, %d bytes", result['parts'] + 1, user_id, len(numbers), size)
+        if not finish_part(result['parts'] + 1, part.out, list(numbers)):
+            # Resume from the part's first archive; what it skipped will be reported again then
+            result['next'] = numbers[0] - 1
+            result['failed'] = [n for n in result['failed'] if n < numbers[0]]
+            result['too_large'] = [n for n in result['too_large'] if n < numbers[0]]
+            return False
+        result['parts'] += 1
+        result['exported'] += len(numbers)
+        incr_metric('export_parts')
+        return True
+
+    for index, entry in iter_export_entries(user_id, archives, start, workers):
+        if time_left() < min_time_left:
+            result['next'] = index
+            break
+        if entry is None:
+            result['failed'].append(index + 1)
+            continue
+        if ZIP_END_RECORD.size + entry.footprint > part_bytes:
+            result['too_large'].append(index + 1)
+            continue
+        if part is not None and (part.size_with(entry) > part_bytes or part.count >= ZIP_MAX_ENTRIES):
+            if not finish():
+                return result
+            part = None
+            numbers = []
+        if part is None:
+            part = ZipPart(new_part(result['parts'] + 1))
+        part.add(entry)
+        numbers.append(index + 1)
+
+    if part is not None:
+        finish()
+    return result
+
+
+def send_archive_zip(chat_id: int, user_id: int, start: int = 0) -> str:
+    """/export all: send every archive from number start + 1 on as ZIP documents."""
+    archives = list_user_archives(user_id)
+    if not archives:
+        send_message(chat_id, "No archived sessions to export. Use /archive first.")
+        return "no_archives_to_export"
+    if start >= len(archives):
+        send_message(chat_id, f"You have {len(archives)} archives. Use /export all to export them all.")
+        return "invalid_export_number"
+
+    stamp = datetime.utcnow().strftime('%Y%m%d')
+
+    def finish_part(number: int, out: io.BytesIO, numbers: List[int]) -> bool:
+        caption = f"Archives {numbers[0]}-{numbers[-1]} of {len(archives)}"
+        # A view, not a copy: the upload body is the only other copy of the part held in memory
+        result = send_document(chat_id, out.getbuffer(), f"archives_{stamp}_part{number}.zip", caption, 'application/zip')
+        return bool(result and result.get('ok'))
+
+    result = export_archives_zip(user_id, archives, lambda number: io.BytesIO(), finish_part, start,
+                                 min_time_left=(UPDATE_MIN_BUDGET_MS + DEADLINE_RESERVE_MS) / 1000.0)
+    archives_plural = "s" if result['exported'] != 1 else ""
+    parts_plural = "s" if result['parts'] != 1 else ""
+    msg = f"Exported {result['exported']} archive{archives_plural} in {result['parts']} ZIP file{parts_plural}."
+    if result['failed']:
+        msg += f"\nCould not read archives {', '.join(map(str, result['failed']))}."
+    if result['too_large']:
+        many = len(result['too_large']) != 1
+        msg += (f"\nArchive{'s' if many else ''} {', '.join(map(str, result['too_large']))} "
+                f"{'are' if many else 'is'} too large to send through Telegram. The bot's operator "
+                f"can export {'them' if many else 'it'} with scripts/export_archives.py.")
+    if result['next'] is not None:
+        msg += f"\nStopped before archive {result['next'] + 1}. Send /export all {result['next'] + 1} for the rest."
+    send_message(chat_id, msg)
+    if not result['parts']:
+        return "export_send_error"
+    return "exported_all" if result['next'] is None else "exported_partial"
+
+
+# ==================== ARCHIVE IMPORT PARSING ====================
+
+class ArchiveImportError(Exception):
+    """An uploaded archive was rejected. `reason` is the handler result code."""
+
+    def __init__(self, reason: str, user_message: str):
+        super().__init__(user_message)
+        self.reason = reason
+        self.user_message = user_message
+
+    @classmethod
+    def too_large(cls, max_bytes: int) -> "ArchiveImportError":
+        return cls("file_too_large", f"File too large to import. The limit is {max_bytes // 1024}KB.")
+
+
+_JSON_WS = re.compile(r'[ \t\n\r]*')
+
+
+class ArchiveStreamParser:
+    """
+    Incremental parser for the archive export format.
+
+    Chunks are fed as they are downloaded. Top-level fields are decoded one at a
+    time and `conversation` entries are validated as soon as each one is complete,
+    so at most one entry (capped at IMPORT_MAX_ENTRY_BYTES) is ever buffered.
+    """
+
+    def __init__(self, max_bytes: int = IMPORT_MAX_BYTES, max_messages: int = IMPORT_MAX_MESSAGES,
+                 max_entry_bytes: int = IMPORT_MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.max_entry_bytes = max_entry_bytes
+        self.bytes_read = 0
+        self.fields: Dict[str, Any] = {}
+        self.conversation: List[Dict[str, Any]] = []
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._state = 'start'
+        self._key = ''
+        self._eof = False
+
+    def feed(self, chunk: bytes):
+        self.bytes_read += len(chunk)
+        if self.bytes_read > self.max_bytes:
+            raise ArchiveImportError.too_large(self.max_bytes)
+        try:
+            self._buf = self._buf[self._pos:] + self._utf8.decode(chunk)
+        except UnicodeDecodeError:
+            raise self._invalid("file is not UTF-8 text")
+        self._pos = 0
+        self._run()
+
+    def close(self) -> Dict[str, Any]:
+        """Finish parsing and return the archive dict."""
+        self._eof = True
+        self._run()
+        if self._state != 'done':
+            raise self._invalid("unexpected end of file")
+        if 'conversation' not in self.fields:
+            raise ArchiveImportError(
+                "invalid_archive_format",
+                "Invalid archive format. Missing 'conversation' field.\nUse /export to get a valid archive format."
+            )
+        archive = dict(self.fields)
+        archive['conversation'] = self.conversation
+        return archive
+
+    def _invalid(self, detail: str) -> ArchiveImportError:
+        return ArchiveImportError(
+            "json_parse_error",
+            f"Invalid JSON file. Please send a valid archive export.\nError: {detail[:100]}"
+        )
+
+    def _skip_ws(self) -> Optional[str]:
+        self._pos = _JSON_WS.match(self._buf, self._pos).end()
+        return self._buf[self._pos] if self._pos < len(self._buf) else None
+
+    def _value(self, delimiters: str):
+        """Decode the value at the cursor, or return a sentinel if more input is needed.
+
+        A value only counts as complete once the following delimiter is visible,
+        otherwise a number split across two chunks would be cut short.
+        """
+        try:
+            value, end = self._decoder.raw_decode(self._buf, self._pos)
+        except json.JSONDecodeError as e:
+            if self._eof:
+                raise self._invalid(str(e))
+            return self._need_more()
+        nxt = _JSON_WS.match(self._buf, end).end()
+        if nxt >= len(self._buf) or self._buf[nxt] not in delimiters:
+            if self._eof:
+                raise self._invalid(f"expected one of {delimiters!r} after a value")
+            return self._need_more()
+        self._pos = nxt
+        return value
+
+    def _need_more(self):
+        if len(self._buf) - self._pos > self.max_entry_bytes:
+            raise ArchiveImportError(
+                "entry_too_large",
+                f"An archive entry is larger than {self.max_entry_bytes // 1024}KB or malformed."
             )
-    table.put_item(Item=item)
-    print(f"Created new session for user {user_id}: {sk}")
-    return item
+        return _NEED_MORE
 
+    def _add_message(self, msg: Any):
+        if not isinstance(msg, dict):
+            raise ArchiveImportError("invalid_archive_format", "Invalid archive format. Messages must be objects.")
+        role, content, ts = msg.get('role'), msg.get('content'), msg.get('ts', 0)
+        if isinstance(ts, str):
+            # /export before the JSON codec wrote DynamoDB Decimals with json.dumps(default=str), i.e. as strings
+            try:
+                ts = float(ts)
+            except ValueError:
+                pass
+        if role not in IMPORT_ROLES or not isinstance(content, str):
+            raise ArchiveImportError(
+                "invalid_archive_format",
+                f"Invalid archive format. Message {len(self.conversation) + 1} needs a role "
+                f"({'/'.join(IMPORT_ROLES)}) and text content."
+            )
+        if isinstance(ts, bool) or not isinstance(ts, (int, float)) or not math.isfinite(ts):
+            raise ArchiveImportError(
+                "invalid_archive_format",
+                f"Invalid archive format. Message {len(self.conversation) + 1} has a non-numeric timestamp."
+            )
+        if len(self.conversation) >= self.max_messages:
+            raise ArchiveImportError(
+                "too_many_messages",
+                f"Archive has too many messages. The limit is {self.max_messages}."
+            )
+        self.conversation.append({'role': role, 'content': content, 'ts': int(ts)})
 
-def get_current_session(user_id: int) -> Dict[str, Any]:
-    """Get active session or create one if none exists."""
-    session = get_active_session(user_id)
-    if not session:
-        print(f"No active session, creating new for user {user_id}")
-        session = create_session(user_id)
-    else:
-        print(f"Using existing active session for user {user_id}")
-    return session
+    def _expect(self, char: str, expected: str):
+        if char not in expected:
+            raise self._invalid(f"expected one of {expected!r}, got {char!r}")
+        self._pos += 1
 
+    def _run(self):
+        while True:
+            char = self._skip_ws()
+            if char is None:
+                return
+            state = self._state
+            if state == 'start':
+                self._expect(char, '{')
+                self._state = 'first_key'
+            elif state in ('first_key', 'key'):
+                if state == 'first_key' and char == '}':
+                    self._pos += 1
+                    self._state = 'done'
+                    continue
+                if char != '"':
+                    raise self._invalid(f"expected a field name, got {char!r}")
+                key = self._value(':')
+                if key is _NEED_MORE:
+                    return
+                self._key = key
+                self._pos += 1
+                self._state = 'value'
+            elif state == 'value':
+                if self._key == 'conversation':
+                    if char != '[':
+                        raise ArchiveImportError(
+                            "invalid_archive_format",
+                            "Invalid archive format. 'conversation' must be a list."
+                        )
+                    self._pos += 1
+                    self.fields['conversation'] = True
+                    self._state = 'first_message'
+                    continue
+                value = self._value(',}')
+                if value is _NEED_MORE:
+                    return
+                if not isinstance(value, (dict, list)):
+                    self.fields[self._key] = value
+                self._state = 'after_value'
+            elif state == 'after_value':
+                self._expect(char, ',}')
+                self._state = 'key' if char == ',' else 'done'
+            elif state in ('first_message', 'message'):
+                if state == 'first_message' and char == ']':
+                    self._pos += 1
+                    self._state = 'after_value'
+                    continue
+                msg = self._value(',]')
+                if msg is _NEED_MORE:
+                    return
+                self._add_message(msg)
+                self._state = 'after_message'
+            elif state == 'after_message':
+                self._expect(char, ',]')
+                self._state = 'message' if char == ',' else 'after_value'
+            else:
+                raise self._invalid("unexpected data after the archive object")
 
-def append_to_conversation(session: Dict[str, Any], message_dict: Dict[str, Any]):
-    """Append a message to the session's conversation and update timestamp."""
-    session['conversation'].append(message_dict)
-    session['last_message_ts'] = int(time.time())
-    table.put_item(Item=session)
-    print(f"Appended message to session {session['sk']}, conversation length: {len(session['conversation'])}")
 
+_NEED_MORE = object()
 
-def call_ollama(model: str, messages: List[Dict[str, Any]]) -> str:
-    """Call Ollama API for chat completion."""
-    if not OLLAMA_URL:
-        print("OLLAMA_URL not configured.")
-        return "Ollama URL not configured. Set OLLAMA_URL env var."
-    print(f"Calling Ollama at {OLLAMA_URL} with model '{model}' (context length: {len(messages)})")
-    payload = {
-        "model": model,
-        "messages": messages,
-        "stream": False
-    }
-    try:
-        resp = requests.post(f"{OLLAMA_URL}/api/chat", json=payload, timeout=60)
-        if resp.status_code == 200:
-            data = resp.json()
-            response_content = data['message']['content']
-            print(f"Ollama success: Response length {len(response_content)} chars")
-            return response_content
-        else:
-            print(f"Ollama API error: {resp.status_code} - {resp.text}")
-            return f"Sorry, AI response unavailable (error {resp.status_code}). Use /status to check connection."
-    except Exception as e:
-        print(f"Ollama call error: {e}")
-        return f"Sorry, AI response unavailable (connection error). Use /status to check connection."
 
+def parse_archive_stream(chunks) -> Dict[str, Any]:
+    """Parse an archive from an iterable of byte chunks, enforcing the import caps."""
+    parser = ArchiveStreamParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()
 
-# ==================== ARCHIVE FUNCTIONS ====================
 
-def get_archive_s3_key(user_id: int, session_id: str) -> str:
-    """Generate S3 key for archived session: archives/{user_id}/{session_id}.json"""
-    return f"{ARCHIVE_PREFIX}/{user_id}/{session_id}.json"
+# ==================== USAGE COUNTERS ====================
+#
+# Aggregate numbers come from counters updated as things happen, never from
+# scanning the table. Code paths queue increments with count_usage() and
+# flush_usage() writes them at the end of the invocation (of each update in
+# server.py), one ADD per item, so a polling batch shares its bot-wide writes:
+#
+# - pk=user, sk=USAGE: the user's totals, per-model totals, first and last active day
+# - pk=-(shard+1), sk=USAGE#DAY#<yyyy-mm-dd>: bot-wide totals and active users for the day
+# - pk=-(shard+1), sk=USAGE#TOTAL: bot-wide totals and user count since counting began
+#
+# Bot-wide writes go to a random one of USAGE_SHARDS partitions, so no item
+# takes every write; readers add the shards up. A day or the total costs
+# USAGE_SHARDS items in one BatchGetItem, however many users there are.
+# Counters are best-effort: a failed write is logged and dropped.
 
+USAGE_EVENTS = ('messages', 'sessions', 'archives', 'imports', 'imported_messages')
 
-def archive_session_to_s3(user_id: int, session: Dict[str, Any]) -> Optional[str]:
-    """Archive a session from DynamoDB to S3."""
-    session_id = session.get('session_id', '')
-    if not session_id:
-        print(f"Session missing session_id: {session}")
-        return None
 
-    archive_data = {
-        'user_id': user_id,
-        'session_id': session_id,
-        'model_name': session.get('model_name', 'unknown'),
-        'conversation': session.get('conversation', []),
-        'original_sk': session.get('sk', ''),
-        'last_message_ts': session.get('last_message_ts', 0),
-        'archived_at': datetime.utcnow().isoformat() + 'Z',
-        'archive_version': '1.0'
-    }
+def count_usage(user_id: int, event: str, model: Optional[str] = None, count: int = 1):
+    """Queue an increment of `event` for the user (and model); written by flush_usage."""
+    pending = getattr(_trace, 'usage', None)
+    if pending is None:
+        pending = _trace.usage = {}
+    key = (user_id, event, model)
+    pending[key] = pending.get(key, 0) + count
 
-    s3_key = get_archive_s3_key(user_id, session_id)
 
-    try:
-        s3_client.put_object(
-            Bucket=ARCHIVE_BUCKET,
-            Key=s3_key,
-            Body=json.dumps(archive_data, indent=2, default=str),
-            ContentType='application/json',
-            Metadata={
-                'user_id': str(user_id),
-                'session_id': session_id,
-                'model_name': session.get('model_name', 'unknown')
-            }
-        )
-        print(f"Archived session to S3: s3://{ARCHIVE_BUCKET}/{s3_key}")
-        return s3_key
-    except Exception as e:
-        print(f"Error archiving to S3: {e}")
-        return None
+def usage_day_sk(day: str) -> str:
+    return f"{USAGE_SK}#DAY#{day}"
 
 
-def delete_session_from_dynamodb(user_id: int, sk: str) -> bool:
-    """Delete a session from DynamoDB after archiving."""
-    try:
-        table.delete_item(Key={'pk': user_id, 'sk': sk})
-        print(f"Deleted session from DynamoDB: pk={user_id}, sk={sk}")
-        return True
-    except Exception as e:
-        print(f"Error deleting session from DynamoDB: {e}")
-        return False
+def _add_counters(key: Dict[str, Any], deltas: Dict[str, int], set_clause: str = '',
+                  set_values: Optional[Dict[str, Any]] = None, return_old: bool = False) -> Dict[str, Any]:
+    """ADD every delta to one item (plus an optional SET clause) in a single UpdateItem."""
+    names = {f"#c{i}": name for i, name in enumerate(deltas)}
+    values = {f":c{i}": delta for i, delta in enumerate(deltas.values())}
+    expression = 'ADD ' + ', '.join(f"#c{i} :c{i}" for i in range(len(deltas)))
+    if set_clause:
+        expression += ' SET ' + set_clause
+        values.update(set_values or {})
+        names.update({f"#{n}": n for n in ('first_day', 'last_day') if f"#{n}" in set_clause})
+    response = get_dynamodb_client().update_item(
+        TableName=TABLE_NAME,
+        Key=to_dynamo(key),
+        UpdateExpression=expression,
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=to_dynamo(values),
+        ReturnValues='ALL_OLD' if return_old else 'NONE'
+    )
+    return from_dynamo(response['Attributes']) if response.get('Attributes') else {}
 
 
-def list_user_archives(user_id: int) -> List[Dict[str, Any]]:
-    """List all archived sessions for a user from S3."""
-    prefix = f"{ARCHIVE_PREFIX}/{user_id}/"
-    archives = []
+def flush_usage():
+    """Write the queued increments: one UpdateItem per user plus two bot-wide."""
+    pending = getattr(_trace, 'usage', None)
+    if not pending:
+        return
+    _trace.usage = {}
+    if not USAGE_ENABLED:
+        return
+    import random
+    today = time.strftime('%Y-%m-%d', time.gmtime())
+    per_user: Dict[int, Dict[str, int]] = {}
+    for (user_id, event, model), count in pending.items():
+        deltas = per_user.setdefault(user_id, {})
+        deltas[event] = deltas.get(event, 0) + count
+        if model:
+            deltas[f"{event}#{model}"] = deltas.get(f"{event}#{model}", 0) + count
 
-    try:
-        paginator = s3_client.get_paginator('list_objects_v2')
-        for page in paginator.paginate(Bucket=ARCHIVE_BUCKET, Prefix=prefix):
-            for obj in page.get('Contents', []):
-                key = obj['Key']
-                session_id = key.split('/')[-1].replace('.json', '')
-                archives.append({
-                    'session_id': session_id,
-                    's3_key': key,
-                    'size': obj['Size'],
-                    'last_modified': obj['LastModified'].isoformat() if obj.get('LastModified') else ''
-                })
-        print(f"Found {len(archives)} archives for user {user_id}")
-    except Exception as e:
-        print(f"Error listing archives: {e}")
+    bot_wide: Dict[str, int] = {}
+    active = new_users = 0
+    for user_id, deltas in per_user.items():
+        for name, count in deltas.items():
+            bot_wide[name] = bot_wide.get(name, 0) + count
+        try:
+            old = _add_counters({'pk': user_id, 'sk': USAGE_SK}, deltas,
+                                '#last_day = :today, #first_day = if_not_exists(#first_day, :today)',
+                                {':today': today}, return_old=True)
+        except Exception as e:
+            log_warning("Usage counters for user %s not written: %s", user_id, e)
+            continue
+        if old.get('last_day') != today:
+            active += 1
+        if not old.get('last_day'):
+            new_users += 1
 
-    return archives
+    shard = USAGE_PK - random.randrange(max(USAGE_SHARDS, 1))
+    for sk, extra in ((usage_day_sk(today), {'active_users': active}), (f"{USAGE_SK}#TOTAL", {'users': new_users})):
+        deltas = {name: count for name, count in dict(bot_wide, **extra).items() if count}
+        try:
+            _add_counters({'pk': shard, 'sk': sk}, deltas)
+        except Exception as e:
+            log_warning("Usage counters %s not written: %s", sk, e)
 
 
-def get_archive_from_s3(user_id: int, session_id: str) -> Optional[Dict[str, Any]]:
-    """Retrieve an archived session from S3."""
-    s3_key = get_archive_s3_key(user_id, session_id)
+def read_usage(sks: List[str]) -> Dict[str, Dict[str, int]]:
+    """Add up the shards of bot-wide counter items: {sk: {counter: value}}."""
+    keys = [{'pk': USAGE_PK - shard, 'sk': sk} for sk in sks for shard in range(max(USAGE_SHARDS, 1))]
+    totals: Dict[str, Dict[str, int]] = {sk: {} for sk in sks}
+    for (_, sk), av in db_batch_get(keys).items():
+        counters = totals[sk]
+        for name, value in from_dynamo(av).items():
+            if name not in ('pk', 'sk'):
+                counters[name] = counters.get(name, 0) + int(value)
+    return totals
 
-    try:
-        response = s3_client.get_object(Bucket=ARCHIVE_BUCKET, Key=s3_key)
-        content = response['Body'].read().decode('utf-8')
-        return json.loads(content)
-    except s3_client.exceptions.NoSuchKey:
-        print(f"Archive not found: {s3_key}")
-        return None
-    except Exception as e:
-        print(f"Error retrieving archive: {e}")
-        return None
 
+def usage_report(days: int = 1) -> Dict[str, Any]:
+    """Bot-wide totals plus the last `days` days (UTC), newest first."""
+    days = max(1, min(days, USAGE_MAX_DAYS))
+    now = time.time()
+    dates = [time.strftime('%Y-%m-%d', time.gmtime(now - 86400 * i)) for i in range(days)]
+    found = read_usage([f"{USAGE_SK}#TOTAL"] + [usage_day_sk(d) for d in dates])
+    return {'total': found[f"{USAGE_SK}#TOTAL"], 'days': {d: found[usage_day_sk(d)] for d in dates}}
 
-def import_archive_to_s3(user_id: int, archive_data: Dict[str, Any]) -> Optional[str]:
-    """Import an archive file to S3 for a user."""
-    new_session_id = str(uuid.uuid4())
 
-    imported_data = {
-        'user_id': user_id,
-        'session_id': new_session_id,
-        'model_name': archive_data.get('model_name', 'imported'),
-        'conversation': archive_data.get('conversation', []),
-        'original_session_id': archive_data.get('session_id', 'unknown'),
-        'original_user_id': archive_data.get('user_id', 'unknown'),
-        'last_message_ts': archive_data.get('last_message_ts', 0),
-        'archived_at': archive_data.get('archived_at', datetime.utcnow().isoformat() + 'Z'),
-        'imported_at': datetime.utcnow().isoformat() + 'Z',
-        'archive_version': '1.0'
-    }
+def format_models(counters: Dict[str, Any], event: str = 'messages') -> str:
+    """Per-model counts of one event, largest first: 'llama3 120, mistral 8'."""
+    prefix = f"{event}#"
+    models = [(name[len(prefix):], value) for name, value in counters.items() if name.startswith(prefix)]
+    return ", ".join(f"{model} {value}" for model, value in sorted(models, key=lambda mv: -mv[1]))
 
-    s3_key = get_archive_s3_key(user_id, new_session_id)
 
-    try:
-        s3_client.put_object(
-            Bucket=ARCHIVE_BUCKET,
-            Key=s3_key,
-            Body=json.dumps(imported_data, indent=2, default=str),
-            ContentType='application/json',
-            Metadata={
-                'user_id': str(user_id),
-                'session_id': new_session_id,
-                'imported': 'true'
-            }
-        )
-        print(f"Imported archive to S3: s3://{ARCHIVE_BUCKET}/{s3_key}")
-        return new_session_id
-    except Exception as e:
-        print(f"Error importing archive to S3: {e}")
-        return None
+def format_usage(counters: Dict[str, Any]) -> str:
+    parts = [f"{counters.get('messages', 0)} messages", f"{counters.get('sessions', 0)} sessions",
+             f"{counters.get('archives', 0)} archives"]
+    if counters.get('imports'):
+        parts.append(f"{counters['imports']} imports ({counters.get('imported_messages', 0)} messages)")
+    return ", ".join(parts)
+
+
+def export_usage_metrics(days: int = 1) -> Dict[str, Any]:
+    """
+    Maintenance action: read the bot-wide counters and add today's and the
+    all-time values to this invocation's metrics record, for dashboards.
+    """
+    set_trace_command('usage_stats')
+    report = usage_report(days)
+    today = next(iter(report['days'].values()))
+    for event in USAGE_EVENTS + ('users',):
+        incr_metric(f"usage_total_{event}", int(report['total'].get(event, 0)))
+    for event in USAGE_EVENTS + ('active_users',):
+        incr_metric(f"usage_today_{event}", int(today.get(event, 0)))
+    return report
 
 
 # ==================== COMMAND HANDLERS ====================
 
 def handle_command(cmd: str, payload: str, chat_id: int, user_id: int, update_id: int) -> str:
     """Handle bot commands."""
-    print(f"Handling command '{cmd}' for user {user_id} in chat {chat_id}")
+    log_debug("Handling command '%s' for user %s in chat %s", cmd, user_id, chat_id)
 
     if cmd == "/start" or cmd == "/hello":
         session = get_current_session(user_id)
@@ -373,15 +4439,19 @@ def handle_command(cmd: str, payload: str, chat_id: int, user_id: int, update_id
 /newsession - Start a new chat session
 /listsessions - List your sessions
 /switch <number> - Switch to a session (e.g., /switch 1)
-/history - Show recent messages in current session
+/history [count] - Show recent messages in current session
 /status - Check system status (Ollama integration coming soon)
 /echo <text> - Echo back text
+/stats [days] - Your usage (admins also see bot-wide totals)
 
 Archive Commands:
 /archive - List sessions to archive
 /archive <number> - Archive a specific session to S3
 /listarchives - List your archived sessions
 /export <number> - Export an archive as a file
+/export all - Export every archive as ZIP files
+/restore <number> - Make an archived session active again
+/search <terms> - Find messages in your sessions and archives
 (Send a JSON file to import an archive)
 
 Note: AI chat is not yet implemented."""
@@ -389,10 +4459,34 @@ Note: AI chat is not yet implemented."""
         return "help"
 
     if cmd == "/status":
-        resp_msg = "🟢 Bot is running on AWS!\nOllama AI integration not yet implemented. Stay tuned!"
+        if OLLAMA_ENABLED:
+            resp_msg = "🟢 Bot is running on AWS!\nModel targets:\n" + "\n".join(model_status_lines())
+        else:
+            resp_msg = "🟢 Bot is running on AWS!\nOllama AI integration is disabled (set OLLAMA_ENABLED)."
         send_message(chat_id, resp_msg)
         return "status"
 
+    if cmd == "/stats":
+        usage = db_get_item({'pk': user_id, 'sk': USAGE_SK}) or {}
+        msg = f"Your usage: {format_usage(usage)}."
+        if format_models(usage):
+            msg += f"\nBy model: {format_models(usage)}"
+        if usage.get('first_day'):
+            msg += f"\nActive since {usage['first_day']}, last on {usage['last_day']}."
+        if user_id in ADMIN_USER_IDS:
+            days = int(payload) if payload.strip().isdigit() else 7
+            report = usage_report(days)
+            total = report['total']
+            msg += f"\n\nBot-wide: {total.get('users', 0)} users, {format_usage(total)}."
+            if format_models(total):
+                msg += f"\nBy model: {format_models(total)}"
+            msg += "\n\nLast days (UTC):"
+            for day, counters in report['days'].items():
+                msg += (f"\n{day}: {counters.get('active_users', 0)} active users, "
+                        f"{counters.get('messages', 0)} messages, {counters.get('sessions', 0)} new sessions")
+        send_message(chat_id, msg)
+        return "stats"
+
     if cmd == "/newsession":
         new_session = create_session(user_id)
         resp = f"New session created with model '{new_session['model_name']}' (ID: {new_session['session_id'][:8]})."
@@ -410,8 +4504,8 @@ Note: AI chat is not yet implemented."""
             active = " (active)" if session.get('is_active', 0) == 1 else ""
             model = session['model_name']
             sid = session['session_id'][:8]
-            ts_str = time.strftime('%Y-%m-%d %H:%M', time.localtime(session.get('last_message_ts', 0)))
-            msg_count = len(session.get('conversation', []))
+            ts_str = time.strftime('%Y-%m-%d %H:%M', time.localtime(int(session.get('last_message_ts', 0))))
+            msg_count = session_message_count(session)
             msg += f"{i+1}. {model} ({sid}){active} - {msg_count} msgs - Last: {ts_str}\n"
         send_message(chat_id, msg)
         return "listsessions"
@@ -425,11 +4519,8 @@ Note: AI chat is not yet implemented."""
                 target_sk = sessions[idx]['sk']
                 for session in sessions:
                     val = 1 if session['sk'] == target_sk else 0
-                    table.update_item(
-                        Key={'pk': user_id, 'sk': session['sk']},
-                        UpdateExpression='SET is_active = :val',
-                        ExpressionAttributeValues={':val': val}
-                    )
+                    db_update_item({'pk': user_id, 'sk': session['sk']}, 'SET is_active = :val', {':val': val})
+                set_active_pointer(user_id, target_sk)
                 model = sessions[idx]['model_name']
                 resp = f"Switched to session {idx+1} (model: {model})."
                 send_message(chat_id, resp)
@@ -442,27 +4533,38 @@ Note: AI chat is not yet implemented."""
             return "invalid_switch"
 
     if cmd == "/history":
+        try:
+            count = min(max(int(payload.strip()), 1), 50) if payload.strip() else 5
+        except ValueError:
+            send_message(chat_id, "Usage: /history [count] (e.g., /history 20)")
+            return "invalid_history"
         session = get_current_session(user_id)
         conversation = session.get('conversation', [])
         if isinstance(conversation, str):
             try:
-                conversation = json.loads(conversation)
+                session['conversation'] = json.loads(conversation)
             except:
-                conversation = []
+                session['conversation'] = []
 
-        conv = conversation[-5:] if conversation else []
+        note = ""
+        try:
+            conv = get_conversation_window(session, count)
+        except ColdHistoryError as e:
+            log_warning("History without older turns: %s", e)
+            conv = session.get('conversation', [])[-count:]
+            note = "\n(Older messages could not be loaded right now.)"
         if not conv:
-            send_message(chat_id, "No messages in this session yet.")
+            send_message(chat_id, "No messages in this session yet." + note)
             return "no_history"
         msg = "Recent conversation:\n"
         for m in conv:
             role = m.get('role', 'unknown').capitalize()
             content = m.get('content', '')
             content = (content[:100] + "...") if len(content) > 100 else content
-            ts = m.get('ts', int(time.time()))
+            ts = int(m.get('ts', time.time()))
             ts_str = time.strftime('%H:%M', time.localtime(ts))
             msg += f"{role} ({ts_str}): {content}\n"
-        send_message(chat_id, msg)
+        send_message(chat_id, msg + note)
         return "history"
 
     if cmd == "/echo":
@@ -486,8 +4588,8 @@ Note: AI chat is not yet implemented."""
                 active = " (active)" if session.get('is_active', 0) == 1 else ""
                 model = session['model_name']
                 sid = session['session_id'][:8]
-                msg_count = len(session.get('conversation', []))
-                ts_str = time.strftime('%Y-%m-%d %H:%M', time.localtime(session.get('last_message_ts', 0)))
+                msg_count = session_message_count(session)
+                ts_str = time.strftime('%Y-%m-%d %H:%M', time.localtime(int(session.get('last_message_ts', 0))))
                 msg += f"{i+1}. {model} ({sid}){active} - {msg_count} msgs - {ts_str}\n"
             msg += "\nUse /archive <number> to archive a session (e.g., /archive 1)"
             send_message(chat_id, msg)
@@ -505,7 +4607,8 @@ Note: AI chat is not yet implemented."""
                     return "archive_s3_error"
 
                 if delete_session_from_dynamodb(user_id, session['sk']):
-                    msg_count = len(session.get('conversation', []))
+                    delete_session_segments(user_id, session)
+                    msg_count = session_message_count(session)
                     resp = f"Session archived successfully!\n"
                     resp += f"- Model: {session['model_name']}\n"
                     resp += f"- Messages: {msg_count}\n"
@@ -540,11 +4643,41 @@ Note: AI chat is not yet implemented."""
         send_message(chat_id, msg)
         return "listarchives"
 
+    if cmd == "/search":
+        if not payload.strip():
+            send_message(chat_id, "Usage: /search <terms> (e.g., /search dog name)")
+            return "search_no_terms"
+        hits = search_messages(user_id, payload)
+        if not hits:
+            send_message(chat_id, f"No messages found for \"{payload.strip()}\".")
+            return "search_no_results"
+
+        archive_numbers = {a['session_id']: i + 1 for i, a in enumerate(list_user_archives(user_id))}
+        msg = f"Results for \"{payload.strip()}\":\n"
+        for i, hit in enumerate(hits):
+            number = archive_numbers.get(hit['session_id'])
+            where = f"Archive #{number}" if number else f"Session {hit['session_id'][:8]}"
+            day = datetime.utcfromtimestamp(int(hit['ts'])).strftime('%Y-%m-%d') if hit['ts'] else 'N/A'
+            plural = "es" if hit['matches'] != 1 else ""
+            msg += f"{i+1}. {where} ({day}) - {hit['matches']} match{plural}\n   \"{hit['snippet']}\"\n"
+        msg += "\nUse /restore <number> to reopen an archive."
+        send_message(chat_id, msg)
+        return "search"
+
     if cmd == "/export":
         if not payload.strip():
-            send_message(chat_id, "Usage: /export <number> (e.g., /export 1)\nUse /listarchives to see available archives.")
+            send_message(chat_id, "Usage: /export <number> (e.g., /export 1) or /export all\nUse /listarchives to see available archives.")
             return "export_no_number"
 
+        args = payload.split()
+        if args[0].lower() == "all":
+            try:
+                start = int(args[1]) - 1 if len(args) > 1 else 0
+            except ValueError:
+                send_message(chat_id, "Usage: /export all [from number] (e.g., /export all 20)")
+                return "invalid_export_format"
+            return send_archive_zip(chat_id, user_id, max(start, 0))
+
         archives = list_user_archives(user_id)
 
         if not archives:
@@ -563,7 +4696,7 @@ Note: AI chat is not yet implemented."""
                     return "export_retrieve_error"
 
                 filename = f"archive_{session_id[:8]}_{archive_data.get('model_name', 'chat')}.json"
-                file_content = json.dumps(archive_data, indent=2, default=str).encode('utf-8')
+                file_content = json_dumps(archive_data, pretty=True)
 
                 msg_count = len(archive_data.get('conversation', []))
                 caption = f"Archive: {archive_data.get('model_name', 'unknown')} - {msg_count} messages"
@@ -582,6 +4715,56 @@ Note: AI chat is not yet implemented."""
             send_message(chat_id, "Usage: /export <number> (e.g., /export 1)")
             return "invalid_export_format"
 
+    if cmd == "/restore":
+        if not payload.strip():
+            send_message(chat_id, "Usage: /restore <number> (e.g., /restore 1)\nUse /listarchives to see available archives.")
+            return "restore_no_number"
+
+        archives = list_user_archives(user_id)
+
+        if not archives:
+            send_message(chat_id, "No archived sessions to restore. Use /archive first.")
+            return "no_archives_to_restore"
+
+        try:
+            idx = int(payload.strip()) - 1
+        except ValueError:
+            send_message(chat_id, "Usage: /restore <number> (e.g., /restore 1)")
+            return "invalid_restore_format"
+
+        if not 0 <= idx < len(archives):
+            send_message(chat_id, "Invalid archive number. Use /listarchives to see available archives.")
+            return "invalid_restore_number"
+
+        session_id = archives[idx]['session_id']
+        if any(it.get('session_id') == session_id for it in get_user_items(user_id)):
+            send_message(chat_id, "That session is already in your active sessions. Use /listsessions and /switch.")
+            return "restore_already_active"
+
+        try:
+            session = restore_archived_session(user_id, session_id)
+        except ColdHistoryError:
+            send_message(chat_id, "That archive has moved to long-term storage (Glacier) and can't be read "
+                                  "until it is restored from there.")
+            return "restore_cold_storage"
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            log_error("Error restoring archive %s: %s", session_id, e)
+            session = None
+        if not session:
+            send_message(chat_id, "Failed to restore archive. Please try again.")
+            return "restore_error"
+
+        resp = f"Session restored and activated!\n"
+        resp += f"- Model: {session['model_name']}\n"
+        resp += f"- Messages: {session_message_count(session)}\n"
+        resp += f"- Archive ID: {session_id[:8]}\n"
+        resp += f"\nOlder messages are loaded on demand. Use /history to see recent ones."
+        send_message(chat_id, resp)
+        return "restored"
+
+    set_trace_command('unknown')  # keep arbitrary text out of the metrics dimensions
     send_message(chat_id, "Unknown command. Send /help for available commands.")
     return "unknown"
 
@@ -592,26 +4775,23 @@ def handle_document(document: Dict[str, Any], chat_id: int, user_id: int) -> str
     file_id = document.get('file_id', '')
     mime_type = document.get('mime_type', '')
 
-    print(f"Received document: {file_name} ({mime_type}) from user {user_id}")
+    log_info("Received document: %s (%s) from user %s", file_name, mime_type, user_id)
 
     if not (file_name.endswith('.json') or mime_type == 'application/json'):
         send_message(chat_id, "Please send a JSON file to import an archive.\nExport archives using /export to get the correct format.")
         return "invalid_file_type"
 
-    file_content = get_telegram_file(file_id)
-    if not file_content:
-        send_message(chat_id, "Failed to download file. Please try again.")
-        return "download_error"
+    if document.get('file_size', 0) > IMPORT_MAX_BYTES:
+        err = ArchiveImportError.too_large(IMPORT_MAX_BYTES)
+        send_message(chat_id, err.user_message)
+        return err.reason
 
     try:
-        archive_data = json.loads(file_content.decode('utf-8'))
-    except json.JSONDecodeError as e:
-        send_message(chat_id, f"Invalid JSON file. Please send a valid archive export.\nError: {str(e)[:100]}")
-        return "json_parse_error"
-
-    if 'conversation' not in archive_data:
-        send_message(chat_id, "Invalid archive format. Missing 'conversation' field.\nUse /export to get a valid archive format.")
-        return "invalid_archive_format"
+        archive_data = parse_archive_stream(stream_telegram_file(file_id))
+    except ArchiveImportError as e:
+        log_warning("Rejected import from user %s: %s", user_id, e.reason)
+        send_message(chat_id, e.user_message)
+        return e.reason
 
     new_session_id = import_archive_to_s3(user_id, archive_data)
     if not new_session_id:
@@ -630,10 +4810,25 @@ def handle_document(document: Dict[str, Any], chat_id: int, user_id: int) -> str
     return "imported"
 
 
-def handle_message(text: str, chat_id: int, user_id: int, update_id: int, document: Optional[Dict[str, Any]] = None) -> str:
-    """Handle incoming messages: commands, chat, or documents."""
+def handle_message(text: str, chat_id: int, user_id: int, update_id: int, document: Optional[Dict[str, Any]] = None,
+                   redelivered: bool = False) -> str:
+    """
+    Handle incoming messages: commands, chat, or documents.
+
+    A redelivered update (see claim_update) was charged to the rate limit by
+    its first attempt, and a chat message is not saved twice.
+    """
+
+    klass = request_class((text or '').strip(), document)
+    wait = 0.0 if redelivered else check_rate_limit(user_id, klass)
+    if wait:
+        set_trace_command('rate_limited')
+        shed_request(chat_id, user_id, klass,
+                     f"You're sending requests too fast. Please wait about {int(wait) + 1}s and try again.")
+        return "rate_limited"
 
     if document:
+        set_trace_command('document')
         return handle_document(document, chat_id, user_id)
 
     if not text:
@@ -645,35 +4840,113 @@ def handle_message(text: str, chat_id: int, user_id: int, update_id: int, docume
         send_message(chat_id, "No text received.")
         return "no_text"
 
-    print(f"Processing update_id={update_id}, text='{text}' for user {user_id} in chat {chat_id}")
+    log_debug("Processing update_id=%s, text='%.200s' for user %s in chat %s", update_id, text, user_id, chat_id)
 
     if text.startswith('/'):
         parts = text.split(" ", 1)
         cmd = parts[0].split("@", 1)[0].lower()
         payload = parts[1] if len(parts) > 1 else ""
+        set_trace_command(cmd)
         return handle_command(cmd, payload, chat_id, user_id, update_id)
     else:
-        session = get_current_session(user_id)
-        now = int(time.time())
+        set_trace_command('chat')
+        if not OLLAMA_ENABLED:
+            session = get_current_session(user_id)
+            saved = saved_turns(session, text) if redelivered else 0
+            if saved == 2:
+                return "already_answered"
+            if not saved:
+                user_msg = {"role": "user", "content": text, "ts": int(time.time())}
+                append_to_conversation(session, user_msg)
+
+            placeholder_response = "AI is not yet implemented. Your message has been saved to the conversation history for testing."
+            ass_msg = {"role": "assistant", "content": placeholder_response, "ts": int(time.time())}
+            append_to_conversation(session, ass_msg)
 
-        user_msg = {"role": "user", "content": text, "ts": now}
-        append_to_conversation(session, user_msg)
+            send_message(chat_id, placeholder_response)
+            return "ai_not_ready"
+
+        # Claim model capacity before touching the session, so a shed message is not half-saved
+        lease = acquire_model_slot()
+        if lease is None:
+            shed_request(chat_id, user_id, 'model_busy',
+                         "The model is busy right now. Please send your message again in a moment.")
+            return "model_busy"
+        try:
+            session = get_current_session(user_id)
+            saved = saved_turns(session, text) if redelivered else 0
+            if saved == 2:
+                # Cut short after the reply was saved and queued; the outbox has it
+                return "already_answered"
+            if not saved:
+                user_msg = {"role": "user", "content": text, "ts": int(time.time())}
+                append_to_conversation(session, user_msg)
 
-        placeholder_response = "AI is not yet implemented. Your message has been saved to the conversation history for testing."
-        ass_msg = {"role": "assistant", "content": placeholder_response, "ts": int(time.time())}
+            context = build_chat_context(session)
+            reply = call_ollama(session['model_name'], memory_prompt(recall_memories(user_id, text, context)) + context)
+        finally:
+            release_model_slot(lease)
+        remember(user_id, text)
+        ass_msg = {"role": "assistant", "content": reply, "ts": int(time.time())}
         append_to_conversation(session, ass_msg)
 
-        send_message(chat_id, placeholder_response)
-        return "ai_not_ready"
+        send_message(chat_id, reply)
+        return "ai_reply"
+
+
+def claim_update(user_id: int, update_id: int) -> bool:
+    """
+    Record that handling of the user's update has started. False if an
+    earlier attempt already did, e.g. one cut short by the deadline that
+    Telegram is now redelivering.
+    """
+    try:
+        get_dynamodb_client().put_item(
+            TableName=TABLE_NAME,
+            Item=to_dynamo({'pk': user_id, 'sk': f"{UPDATE_SK}#{update_id}",
+                            'ttl': int(time.time()) + UPDATE_CLAIM_TTL}),
+            ConditionExpression='attribute_not_exists(sk)'
+        )
+    except get_dynamodb_client().exceptions.ConditionalCheckFailedException:
+        return False
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        log_warning("Could not record update %s of user %s, handling it as new: %s", update_id, user_id, e)
+    return True
+
+
+def saved_turns(session: Dict[str, Any], text: str) -> int:
+    """
+    How much of a redelivered chat message the session already holds: 2 if
+    it ends with this message and its reply, 1 if with the message alone.
+    """
+    conversation = session.get('conversation') or []
+    if conversation and conversation[-1]['role'] == 'user' and conversation[-1]['content'] == text:
+        return 1
+    if (len(conversation) >= 2 and conversation[-1]['role'] == 'assistant'
+            and conversation[-2]['role'] == 'user' and conversation[-2]['content'] == text):
+        return 2
+    return 0
+
+
+def update_user_id(update: Dict[str, Any]) -> Optional[int]:
+    message = update.get("message") or {}
+    return message.get('from', {}).get('id', message.get("chat", {}).get("id"))
+
 
+def process_telegram_update(update: Dict[str, Any], batch_reads: Optional[Dict[int, Dict[tuple, Any]]] = None) -> Dict[str, Any]:
+    """
+    Process a single Telegram update (from webhook or polling).
 
-def process_telegram_update(update: Dict[str, Any]) -> Dict[str, Any]:
-    """Process a single Telegram update (from webhook or polling)."""
+    batch_reads carries each user's read cache from one update of a polling
+    batch to the next (seeded by prefetch_active_sessions).
+    """
     update_id = update.get("update_id", 0)
     message = update.get("message")
     
     if not message:
-        print(f"No message in update_id={update_id}, skipping")
+        log_debug("No message in update_id=%s, skipping", update_id)
         return {"processed": False, "reason": "no_message"}
     
     chat_id = message.get("chat", {}).get("id")
@@ -683,17 +4956,26 @@ def process_telegram_update(update: Dict[str, Any]) -> Dict[str, Any]:
     document = message.get("document")
     
     if chat_id is None:
-        print(f"No chat_id in update_id={update_id}, skipping")
+        log_warning("No chat_id in update_id=%s, skipping", update_id)
         return {"processed": False, "reason": "no_chat_id"}
     
-    handle_result = handle_message(text, chat_id, user_id, update_id, document)
+    redelivered = bool(update_id) and not claim_update(user_id, update_id)
+    if redelivered:
+        log_info("Update %s of user %s was started before, resuming it", update_id, user_id)
+        incr_metric('updates_redelivered')
+    with read_scope(batch_reads.get(user_id) if batch_reads is not None else None) as reads:
+        handle_result = handle_message(text, chat_id, user_id, update_id, document, redelivered)
+    if batch_reads is not None:
+        batch_reads[user_id] = {k: v for k, v in reads.cache.items() if k[1] == user_id}
+    flush_outbox(wait=False, chat_id=chat_id)
     
     return {
         "processed": True,
         "update_id": update_id,
         "handled": handle_result,
         "text": text if text else "(document)",
-        "user_id": user_id
+        "user_id": user_id,
+        "reads_saved": reads.saved
     }
 
 
@@ -703,53 +4985,48 @@ def lambda_handler(event, context):
     Supports both:
     1. Webhook mode (API Gateway triggers Lambda with Telegram update in body)
     2. Polling mode (Manual invocation to poll Telegram getUpdates)
+
+    Each invocation ends by draining queued replies (see OUTBOUND), writing
+    usage counters (see USAGE COUNTERS), embedding and indexing new messages
+    (see LONG-TERM MEMORY and SEARCH INDEX) and writing one metrics record
+    (see OBSERVABILITY).
     """
-    print(f"Event received: {json.dumps(event)[:500]}...")
-    
-    # Check if this is a webhook request from API Gateway
-    if 'body' in event:
-        # API Gateway webhook mode
-        try:
-            body = event.get('body', '{}')
-            if isinstance(body, str):
-                update = json.loads(body)
-            else:
-                update = body
-            
-            print(f"Webhook update received: {json.dumps(update)[:500]}...")
-            
-            result = process_telegram_update(update)
-            
-            # Always return 200 to Telegram to acknowledge receipt
-            return {
-                "statusCode": 200,
-                "headers": {"Content-Type": "application/json"},
-                "body": json.dumps({"ok": True, "result": result})
-            }
-        except json.JSONDecodeError as e:
-            print(f"JSON decode error: {e}")
-            return {
-                "statusCode": 200,
-                "headers": {"Content-Type": "application/json"},
-                "body": json.dumps({"ok": False, "error": "Invalid JSON"})
-            }
-        except Exception as e:
-            print(f"Webhook error: {e}")
-            import traceback
-            traceback.print_exc()
-            return {
-                "statusCode": 200,
-                "headers": {"Content-Type": "application/json"},
-                "body": json.dumps({"ok": False, "error": str(e)})
-            }
-    
-    # Polling mode (manual invocation or scheduled)
+    begin_invocation(context.get_remaining_time_in_millis() if hasattr(context, 'get_remaining_time_in_millis') else None)
+    started = time.perf_counter()
+    mode = 'maintenance' if event.get('action') else ('webhook' if 'body' in event else 'polling')
+    response: Dict[str, Any] = {"statusCode": 500}
+    try:
+        resume_deferred_replies()
+        response = route_event(event)
+        return response
+    finally:
+        drain_pending_work()
+        body = response.get('body')
+        if isinstance(body, dict):
+            updates = body.get('processed_count', 1 if 'result' in body else 0)
+        else:
+            updates = 1 if mode == 'webhook' else 0
+        emit_metrics(mode, (time.perf_counter() - started) * 1000.0, updates, getattr(_trace, 'errors', 0))
+        _trace.deadline = None
+
+
+def poll_updates(leases: Optional[BotLeases] = None) -> Dict[str, Any]:
+    """
+    Fetch the active bot's pending updates and process them in order,
+    checkpointing the offset after each one.
+
+    With `leases` (a polling worker, see BOTS) the offset writes carry the
+    lease's fence, and the batch stops once the lease is lost or about to run
+    out; the rest is left for the bot's next holder.
+    """
+    bot_id = _active_bot_id
+    fence = leases.fence(bot_id) if leases is not None else None
     try:
         last_offset = get_last_offset()
-        print(f"Polling mode - Starting with last_offset: {last_offset}")
+        log_debug("Polling mode - Starting with last_offset: %s", last_offset)
 
         if last_offset == 0:
-            print("First run detected - will process only the latest message")
+            log_info("First run detected - will process only the latest message")
             initial_poll = poll_messages(0)
             if initial_poll.get("ok"):
                 all_updates = initial_poll.get("result", [])
@@ -758,10 +5035,10 @@ def lambda_handler(event, context):
                     latest_id = latest_update.get("update_id", 0)
 
                     if len(all_updates) > 1:
-                        print(f"Skipping {len(all_updates) - 1} old messages")
+                        log_info("Skipping %d old messages", len(all_updates) - 1)
 
                     result = process_telegram_update(latest_update)
-                    save_offset(latest_id + 1)
+                    save_offset(latest_id + 1, fence)
                     return {
                         "statusCode": 200,
                         "body": {
@@ -772,7 +5049,7 @@ def lambda_handler(event, context):
                         }
                     }
 
-                save_offset(latest_id + 1 if all_updates else 1)
+                save_offset(latest_id + 1 if all_updates else 1, fence)
                 return {
                     "statusCode": 200,
                     "body": f"First run: Cleared {len(all_updates)} old messages"
@@ -782,51 +5059,199 @@ def lambda_handler(event, context):
 
         if not result.get("ok"):
             error_msg = f"Telegram API error: {result.get('error', result)}"
-            print(error_msg)
+            log_error("%s", error_msg)
             return {"statusCode": 400, "body": error_msg}
 
         updates = result.get("result", [])
 
         if not updates:
-            print("No new messages")
+            log_debug("No new messages")
             return {"statusCode": 200, "body": "No messages"}
 
-        print(f"Received {len(updates)} updates")
+        log_info("Received %d updates", len(updates))
 
         processed = []
-        max_update_id = last_offset
+        max_update_id = last_offset - 1
+        fresh = [u for u in updates if not (last_offset > 0 and u.get("update_id", 0) < last_offset)]
+        user_ids = list(dict.fromkeys(uid for uid in map(update_user_id, fresh) if uid is not None))
+        batch_reads = prefetch_active_sessions(user_ids) if user_ids else {}
+
+        checkpoint = last_offset
+        deferred = 0
+        lease_lost = False
+        try:
+            for index, update in enumerate(updates):
+                update_id = update.get("update_id", 0)
 
-        for update in updates:
-            update_id = update.get("update_id", 0)
+                if last_offset > 0 and update_id < last_offset:
+                    log_debug("Skipping already-processed update_id=%s", update_id)
+                    max_update_id = max(max_update_id, update_id)
+                    continue
 
-            if last_offset > 0 and update_id < last_offset:
-                print(f"Skipping already-processed update_id={update_id}")
+                if leases is not None and not leases.valid(bot_id):
+                    raise LeaseLost(f"lease of bot {bot_id} is about to expire")
+                if time_left() < (UPDATE_MIN_BUDGET_MS + DEADLINE_RESERVE_MS) / 1000.0:
+                    deferred = len(updates) - index
+                    log_warning("Low on time, leaving %d updates for the next invocation", deferred)
+                    break
+                cut = _trace.counters.get('deadline_exceeded', 0)
+                result = process_telegram_update(update, batch_reads)
+                if _trace.counters.get('deadline_exceeded', 0) > cut:
+                    # Cut short part-way: left unacknowledged so Telegram delivers it again
+                    deferred = len(updates) - index
+                    log_warning("Update %s ran out of time, leaving %d updates for the next invocation", update_id, deferred)
+                    break
+                if result.get("processed"):
+                    processed.append(result)
                 max_update_id = max(max_update_id, update_id)
-                continue
+                # Checkpoint every update, so a timeout or crash later in the batch does not repeat it
+                checkpoint = max_update_id + 1
+                save_offset(checkpoint, fence)
 
-            result = process_telegram_update(update)
-            if result.get("processed"):
-                processed.append(result)
-            max_update_id = max(max_update_id, update_id)
+            if max_update_id + 1 > checkpoint:
+                save_offset(max_update_id + 1, fence)
+        except LeaseLost as e:
+            # Whatever is left belongs to the bot's new holder
+            lease_lost = True
+            deferred = sum(1 for u in updates if u.get("update_id", 0) >= checkpoint)
+            max_update_id = checkpoint - 1
+            log_warning("Stopping bot %s: %s", bot_id, e)
+            incr_metric('lease_lost')
 
-        if max_update_id >= last_offset:
-            new_offset = max_update_id + 1
-            save_offset(new_offset)
-            print(f"Acknowledged up to update_id={max_update_id}, next offset={new_offset}")
+        if deferred:
+            incr_metric('updates_deferred', deferred)
+        log_debug("Acknowledged up to update_id=%s, next offset=%s", max_update_id, max_update_id + 1)
 
         return {
             "statusCode": 200,
             "body": {
                 "mode": "polling",
                 "processed_count": len(processed),
+                "deferred_count": deferred,
+                "reads_saved": sum(m.get("reads_saved", 0) for m in processed),
                 "messages": processed,
                 "last_offset": last_offset,
-                "new_offset": max_update_id + 1
+                "new_offset": max_update_id + 1,
+                **({"lease_lost": lease_lost} if leases is not None else {})
             }
         }
     except Exception as e:
         error_msg = f"Error: {str(e)}"
-        print(error_msg)
-        import traceback
-        traceback.print_exc()
+        log_error("%s", error_msg, exc_info=True)
         return {"statusCode": 500, "body": error_msg}
+
+
+def poll_leased_bots(leases: BotLeases) -> Dict[str, Any]:
+    """Poll each bot `leases` holds once, in turn. The body has each bot's polling result."""
+    results = {}
+    for bot_id in leases.held():
+        if time_left() < (UPDATE_MIN_BUDGET_MS + DEADLINE_RESERVE_MS) / 1000.0:
+            break
+        use_bot(BOTS[bot_id])
+        results[bot_id] = poll_updates(leases)['body']
+    return {
+        "statusCode": 200,
+        "body": {
+            "mode": "polling",
+            "worker": leases.worker_id,
+            "processed_count": sum(r.get("processed_count", 0) for r in results.values() if isinstance(r, dict)),
+            "bots": results
+        }
+    }
+
+
+def poll_as_worker(bot_ids: Optional[List[str]] = None) -> Dict[str, Any]:
+    """One polling invocation as a worker: lease a share of the bots, poll each once, hand the leases back."""
+    leases = BotLeases(bot_ids=bot_ids)
+    try:
+        leases.start()
+        return poll_leased_bots(leases)
+    finally:
+        # Replies go out before another worker can pick the bots up
+        drain_pending_work()
+        leases.stop()
+
+
+def drain_pending_work():
+    """Deliver queued replies (and any deferred ones), write usage counters, then embed and index new messages."""
+    resume_deferred_replies()
+    flush_outbox(wait=True)
+    flush_usage()
+    run_deferred_work()
+
+
+def run_deferred_work():
+    """Embed and index the messages queued since the last call (after replies have gone out)."""
+    state = _active_bot.state
+    if state.memory_pending:
+        embed_pending_memory()
+    if state.search_pending:
+        index_pending_search()
+
+
+def route_event(event: Dict[str, Any]) -> Dict[str, Any]:
+    """Dispatch an invocation to maintenance, webhook or polling handling."""
+    log_debug("Event received: %s", Preview(event))
+    bot = HOME_BOT
+    if event.get('bot_id'):
+        bot = BOTS.get(str(event['bot_id']))
+        if bot is None:
+            return {"statusCode": 400, "body": f"Unknown bot_id: {event['bot_id']}"}
+    if TELEGRAM_BOTS and not event.get('action') and 'body' not in event:
+        # Several bots: this invocation polls as one worker among any others running
+        return poll_as_worker([bot.bot_id] if event.get('bot_id') else None)
+    use_bot(bot)
+
+    # Maintenance job: pack loose archives into bundles (scheduled or manual invoke)
+    if event.get('action') == 'compact_archives':
+        return {"statusCode": 200, "body": {"compacted": compact_archives(event.get('user_id'))}}
+    if event.get('action') == 'reindex_search':
+        return {"statusCode": 200, "body": {"reindexed": reindex_search(int(event['user_id']))}}
+    if event.get('action') == 'usage_stats':
+        return {"statusCode": 200, "body": export_usage_metrics(int(event.get('days', 1)))}
+    
+    # Check if this is a webhook request from API Gateway
+    if 'body' in event:
+        # API Gateway webhook mode
+        try:
+            body = event.get('body', '{}')
+            if isinstance(body, str):
+                update = json_loads(body)
+            else:
+                update = body
+            
+            log_debug("Webhook update received: %s", Preview(update))
+            
+            result = process_telegram_update(update)
+            
+            # Return 200 to Telegram to acknowledge receipt, unless the deadline cut the update off
+            return {
+                "statusCode": 200,
+                "headers": {"Content-Type": "application/json"},
+                "body": json_text({"ok": True, "result": result})
+            }
+        except DeadlineExceeded as e:
+            # Not acknowledged, so Telegram delivers the update again
+            log_warning("Webhook update cut off by the deadline, asking for redelivery: %s", e)
+            return {
+                "statusCode": 503,
+                "headers": {"Content-Type": "application/json"},
+                "body": json_text({"ok": False, "error": "deadline exceeded"})
+            }
+        except json.JSONDecodeError as e:
+            log_error("JSON decode error: %s", e)
+            return {
+                "statusCode": 200,
+                "headers": {"Content-Type": "application/json"},
+                "body": json_text({"ok": False, "error": "Invalid JSON"})
+            }
+        except Exception as e:
+            log_error("Webhook error: %s", e, exc_info=True)
+            return {
+                "statusCode": 200,
+                "headers": {"Content-Type": "application/json"},
+                "body": json_text({"ok": False, "error": str(e)})
+            }
+    
+    # Polling mode (manual invocation or scheduled)
+    return poll_updates()
@@ -95,6 +95,7 @@ module "lambda" {
     TELEGRAM_TOKEN = var.telegram_token
     S3_BUCKET_NAME = module.s3.bucket_name
     ENVIRONMENT    = var.environment
+    LOG_LEVEL      = var.log_level
   }
 
   log_retention_days = var.log_retention_days
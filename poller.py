@@ -0,0 +1,94 @@
+#!/usr/bin/python
+"""
+Polling worker
+
+Polls the bots in TELEGRAM_TOKEN and TELEGRAM_BOTS as one long-lived process,
+sharing them with any other poller.py processes and polling invocations of
+the Lambda through leases in the table (see BOTS in handler.py):
+
+- On start the worker registers and claims an even share of the bots. A
+  heartbeat thread renews the registration and the leases every
+  BOT_LEASE_TTL / 3 seconds.
+- Each round polls every bot the worker holds once, in turn, and then
+  drains replies and counters. Rounds without updates are followed by
+  --idle-sleep seconds of sleep.
+- Every BOT_LEASE_TTL / 3 seconds the worker rebalances: it claims expired
+  or released leases (for example of a worker that died) and hands the extra
+  ones back while it holds more than its share and another worker holds less.
+
+Each round writes one metrics record, like a polling invocation.
+
+On SIGTERM or SIGINT the worker finishes the bot it is polling, sends what
+is queued and releases its leases, so the others take its bots over at once
+instead of after BOT_LEASE_TTL.
+
+Usage:
+    TELEGRAM_BOTS=123:AAA,456:BBB python poller.py
+    python poller.py --max-bots 4 --idle-sleep 0.5
+"""
+
+import argparse
+import signal
+import threading
+import time
+
+import handler
+
+
+def run(leases: handler.BotLeases, stop: threading.Event, idle_sleep: float):
+    rebalance_every = handler.BOT_LEASE_TTL / 3
+    rebalanced = time.monotonic()
+    while not stop.is_set():
+        if time.monotonic() - rebalanced >= rebalance_every:
+            leases.rebalance()
+            rebalanced = time.monotonic()
+        handler.begin_invocation()
+        started = time.perf_counter()
+        response = {'body': {}}
+        try:
+            response = handler.poll_leased_bots(leases)
+        except Exception as e:
+            handler.log_error("Polling round failed: %s", e, exc_info=True)
+        finally:
+            handler.drain_pending_work()
+            processed = response['body'].get('processed_count', 0)
+            handler.emit_metrics('polling', (time.perf_counter() - started) * 1000.0, processed,
+                                 getattr(handler._trace, 'errors', 0))
+        if not processed:
+            stop.wait(idle_sleep)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--worker-id', help='name in the lease table (default host-pid-random)')
+    parser.add_argument('--max-bots', type=int, default=handler.POLL_MAX_BOTS, help='bots held at most, 0 = even share')
+    parser.add_argument('--idle-sleep', type=float, default=1.0, help='seconds to wait after a round without updates')
+    args = parser.parse_args()
+
+    if not handler.BOTS:
+        raise SystemExit("No bots configured: set TELEGRAM_TOKEN and/or TELEGRAM_BOTS")
+    handler.prime()
+
+    stop = threading.Event()
+
+    def shutdown(signum, frame):
+        stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    leases = handler.BotLeases(args.worker_id, max_bots=args.max_bots)
+    held = leases.start()
+    handler.log_info("Worker %s polling %d of %d bots: %s", leases.worker_id, len(held), len(handler.BOTS),
+                     ', '.join(held) or '-')
+    try:
+        run(leases, stop, args.idle_sleep)
+    finally:
+        handler.begin_invocation()
+        handler.drain_pending_work()
+        leases.stop()
+        handler.log_info("Worker %s stopped", leases.worker_id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+"""
+Multi-bot polling benchmark
+
+Runs N polling worker processes against M bots and reports how long they
+take to work through every bot's backlog, for each N in --workers:
+
+- The workers share one SQLite store (storage.py) standing in for DynamoDB,
+  so leases, offsets and sessions are contended for the way they would be
+  in the real table.
+- Telegram is a synthetic Bot API in each process. Every bot has --updates
+  chat messages waiting, generated from the offset, so the processes need no
+  shared queue. Ollama is the FakeOllama from local_backends.py. Both have
+  per-request latency (--telegram-ms, --ollama-ms).
+- Workers register, then claim and rebalance leases exactly as poller.py
+  does. Each worker logs the (bot, update_id) pairs it processed. The run
+  is checked for duplicates and gaps.
+
+--kill-after S SIGKILLs the first worker S seconds in, to show its bots
+being taken over once its leases expire (--lease-ttl). The update it was
+handling when it died may be processed twice. That is the usual
+at-least-once redelivery of an uncheckpointed update.
+
+Usage:
+    python scripts/bench_bots.py
+    python scripts/bench_bots.py --bots 16 --workers 1 2 4 8 16 --updates 100
+    python scripts/bench_bots.py --workers 4 --kill-after 2 --lease-ttl 3
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+sys.path.insert(0, SCRIPT_DIR)
+
+from local_backends import Backend, FakeHTTP, FakeOllama, FakeResponse, make_update  # noqa: E402
+
+BOT_ID_BASE = 7000000
+
+
+class SyntheticTelegram(Backend):
+    """Bot API for any number of bots, each with update ids 1..updates waiting."""
+
+    def __init__(self, updates: int, users: int, latency_ms: float):
+        super().__init__('telegram', latency_ms)
+        self.updates = updates
+        self.users = users
+
+    def handle(self, method: str, path: str, params=None, json_body=None, data=None, files=None) -> FakeResponse:
+        token, _, api_method = path[len('/bot'):].partition('/')
+        self._record(api_method)
+        if api_method != 'getUpdates':
+            return FakeResponse(200, {'ok': True, 'result': {'message_id': 1}})
+        offset = max(int((params or {}).get('offset', 1)), 1)
+        last = min(offset + int((params or {}).get('limit', 100)), self.updates + 1)
+        bot_id = token.split(':', 1)[0]
+        return FakeResponse(200, {'ok': True, 'result': [
+            make_update(i, 1000 + i % self.users, f"message {i} for bot {bot_id}") for i in range(offset, last)
+        ]})
+
+
+def configure(args, directory: str):
+    """Environment for handler.py, set before it is imported (here and in the spawned workers)."""
+    tokens = [f"{BOT_ID_BASE + i}:bench" for i in range(args.bots)]
+    os.environ.update({
+        'STORAGE_BACKEND': 'sqlite', 'STORAGE_PATH': directory, 'TELEGRAM_TOKEN': '',
+        'TELEGRAM_BOTS': ','.join(tokens), 'BOT_LEASE_TTL': str(args.lease_ttl),
+        'OLLAMA_ENABLED': '1', 'MODEL_MAX_IN_FLIGHT': '0', 'RATE_LIMITS': '',
+        'SEND_CHAT_RATE': '0', 'SEND_GLOBAL_RATE': '0', 'METRICS_SINK': 'off', 'LOG_LEVEL': 'ERROR',
+    })
+
+
+def worker(index: int, args, directory: str, log_path: str, ready, go):
+    configure(args, directory)
+    import handler
+
+    handler._http_session = FakeHTTP(SyntheticTelegram(args.updates, args.users, args.telegram_ms),
+                                     FakeOllama(args.ollama_ms, 200), handler.OLLAMA_URL)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    leases = handler.BotLeases(f"worker-{index}")
+    leases.heartbeat()  # registered before anyone claims, so the first shares are already even
+    ready.set()
+    go.wait()
+
+    log = open(log_path, 'w', buffering=1)
+    process_update = handler.process_telegram_update
+
+    def logged(update, *rest):
+        # Logged as each update finishes, so a SIGKILLed worker's log is complete up to its last update
+        result = process_update(update, *rest)
+        log.write(f"{handler.active_bot_id()} {update['update_id']}\n")
+        return result
+
+    handler.process_telegram_update = logged
+    leases.start()
+    rebalanced = time.monotonic()
+    while not stop.is_set():
+        if time.monotonic() - rebalanced >= args.lease_ttl / 3:
+            leases.rebalance()
+            rebalanced = time.monotonic()
+        handler.begin_invocation()
+        body = handler.poll_leased_bots(leases)['body']
+        handler.drain_pending_work()
+        if not body['processed_count']:
+            stop.wait(0.05)
+    leases.stop()
+    log.close()
+
+
+def offsets(handler) -> dict:
+    result = {}
+    for bot_id, bot in handler.BOTS.items():
+        handler.use_bot(bot)
+        result[bot_id] = handler.get_last_offset()
+    return result
+
+
+def run(args, workers: int) -> dict:
+    directory = tempfile.mkdtemp(prefix='bench-bots-')
+    configure(args, directory)
+    import handler
+    # A fresh store per run; the parent only seeds and watches the offsets
+    handler.STORAGE_PATH = directory
+    handler._dynamodb_client = handler._s3_client = None
+    handler.BOTS = handler.parse_bots(os.environ['TELEGRAM_BOTS'])
+    for bot in handler.BOTS.values():
+        handler.use_bot(bot)
+        handler.save_offset(1)  # past the first-run shortcut, which skips old updates
+
+    context = multiprocessing.get_context('spawn')
+    go = context.Event()
+    procs, readies, logs = [], [], []
+    for i in range(workers):
+        ready = context.Event()
+        logs.append(os.path.join(directory, f"worker-{i}.log"))
+        procs.append(context.Process(target=worker, args=(i, args, directory, logs[-1], ready, go)))
+        readies.append(ready)
+        procs[-1].start()
+    for ready in readies:
+        ready.wait()
+
+    started = time.perf_counter()
+    go.set()
+    killed = False
+    target = args.updates + 1
+    while True:
+        time.sleep(0.1)
+        if args.kill_after and not killed and time.perf_counter() - started >= args.kill_after:
+            os.kill(procs[0].pid, signal.SIGKILL)
+            killed = True
+        if all(offset >= target for offset in offsets(handler).values()):
+            break
+        if time.perf_counter() - started > args.timeout:
+            break
+    elapsed = time.perf_counter() - started
+    for proc in procs:
+        if proc.is_alive():
+            proc.terminate()
+    for proc in procs:
+        proc.join()
+
+    seen = {}
+    for path in logs:
+        with open(path) as f:
+            for line in f:
+                seen[line] = seen.get(line, 0) + 1
+    expected = args.bots * args.updates
+    return {
+        'workers': workers,
+        'bots': args.bots,
+        'updates': sum(seen.values()),
+        'missing': expected - len(seen),
+        'duplicates': sum(count - 1 for count in seen.values()),
+        'elapsed_s': round(elapsed, 2),
+        'updates_per_s': round(len(seen) / elapsed, 1),
+        'killed': killed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bots', type=int, default=8)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--updates', type=int, default=60, help='updates waiting per bot')
+    parser.add_argument('--users', type=int, default=5, help='users per bot')
+    parser.add_argument('--telegram-ms', type=float, default=20.0)
+    parser.add_argument('--ollama-ms', type=float, default=50.0)
+    parser.add_argument('--lease-ttl', type=float, default=3.0)
+    parser.add_argument('--kill-after', type=float, default=0.0, help='SIGKILL the first worker after this many seconds')
+    parser.add_argument('--timeout', type=float, default=300.0)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    rows = [run(args, n) for n in args.workers]
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    base = rows[0]['updates_per_s'] / rows[0]['workers'] if rows[0]['updates_per_s'] else 0
+    print(f"{'workers':>8}{'bots':>6}{'updates':>9}{'missing':>9}{'dups':>6}{'secs':>8}{'upd/s':>9}{'scaling':>9}")
+    for row in rows:
+        scaling = row['updates_per_s'] / (base * row['workers']) if base else 0
+        print(f"{row['workers']:>8}{row['bots']:>6}{row['updates']:>9}{row['missing']:>9}{row['duplicates']:>6}"
+              f"{row['elapsed_s']:>8.2f}{row['updates_per_s']:>9.1f}{scaling:>9.0%}"
+              f"{'  (worker 0 killed)' if row['killed'] else ''}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+"""
+Cold-start benchmark for handler.py
+
+Every run happens in a fresh interpreter, so each number includes the full
+import of handler.py plus whatever the first invocation has to set up. For
+each command type it reports:
+- import time of handler.py and which heavy modules it pulled in
+- latency of the first lambda_handler invocation
+
+Commands that need DynamoDB/S3 only run when --endpoint-url points at
+LocalStack (see docker-compose.yml). The others run fully offline.
+TELEGRAM_TOKEN is cleared, so replies are not sent and requests is only
+imported by paths that call Ollama.
+
+Usage:
+    python scripts/bench_cold_start.py
+    python scripts/bench_cold_start.py --endpoint-url http://localhost:4566 --runs 10
+    python scripts/bench_cold_start.py --budget-ms 150 --json cold_start.json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name -> (message text or None for a polling invocation, needs storage)
+CASES = {
+    'help': ('/help', False),
+    'echo': ('/echo hi', False),
+    'status': ('/status', False),
+    'start': ('/start', True),
+    'listsessions': ('/listsessions', True),
+    'history': ('/history', True),
+    'listarchives': ('/listarchives', True),
+    'chat': ('hello there', True),
+    'polling': (None, True),
+}
+
+CHILD = r'''
+import json, sys, time
+t0 = time.perf_counter()
+import handler
+t1 = time.perf_counter()
+text = json.loads(sys.argv[1])
+if text is None:
+    event = {}
+else:
+    update = {"update_id": 1, "message": {"message_id": 1, "chat": {"id": 42}, "from": {"id": 42}, "text": text}}
+    event = {"body": json.dumps(update)}
+handler.lambda_handler(event, None)
+t2 = time.perf_counter()
+print(json.dumps({
+    "import_ms": (t1 - t0) * 1000,
+    "first_invoke_ms": (t2 - t1) * 1000,
+    "modules_after": {m: m in sys.modules for m in ("boto3", "botocore", "requests")},
+}))
+'''
+
+
+def run_case(text, env):
+    proc = subprocess.run(
+        [sys.executable, '-c', CHILD, json.dumps(text)],
+        cwd=PROJECT_DIR, env=env, capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr else 'child failed')
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per case (default 5)')
+    parser.add_argument('--endpoint-url', default='', help='AWS endpoint for storage cases, e.g. LocalStack')
+    parser.add_argument('--prime', action='store_true', help='set PRIME_ON_INIT=1 (clients built during init)')
+    parser.add_argument('--budget-ms', type=float, default=0, help='fail if median import time exceeds this')
+    parser.add_argument('--json', default='', help='write results to this file')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.update({
+        'TELEGRAM_TOKEN': '',
+        'PYTHONDONTWRITEBYTECODE': '1',
+        'METRICS_SINK': 'emf',
+        'AWS_DEFAULT_REGION': env.get('AWS_DEFAULT_REGION', 'us-east-1'),
+    })
+    if args.prime:
+        env['PRIME_ON_INIT'] = '1'
+    if args.endpoint_url:
+        env.update({
+            'AWS_ENDPOINT_URL': args.endpoint_url,
+            'AWS_ACCESS_KEY_ID': 'test',
+            'AWS_SECRET_ACCESS_KEY': 'test',
+        })
+
+    results = {}
+    print(f"{'case':<14}{'import ms':>12}{'first call ms':>16}{'total ms':>12}  modules loaded")
+    print('-' * 78)
+    for name, (text, needs_storage) in CASES.items():
+        if needs_storage and not args.endpoint_url:
+            print(f"{name:<14}{'skipped (needs --endpoint-url)':>40}")
+            continue
+        try:
+            runs = [run_case(text, env) for _ in range(args.runs)]
+        except RuntimeError as e:
+            print(f"{name:<14}  error: {e}")
+            continue
+        import_ms = statistics.median(r['import_ms'] for r in runs)
+        invoke_ms = statistics.median(r['first_invoke_ms'] for r in runs)
+        loaded = ', '.join(m for m, present in runs[-1]['modules_after'].items() if present) or 'none'
+        results[name] = {
+            'import_ms': round(import_ms, 2),
+            'first_invoke_ms': round(invoke_ms, 2),
+            'total_ms': round(import_ms + invoke_ms, 2),
+            'modules_loaded': loaded,
+            'runs': args.runs,
+        }
+        print(f"{name:<14}{import_ms:>12.1f}{invoke_ms:>16.1f}{import_ms + invoke_ms:>12.1f}  {loaded}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'prime': args.prime, 'cases': results}, f, indent=2)
+        print(f"\nWrote {args.json}")
+
+    if args.budget_ms and results:
+        worst = max(r['import_ms'] for r in results.values())
+        if worst > args.budget_ms:
+            print(f"\nImport time {worst:.1f}ms exceeds budget of {args.budget_ms:.1f}ms")
+            sys.exit(1)
+        print(f"\nImport time {worst:.1f}ms within budget of {args.budget_ms:.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+"""
+JSON codec benchmark
+
+Times the JSON work on the hot paths, each three ways: the code as it was
+before the codec layer (json.dumps/json.loads with indent and str
+conversions), handler.json_dumps/json_loads on the standard library, and the
+same on orjson (skipped if it is not installed):
+
+- webhook_parse: decode the body of an API Gateway event holding a Telegram
+  update (--words of text) and encode the response
+- webhook_log: render the event for the DEBUG log line ('%.500s' % event
+  before, Preview(event) now)
+- archive_write: encode_archive() of an archive with --messages turns
+- export: read an archive back and encode it indented, as /export does
+
+Usage:
+    python scripts/bench_json.py
+    python scripts/bench_json.py --messages 10000 --iterations 50
+    python scripts/bench_json.py --json
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+sys.path.insert(0, SCRIPT_DIR)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import handler  # noqa: E402
+from bench_pipeline import percentile  # noqa: E402
+from bench_sessions import WORDS  # noqa: E402
+from local_backends import make_update  # noqa: E402
+
+
+def sample_archive(messages: int, rng: random.Random):
+    ts = 1700000000
+    conversation = []
+    for i in range(messages):
+        ts += rng.randint(1, 120)
+        content = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 40)))
+        conversation.append(handler.Message('user' if i % 2 == 0 else 'assistant', content, ts))
+    return {'user_id': 1001, 'session_id': 'bench', 'model_name': 'llama3', 'conversation': conversation,
+            'original_sk': 'MODEL#llama3#SESSION#bench', 'last_message_ts': ts,
+            'archived_at': '2026-01-01T00:00:00Z', 'archive_version': '1.0'}
+
+
+def api_gateway_event(body: str):
+    """A REST API proxy event shaped like the ones API Gateway delivers (headers twice, request context)."""
+    headers = {'Accept-Encoding': 'gzip, deflate', 'Content-Type': 'application/json', 'Host': 'abc123.execute-api.us-east-1.amazonaws.com',
+               'X-Amzn-Trace-Id': 'Root=1-00000000-000000000000000000000000', 'X-Forwarded-For': '91.108.6.1',
+               'X-Forwarded-Port': '443', 'X-Forwarded-Proto': 'https', 'X-Telegram-Bot-Api-Secret-Token': 'secret'}
+    return {
+        'resource': '/webhook', 'path': '/webhook', 'httpMethod': 'POST', 'headers': headers,
+        'multiValueHeaders': {k: [v] for k, v in headers.items()}, 'queryStringParameters': None,
+        'requestContext': {'resourceId': 'abc123', 'resourcePath': '/webhook', 'httpMethod': 'POST',
+                           'extendedRequestId': 'bench=', 'requestTime': '01/Jan/2026:00:00:00 +0000',
+                           'path': '/prod/webhook', 'accountId': '123456789012', 'protocol': 'HTTP/1.1',
+                           'stage': 'prod', 'requestTimeEpoch': 1767225600000, 'requestId': 'bench',
+                           'identity': {'sourceIp': '91.108.6.1', 'userAgent': None},
+                           'domainName': 'abc123.execute-api.us-east-1.amazonaws.com', 'apiId': 'abc123'},
+        'body': body, 'isBase64Encoded': False,
+    }
+
+
+def legacy_encode_archive(archive_data):
+    """encode_archive as it was: stdlib json.dumps per part, spaced separators, ASCII escapes."""
+    header = {k: v for k, v in archive_data.items() if k != 'conversation'}
+    parts = [json.dumps(header, indent=2, default=handler.json_default)[:-2].encode('utf-8'),
+             b',\n  "conversation": [\n']
+    for i, message in enumerate(archive_data['conversation']):
+        if i:
+            parts.append(b',\n')
+        parts.append(b'    ' + json.dumps(message, default=handler.json_default).encode('utf-8'))
+    parts.append(b'\n  ]\n}')
+    return b''.join(parts)
+
+
+def cases(args, rng: random.Random):
+    update = make_update(1, 1001, ' '.join(rng.choice(WORDS) for _ in range(args.words)))
+    event = api_gateway_event(json.dumps(update))
+    result = {'processed': True, 'update_id': 1, 'handled': 'ai_reply', 'text': update['message']['text'],
+              'user_id': 1001, 'reads_saved': 1}
+    archive = sample_archive(args.messages, rng)
+    archive_bytes, _ = handler.encode_archive(archive)
+
+    def webhook_legacy():
+        json.loads(event['body'])
+        json.dumps({'ok': True, 'result': result})
+
+    def webhook_now():
+        handler.json_loads(event['body'])
+        handler.json_text({'ok': True, 'result': result})
+
+    def export_legacy():
+        data = json.loads(archive_bytes.decode('utf-8'))
+        json.dumps(data, indent=2, default=handler.json_default).encode('utf-8')
+
+    def export_now():
+        handler.json_dumps(handler.json_loads(archive_bytes), pretty=True)
+
+    return {
+        'webhook_parse': (webhook_legacy, webhook_now),
+        'webhook_log': (lambda: '%.500s' % (event,), lambda: str(handler.Preview(event))),
+        'archive_write': (lambda: legacy_encode_archive(archive), lambda: handler.encode_archive(archive)),
+        'export': (export_legacy, export_now),
+    }
+
+
+def time_us(fn, iterations: int):
+    fn()
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1e6)
+    samples.sort()
+    return round(percentile(samples, 50), 1)
+
+
+def use_backend(name: str) -> bool:
+    handler.JSON_BACKEND = name
+    handler._orjson = None
+    return name == 'stdlib' or handler.get_orjson() is not None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=1000, help='turns in the archive')
+    parser.add_argument('--words', type=int, default=300, help='words in the webhook message text')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    rows = {name: {} for name in cases(args, random.Random(args.seed))}
+    for backend in ('stdlib', 'orjson'):
+        if not use_backend(backend):
+            print(f"{backend} is not installed, skipped", file=sys.stderr)
+            continue
+        for name, (legacy, now) in cases(args, random.Random(args.seed)).items():
+            if backend == 'stdlib':
+                rows[name]['before_us'] = time_us(legacy, args.iterations)
+            rows[name][f"{backend}_us"] = time_us(now, args.iterations)
+    use_backend('auto')
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    print(f"{'case':<15}{'before':>12}{'stdlib':>12}{'orjson':>12}   (p50 microseconds, {args.messages} turns)")
+    for name, row in rows.items():
+        cells = ''.join(f"{row[k]:>12.1f}" if k in row else f"{'-':>12}" for k in ('before_us', 'stdlib_us', 'orjson_us'))
+        print(f"{name:<15}{cells}")
+
+
+if __name__ == '__main__':
+    main()
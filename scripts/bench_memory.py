@@ -0,0 +1,114 @@
+#!/usr/bin/python
+"""
+Retrieval benchmark for long-term memory
+
+Builds a MemoryIndex the way load_memory_index does (decoding float32
+segments of --segment-size vectors) and times top-k cosine search against
+it. Vectors are random unit vectors; only their count and dimension matter
+for the timing. Uses NumPy when it is installed; --no-numpy times the
+plain-Python fallback instead, which only scans the newest
+MEMORY_SCAN_LIMIT vectors.
+
+Reports segment load time, resident vector bytes and per-query latency
+percentiles.
+
+Usage:
+    python scripts/bench_memory.py
+    python scripts/bench_memory.py --vectors 100000 --dim 768 --queries 200
+    python scripts/bench_memory.py --no-numpy --vectors 10000 --json
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+sys.path.insert(0, SCRIPT_DIR)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import handler  # noqa: E402
+from bench_pipeline import percentile  # noqa: E402
+
+# Distinct vectors generated; the index repeats them to reach --vectors
+POOL_SIZE = 1024
+
+
+def random_vectors(count: int, dim: int, rng: random.Random):
+    return [[rng.gauss(0.0, 1.0) for _ in range(dim)] for _ in range(count)]
+
+
+def build_segments(vectors: int, dim: int, segment_size: int, rng: random.Random):
+    pool = random_vectors(min(POOL_SIZE, vectors), dim, rng)
+    segments = []
+    for start in range(0, vectors, segment_size):
+        count = min(segment_size, vectors - start)
+        rows = [pool[(start + i) % len(pool)] for i in range(count)]
+        texts = [f"remembered message {start + i}" for i in range(count)]
+        segments.append(handler.encode_memory_segment(texts, rows))
+    return segments
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--vectors', type=int, default=100000)
+    parser.add_argument('--dim', type=int, default=768, help='embedding size (768 for nomic-embed-text)')
+    parser.add_argument('--k', type=int, default=handler.MEMORY_TOP_K)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--segment-size', type=int, default=1000, help='vectors per stored segment')
+    parser.add_argument('--no-numpy', action='store_true', help='time the plain-Python fallback')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    if args.no_numpy:
+        handler._numpy = False
+    backend = 'numpy' if handler.get_numpy() is not None else 'python'
+    rng = random.Random(args.seed)
+
+    segments = build_segments(args.vectors, args.dim, args.segment_size, rng)
+    index = handler.MemoryIndex()
+    started = time.perf_counter()
+    for data in segments:
+        header, raw = handler.decode_memory_segment(data)
+        index.add(header['texts'], raw, header['dim'])
+    load_ms = (time.perf_counter() - started) * 1000.0
+
+    queries = random_vectors(args.queries, args.dim, rng)
+    latencies = []
+    for query in queries:
+        t0 = time.perf_counter()
+        hits = index.search(query, args.k)
+        latencies.append((time.perf_counter() - t0) * 1000.0)
+        assert len(hits) == min(args.k, args.vectors)
+    latencies.sort()
+
+    result = {
+        'backend': backend,
+        'vectors': args.vectors,
+        'dim': args.dim,
+        'k': args.k,
+        'scanned': args.vectors if backend == 'numpy' else min(args.vectors, handler.MEMORY_SCAN_LIMIT),
+        'segments': len(segments),
+        'load_ms': round(load_ms, 2),
+        'vector_mb': round(args.vectors * args.dim * 4 / 1e6, 1),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'queries_per_s': round(len(latencies) / (sum(latencies) / 1000.0), 1) if latencies else 0.0,
+    }
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    print(f"{args.vectors} x {args.dim} float32 vectors ({result['vector_mb']} MB) in {len(segments)} segments, "
+          f"{backend} backend, {result['scanned']} scanned per query")
+    print(f"  load      {load_ms:>10.1f} ms")
+    print(f"  search    p50 {result['p50_ms']:.3f} ms  p95 {result['p95_ms']:.3f} ms  p99 {result['p99_ms']:.3f} ms"
+          f"  ({result['queries_per_s']} queries/s, top {args.k})")
+
+
+if __name__ == '__main__':
+    main()
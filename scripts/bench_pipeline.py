@@ -0,0 +1,386 @@
+#!/usr/bin/python
+"""
+Offline benchmark suite for the update pipeline
+
+Drives lambda_handler (webhook and polling mode) against the in-process
+stand-ins in local_backends.py, so it needs neither AWS nor Telegram nor
+Ollama. Each backend can be given an injected per-request latency to model a
+real network.
+
+Covers every command in handle_command, chat turns, document imports and
+polling batches. For each case it reports throughput (updates per second,
+so a polling invocation counts every update it processed), p50/p95/p99 latency,
+backend requests per operation and bytes moved, and it can save the results
+as a JSON baseline and diff a later run against it.
+
+Usage:
+    python scripts/bench_pipeline.py
+    python scripts/bench_pipeline.py --ddb-ms 5 --s3-ms 20 --telegram-ms 40 --ollama-ms 300
+    python scripts/bench_pipeline.py --save baseline.json
+    python scripts/bench_pipeline.py --baseline baseline.json --tolerance 15
+    python scripts/bench_pipeline.py --cases 'history|export' --iterations 200
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+sys.path.insert(0, SCRIPT_DIR)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('METRICS_SINK', 'emf')  # same per-invocation cost as in Lambda
+
+import handler  # noqa: E402
+from local_backends import LocalBackends, make_update  # noqa: E402
+
+# Measure the handler, not Telegram's pacing: every case talks to one chat
+# far faster than the 1 msg/s a real chat allows
+handler.SEND_CHAT_RATE = 0
+handler.SEND_GLOBAL_RATE = 0
+# Same for per-user limits: one user sends every request
+handler.RATE_LIMITS = ''
+
+USER_ID = 1001
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def webhook_event(update: Dict[str, Any]) -> Dict[str, Any]:
+    return {'body': json.dumps(update)}
+
+
+def command_event(text: str, user_id: int = USER_ID, update_id: int = 1) -> Dict[str, Any]:
+    return webhook_event(make_update(update_id, user_id, text))
+
+
+def seed_sessions(user_id: int, sessions: int, messages: int, active_index: int = 0):
+    """Write sessions straight to storage (faster than replaying chat turns)."""
+    now = int(time.time())
+    for s in range(sessions):
+        session_id = f"seed-{user_id}-{s:04d}"
+        conversation = [
+            {'role': 'user' if i % 2 == 0 else 'assistant', 'content': f"message {i} of session {s} " * 4,
+             'ts': now - (messages - i) * 60}
+            for i in range(messages)
+        ]
+        handler.db_put_item({
+            'pk': user_id,
+            'sk': f"MODEL#llama3#SESSION#{session_id}",
+            'model_name': 'llama3',
+            'session_id': session_id,
+            'is_active': 1 if s == active_index else 0,
+            'last_message_ts': now,
+            'conversation': conversation,
+            'user_id': user_id,
+            's3_path': '',
+        })
+
+
+def seed_archives(user_id: int, count: int, messages: int):
+    for a in range(count):
+        handler.put_archive(user_id, {
+            'user_id': user_id,
+            'session_id': f"archived-{user_id}-{a:04d}",
+            'model_name': 'llama3',
+            'conversation': [{'role': 'user' if i % 2 == 0 else 'assistant', 'content': f"old message {i}",
+                              'ts': 1700000000 + i} for i in range(messages)],
+            'archived_at': '2025-01-01T00:00:00Z',
+            'archive_version': '1.0'
+        }, {'user_id': str(user_id)})
+
+
+def seed_usage(users: int):
+    """Count some activity for `users` users (USER_ID first) through the usage counters."""
+    for u in range(users):
+        handler.count_usage(USER_ID + u, 'messages', 'llama3', 20 + u)
+        handler.count_usage(USER_ID + u, 'sessions', 'llama3')
+        handler.count_usage(USER_ID + u, 'archives', 'llama3')
+    handler.flush_usage()
+
+
+def seed_memory(user_id: int, count: int, batch: int = 500):
+    """Embed count remembered messages into memory segments through the fake Ollama."""
+    for start in range(0, count, batch):
+        texts = [f"earlier message {i} about topic {i % 97}" for i in range(start, min(start + batch, count))]
+        handler.db_update_item({'pk': user_id, 'sk': handler.MEMORY_SK}, 'ADD pending :texts', {':texts': set(texts)})
+        handler.flush_memory_batch(user_id, sorted(texts))
+
+
+def seed_search_index(user_id: int, sessions: int, messages: int, per_segment: int = 10000):
+    """Index sessions x messages synthetic docs straight into search segments."""
+    words = ['alpha', 'budget', 'cello', 'dinner', 'engine', 'forest', 'garden', 'harbor', 'invoice', 'jacket']
+    docs = [[f"indexed-{s:05d}", i, 1700000000 + s * 3600 + i,
+             f"message {i} of session {s} about {words[(s + i) % 10]} and topic {s % 97}"]
+            for s in range(sessions) for i in range(messages)]
+    for start in range(0, len(docs), per_segment):
+        key = f"{handler.SEARCH_PREFIX}/{user_id}/seed{start // per_segment:04d}.idx"
+        handler.commit_segment(user_id, handler.SEARCH_SK, key, handler.encode_search_segment(docs[start:start + per_segment]))
+
+
+def archive_document(messages: int) -> bytes:
+    return json.dumps({
+        'session_id': 'exported',
+        'model_name': 'llama3',
+        'conversation': [{'role': 'user' if i % 2 == 0 else 'assistant', 'content': f"imported message {i}",
+                          'ts': 1700000000 + i} for i in range(messages)],
+    }, indent=2).encode('utf-8')
+
+
+class Case:
+    """A named scenario: setup() seeds state, op(i) returns the event for iteration i."""
+
+    def __init__(self, name: str, op: Callable[[int], Dict[str, Any]], setup: Callable[[], None] = None,
+                 config: Dict[str, Any] = None):
+        self.name = name
+        self.op = op
+        self.setup = setup or (lambda: None)
+        self.config = config or {}
+
+
+class Context:
+    """The backends of the case currently running (set by run_case)."""
+    backends: LocalBackends = None
+
+
+def build_cases(args, ctx: Context) -> List[Case]:
+    # Warmup runs use iterations n..n+warmup-1, so seed enough distinct targets
+    n = args.iterations + args.warmup
+    sessions, messages = args.sessions, args.messages
+
+    def with_sessions():
+        seed_sessions(USER_ID, sessions, messages)
+
+    def with_memory():
+        seed_sessions(USER_ID, sessions, messages)
+        seed_memory(USER_ID, args.memory_vectors)
+
+    def with_search_index():
+        seed_sessions(USER_ID, sessions, messages)
+        seed_search_index(USER_ID, args.search_sessions, args.messages)
+
+    def with_archives():
+        seed_sessions(USER_ID, sessions, messages)
+        seed_archives(USER_ID, max(n, 1), args.archive_messages)
+
+    def with_export_archives():
+        seed_sessions(USER_ID, sessions, messages)
+        seed_archives(USER_ID, args.export_archives, args.archive_messages)
+
+    def with_usage():
+        seed_sessions(USER_ID, sessions, messages)
+        seed_usage(args.usage_users)
+
+    def with_many_sessions_to_archive():
+        seed_sessions(USER_ID, n + 1, messages)
+
+    def with_document():
+        ctx.backends.telegram.add_file('bench-archive', archive_document(args.import_messages))
+
+    def document_event(i):
+        content = ctx.backends.telegram.files['bench-archive']
+        return webhook_event(make_update(i + 1, USER_ID, document={
+            'file_id': 'bench-archive', 'file_name': 'archive.json', 'mime_type': 'application/json',
+            'file_size': len(content)}))
+
+    state = {'next_update': 1}
+
+    def with_polling():
+        seed_sessions(USER_ID, sessions, messages)
+        handler.save_offset(1)
+        state['next_update'] = 1
+
+    def polling_event(i):
+        # Queue a fresh mixed batch, then invoke in polling mode
+        texts = ['/help', 'hello there', '/history', 'how are you?', '/listsessions']
+        batch = []
+        for j in range(args.batch):
+            uid = USER_ID + (j % args.batch_users)
+            batch.append(make_update(state['next_update'], uid, texts[j % len(texts)]))
+            state['next_update'] += 1
+        ctx.backends.telegram.updates = batch
+        return {}
+
+    commands = [
+        Case('cmd_start', lambda i: command_event('/start'), with_sessions),
+        Case('cmd_hello', lambda i: command_event('/hello'), with_sessions),
+        Case('cmd_help', lambda i: command_event('/help')),
+        Case('cmd_status', lambda i: command_event('/status')),
+        Case('cmd_echo', lambda i: command_event('/echo benchmark')),
+        Case('cmd_unknown', lambda i: command_event('/nope')),
+        Case('cmd_newsession', lambda i: command_event('/newsession'), with_sessions),
+        Case('cmd_listsessions', lambda i: command_event('/listsessions'), with_sessions),
+        Case('cmd_switch', lambda i: command_event(f"/switch {i % sessions + 1}"), with_sessions),
+        Case('cmd_history', lambda i: command_event('/history'), with_sessions),
+        Case('cmd_history_deep', lambda i: command_event('/history 50'), with_sessions),
+        Case('cmd_archive_list', lambda i: command_event('/archive'), with_sessions),
+        Case('cmd_archive', lambda i: command_event('/archive 1'), with_many_sessions_to_archive),
+        Case('cmd_listarchives', lambda i: command_event('/listarchives'), with_archives),
+        Case('cmd_export', lambda i: command_event(f"/export {i % n + 1}"), with_archives),
+        Case('cmd_export_all', lambda i: command_event('/export all'), with_export_archives),
+        Case('cmd_restore', lambda i: command_event(f"/restore {i + 1}"), with_archives),
+        Case('cmd_stats', lambda i: command_event('/stats'), with_usage),
+        Case('cmd_stats_admin', lambda i: command_event('/stats 7'), with_usage,
+             config={'ADMIN_USER_IDS': frozenset([USER_ID])}),
+        Case('cmd_search', lambda i: command_event(f"/search cello topic {i % 97}"), with_search_index),
+        Case('chat_turn', lambda i: command_event(f"tell me something {i}"), with_sessions),
+        Case('chat_turn_ollama', lambda i: command_event(f"tell me something {i}"), with_sessions,
+             config={'OLLAMA_ENABLED': True}),
+        Case('chat_turn_memory', lambda i: command_event(f"tell me about topic {i}"), with_memory,
+             config={'OLLAMA_ENABLED': True, 'MEMORY_ENABLED': True}),
+        Case('document_import', document_event, with_document),
+        Case('polling_batch', polling_event, with_polling),
+    ]
+    return commands
+
+
+def run_case(case: Case, ctx: Context, args) -> Dict[str, Any]:
+    backends = LocalBackends(args.ddb_ms, args.s3_ms, args.telegram_ms, args.ollama_ms, args.reply_chars)
+    ctx.backends = backends.install(handler)
+    saved = {k: getattr(handler, k) for k in case.config}
+    for key, value in case.config.items():
+        setattr(handler, key, value)
+
+    sink = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(sink):
+            case.setup()
+            for i in range(args.warmup):
+                handler.lambda_handler(case.op(args.iterations + i), None)
+        backends.reset_stats()
+
+        latencies = []
+        errors = 0
+        units = 0
+        started = time.perf_counter()
+        for i in range(args.iterations):
+            event = case.op(i)
+            sink.seek(0)
+            sink.truncate()
+            with contextlib.redirect_stdout(sink):
+                t0 = time.perf_counter()
+                result = handler.lambda_handler(event, None)
+                latencies.append((time.perf_counter() - t0) * 1000.0)
+            body = result.get('body')
+            # Polling invocations count every update they processed
+            units += body.get('processed_count', 1) if isinstance(body, dict) else 1
+            if result.get('statusCode') != 200 or (isinstance(body, str) and not json.loads(body).get('ok')):
+                errors += 1
+        elapsed = time.perf_counter() - started
+    finally:
+        for key, value in saved.items():
+            setattr(handler, key, value)
+
+    latencies.sort()
+    ops = len(latencies)
+    stats = backends.stats()
+    return {
+        'ops': ops,
+        'errors': errors,
+        'throughput_per_s': round(units / elapsed, 2) if elapsed else 0.0,
+        'units_per_op': round(units / ops, 2) if ops else 0.0,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'requests_per_op': {name: round(s['requests'] / ops, 2) for name, s in stats.items()},
+        'bytes_per_op': {name: round((s['bytes_in'] + s['bytes_out']) / ops) for name, s in stats.items()},
+        'calls': {name: s['calls'] for name, s in stats.items() if s['calls']},
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Return a list of regressions against a saved baseline."""
+    regressions = []
+    print(f"\n{'case':<20}{'p50 base':>10}{'p50 now':>10}{'delta':>9}  requests/op (base -> now)")
+    print('-' * 90)
+    for name, now in results.items():
+        base = baseline.get('cases', {}).get(name)
+        if not base:
+            continue
+        delta = (now['p50_ms'] - base['p50_ms']) / base['p50_ms'] * 100 if base['p50_ms'] else 0.0
+        req_changes = []
+        for backend, value in now['requests_per_op'].items():
+            before = base['requests_per_op'].get(backend, 0)
+            if value != before:
+                req_changes.append(f"{backend} {before}->{value}")
+                if value > before:
+                    regressions.append(f"{name}: {backend} requests/op {before} -> {value}")
+        if delta > tolerance:
+            regressions.append(f"{name}: p50 {base['p50_ms']}ms -> {now['p50_ms']}ms (+{delta:.0f}%)")
+        print(f"{name:<20}{base['p50_ms']:>10.2f}{now['p50_ms']:>10.2f}{delta:>+8.0f}%  {', '.join(req_changes) or '='}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--cases', default='', help='regex filter on case names')
+    parser.add_argument('--sessions', type=int, default=5, help='sessions seeded per user')
+    parser.add_argument('--messages', type=int, default=20, help='messages per seeded session')
+    parser.add_argument('--archive-messages', type=int, default=200, help='messages per seeded archive')
+    parser.add_argument('--export-archives', type=int, default=20, help='archives seeded for /export all')
+    parser.add_argument('--usage-users', type=int, default=50, help='users with usage counters seeded for /stats')
+    parser.add_argument('--import-messages', type=int, default=500, help='messages in the imported document')
+    parser.add_argument('--search-sessions', type=int, default=2000, help='indexed sessions seeded for /search')
+    parser.add_argument('--memory-vectors', type=int, default=2000, help='remembered messages seeded for memory')
+    parser.add_argument('--batch', type=int, default=20, help='updates per polling batch')
+    parser.add_argument('--batch-users', type=int, default=5, help='distinct users in a polling batch')
+    parser.add_argument('--reply-chars', type=int, default=400, help='length of fake Ollama replies')
+    parser.add_argument('--ddb-ms', type=float, default=0.0, help='injected DynamoDB latency per request')
+    parser.add_argument('--s3-ms', type=float, default=0.0, help='injected S3 latency per request')
+    parser.add_argument('--telegram-ms', type=float, default=0.0, help='injected Telegram latency per request')
+    parser.add_argument('--ollama-ms', type=float, default=0.0, help='injected Ollama latency per request')
+    parser.add_argument('--save', default='', help='write results as a JSON baseline')
+    parser.add_argument('--baseline', default='', help='compare against a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=20.0, help='allowed p50 regression in percent')
+    args = parser.parse_args()
+
+    pattern = re.compile(args.cases) if args.cases else None
+    ctx = Context()
+    cases = [c for c in build_cases(args, ctx) if not pattern or pattern.search(c.name)]
+
+    results = {}
+    print(f"{'case':<20}{'upd/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'ddb':>6}{'s3':>6}{'tg':>6}{'llm':>6}{'KB/op':>9}{'err':>5}")
+    print('-' * 95)
+    for case in cases:
+        r = run_case(case, ctx, args)
+        results[case.name] = r
+        req = r['requests_per_op']
+        kb = sum(r['bytes_per_op'].values()) / 1024
+        print(f"{case.name:<20}{r['throughput_per_s']:>10.1f}{r['p50_ms']:>9.2f}{r['p95_ms']:>9.2f}{r['p99_ms']:>9.2f}"
+              f"{req['dynamodb']:>6.1f}{req['s3']:>6.1f}{req['telegram']:>6.1f}{req['ollama']:>6.1f}"
+              f"{kb:>9.1f}{r['errors']:>5}")
+
+    if args.save:
+        meta = {k: v for k, v in vars(args).items() if k not in ('save', 'baseline', 'cases')}
+        with open(args.save, 'w') as f:
+            json.dump({'meta': meta, 'cases': results}, f, indent=2, sort_keys=True)
+        print(f"\nSaved baseline to {args.save}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for line in regressions:
+                print(f"  - {line}")
+            sys.exit(1)
+        print("\nNo regressions against baseline.")
+
+
+if __name__ == '__main__':
+    main()
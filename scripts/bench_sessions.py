@@ -0,0 +1,116 @@
+#!/usr/bin/python
+"""
+Session item decoding benchmark
+
+Builds a session item with --messages conversation turns as the low-level
+DynamoDB client returns it (an attribute-value map) and times decoding it
+two ways: the generic boto3 TypeDeserializer, which turns every turn into a
+dict of Decimals, and handler.from_dynamo, which decodes turns into Message
+objects. Encoding back (TypeSerializer vs handler.to_dynamo) is timed too.
+Memory is the size of the decoded item as measured by tracemalloc.
+
+Usage:
+    python scripts/bench_sessions.py
+    python scripts/bench_sessions.py --messages 1000 10000 --iterations 20
+    python scripts/bench_sessions.py --json
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+sys.path.insert(0, SCRIPT_DIR)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import handler  # noqa: E402
+from bench_pipeline import percentile  # noqa: E402
+
+WORDS = ('the', 'model', 'session', 'archive', 'message', 'reply', 'weather', 'today', 'python', 'lambda')
+
+
+def session_item(messages: int, rng: random.Random):
+    conversation = []
+    ts = 1700000000
+    for i in range(messages):
+        ts += rng.randint(1, 120)
+        content = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 40)))
+        conversation.append({'role': 'user' if i % 2 == 0 else 'assistant', 'content': content, 'ts': ts})
+    item = {'pk': 1001, 'sk': 'MODEL#llama3#SESSION#bench', 'model_name': 'llama3', 'session_id': 'bench',
+            'is_active': 1, 'last_message_ts': ts, 'user_id': 1001, 's3_path': '', 'conversation': conversation}
+    handler._load_type_codecs()
+    return {k: handler._serializer.serialize(v) for k, v in item.items()}
+
+
+def generic_decode(av):
+    return {k: handler._deserializer.deserialize(v) for k, v in av.items()}
+
+
+def generic_encode(item):
+    return {k: handler._serializer.serialize(v) for k, v in item.items()}
+
+
+def time_ms(fn, arg, iterations: int):
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn(arg)
+        samples.append((time.perf_counter() - started) * 1000.0)
+    samples.sort()
+    return samples
+
+
+def decoded_bytes(fn, av) -> int:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    item = fn(av)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del item
+    return size
+
+
+def measure(messages: int, iterations: int, rng: random.Random):
+    av = session_item(messages, rng)
+    generic_item, fast_item = generic_decode(av), handler.from_dynamo(av)
+    assert [dict(m) for m in fast_item['conversation']] == generic_item['conversation']
+    assert handler.to_dynamo(fast_item) == av
+    row = {'messages': messages, 'item_kb': round(len(json.dumps(av)) / 1024, 1)}
+    for name, fn, arg in (('decode_generic', generic_decode, av), ('decode_fast', handler.from_dynamo, av),
+                          ('encode_generic', generic_encode, generic_item), ('encode_fast', handler.to_dynamo, fast_item)):
+        samples = time_ms(fn, arg, iterations)
+        row[f'{name}_p50_ms'] = round(percentile(samples, 50), 3)
+        row[f'{name}_p95_ms'] = round(percentile(samples, 95), 3)
+    row['memory_generic_kb'] = round(decoded_bytes(generic_decode, av) / 1024, 1)
+    row['memory_fast_kb'] = round(decoded_bytes(handler.from_dynamo, av) / 1024, 1)
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, nargs='+', default=[1000, 10000], help='conversation lengths')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    rows = [measure(n, args.iterations, rng) for n in args.messages]
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    print(f"{'messages':>9} {'item KB':>8}   {'decode generic':>14} {'decode fast':>12}   "
+          f"{'encode generic':>14} {'encode fast':>12}   {'mem generic':>11} {'mem fast':>9}")
+    for row in rows:
+        print(f"{row['messages']:>9} {row['item_kb']:>8}   {row['decode_generic_p50_ms']:>11.2f} ms "
+              f"{row['decode_fast_p50_ms']:>9.2f} ms   {row['encode_generic_p50_ms']:>11.2f} ms "
+              f"{row['encode_fast_p50_ms']:>9.2f} ms   {row['memory_generic_kb']:>8.0f} KB {row['memory_fast_kb']:>6.0f} KB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+"""
+Storage backend benchmark
+
+Runs the same mixed update workload (chat turns, /history, /listsessions,
+/newsession, /switch, /archive, /export) through lambda_handler on each
+storage backend and reports per-update latency (p50/p95/p99) and throughput:
+
+- aws: the DynamoDB and S3 stand-ins from local_backends.py with an injected
+  per-request latency (--ddb-ms, --s3-ms) modelling the network round trip
+- sqlite: storage.SQLiteItemStore + FileObjectStore in a temporary directory
+- memory: storage.MemoryItemStore + MemoryObjectStore
+
+Telegram and Ollama are always the in-process fakes without latency, so the
+difference between rows is the storage layer alone.
+
+Usage:
+    python scripts/bench_storage.py
+    python scripts/bench_storage.py --updates 2000 --users 20 --ddb-ms 5 --s3-ms 20
+    python scripts/bench_storage.py --backends sqlite memory --json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+sys.path.insert(0, SCRIPT_DIR)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import handler  # noqa: E402
+from bench_pipeline import command_event, percentile, seed_sessions  # noqa: E402
+from local_backends import LocalBackends  # noqa: E402
+
+handler.SEND_CHAT_RATE = 0
+handler.SEND_GLOBAL_RATE = 0
+handler.RATE_LIMITS = ''
+
+# (weight, text) - mostly chat turns, like real traffic
+WORKLOAD = (
+    (60, 'tell me something about {i}'),
+    (10, '/history'),
+    (8, '/listsessions'),
+    (5, '/newsession'),
+    (5, '/switch 1'),
+    (5, '/archive 1'),
+    (4, '/status'),
+    (3, '/export 1'),
+)
+
+
+def workload(updates: int, users: int, seed: int):
+    rng = random.Random(seed)
+    weights = [w for w, _ in WORKLOAD]
+    texts = [t for _, t in WORKLOAD]
+    for i in range(updates):
+        text = rng.choices(texts, weights)[0].format(i=i)
+        yield command_event(text, user_id=1001 + rng.randrange(users), update_id=i + 1)
+
+
+def install(backend: str, args, directory: str):
+    local = LocalBackends(args.ddb_ms, args.s3_ms, 0.0, 0.0, args.reply_chars).install(handler)
+    handler.STORAGE_BACKEND = backend
+    handler.STORAGE_PATH = os.path.join(directory, backend)
+    if backend != 'aws':
+        # Let the handler open the local stores itself, as it does in production
+        handler._dynamodb_client = handler._s3_client = None
+    return local
+
+
+def run(backend: str, args, directory: str):
+    install(backend, args, directory)
+    sink = io.StringIO()
+    with contextlib.redirect_stdout(sink):
+        for user in range(args.users):
+            seed_sessions(1001 + user, args.sessions, args.messages)
+        for event in workload(args.warmup, args.users, args.seed + 1):
+            handler.lambda_handler(event, None)
+
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    for event in workload(args.updates, args.users, args.seed):
+        sink.seek(0)
+        sink.truncate()
+        with contextlib.redirect_stdout(sink):
+            t0 = time.perf_counter()
+            result = handler.lambda_handler(event, None)
+            latencies.append((time.perf_counter() - t0) * 1000.0)
+        if result.get('statusCode') != 200:
+            errors += 1
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'backend': backend,
+        'updates': len(latencies),
+        'errors': errors,
+        'throughput_per_s': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', nargs='+', default=['aws', 'sqlite', 'memory'],
+                        choices=['aws', 'sqlite', 'memory'])
+    parser.add_argument('--updates', type=int, default=1000)
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--sessions', type=int, default=3, help='sessions seeded per user')
+    parser.add_argument('--messages', type=int, default=20, help='messages per seeded session')
+    parser.add_argument('--reply-chars', type=int, default=400, help='length of fake Ollama replies')
+    parser.add_argument('--ddb-ms', type=float, default=5.0, help='injected DynamoDB latency for the aws backend')
+    parser.add_argument('--s3-ms', type=float, default=20.0, help='injected S3 latency for the aws backend')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='bench-storage-') as directory:
+        rows = [run(backend, args, directory) for backend in args.backends]
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    print(f"{'backend':<8}{'updates':>9}{'errors':>8}{'upd/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for row in rows:
+        print(f"{row['backend']:<8}{row['updates']:>9}{row['errors']:>8}{row['throughput_per_s']:>10.1f}"
+              f"{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+#!/bin/bash
+#
+# Compact Archives Script
+# Packs loose per-session archives into bundle objects by invoking the
+# Lambda function with the compact_archives maintenance action.
+#
+# Usage:
+#   ./scripts/compact-archives.sh            # Compact archives of every user
+#   ./scripts/compact-archives.sh 123456789  # Compact archives of one user
+#
+
+set -e
+
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+PROJECT_DIR="$(dirname "$SCRIPT_DIR")"
+
+cd "$PROJECT_DIR"
+
+LAMBDA_NAME=$(terraform output -raw lambda_function_name 2>/dev/null || echo "telegram-bot")
+
+if [ -n "$1" ]; then
+    PAYLOAD="{\"action\": \"compact_archives\", \"user_id\": $1}"
+else
+    PAYLOAD='{"action": "compact_archives"}'
+fi
+
+echo "Invoking $LAMBDA_NAME with: $PAYLOAD"
+aws lambda invoke \
+    --function-name "$LAMBDA_NAME" \
+    --cli-binary-format raw-in-base64-out \
+    --payload "$PAYLOAD" \
+    /tmp/compact-archives.json > /dev/null
+
+jq . /tmp/compact-archives.json
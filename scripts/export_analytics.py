@@ -0,0 +1,416 @@
+#!/usr/bin/python
+"""
+Columnar analytics export
+
+Flattens every archived conversation into one row per message and writes
+Parquet (or Arrow IPC) files partitioned by day and model:
+
+    <out>/date=2026-01-31/model=llama3/part-00000.parquet
+
+Columns: user_id, session_id, position, role, ts (UTC timestamp), content,
+content_chars, archived_at, imported. `date` (the message's UTC day) and
+`model` are the directory names, i.e. Hive partitioning, which pyarrow.dataset
+(partitioning='hive'), DuckDB, Spark and Athena all understand. Model names
+are URI-encoded in the path.
+
+Both loose archives/{user_id}/{session_id}.json objects and archives packed
+into bundles are read, through the handler's own archive functions:
+
+- User prefixes are listed page by page and each user's archives are listed on
+  a pool of --list-workers threads. A user whose listing fails is reported
+  as failed (<user_id>/*), like an archive that cannot be read.
+- Archives are fetched and decoded on a pool of --workers threads. At most
+  four per worker are in flight, so a slow consumer does not pile results up.
+- Rows are buffered per partition, column by column. Once --max-buffered-rows
+  are held, the largest partitions are written out as row groups, so memory
+  stays flat however large the export is.
+- Work is committed every --batch-objects archives: the batch's part files are
+  renamed into place, then <out>/_checkpoint.json records the last archive
+  done. Archives are visited in listing order, so running the same command
+  again after an interruption carries on from there. Part files of an
+  uncommitted batch are removed first.
+
+Progress (objects/s, messages, failures) goes to stderr every few seconds.
+
+pyarrow is only needed here (pip install pyarrow); the Lambda package does not
+include it. The bucket and storage backend come from the same environment as
+the handler (ARCHIVE_BUCKET, STORAGE_BACKEND, STORAGE_PATH, AWS credentials).
+
+Usage:
+    python scripts/export_analytics.py --out analytics/
+    python scripts/export_analytics.py --out analytics/ --format arrow --workers 32
+    python scripts/export_analytics.py --out analytics/ --no-content --restart
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import handler  # noqa: E402
+
+CHECKPOINT_FILE = '_checkpoint.json'
+PART_FILE = re.compile(r'^part-(\d+)\.(parquet|arrow)(\.tmp)?$')
+COLUMNS = ('user_id', 'session_id', 'position', 'role', 'ts', 'content', 'content_chars', 'archived_at', 'imported')
+IN_FLIGHT_PER_WORKER = 4
+USERS_PER_LISTING = 64  # user prefixes listed per round on the listing pool
+PROGRESS_SECONDS = 5.0
+
+
+def get_pyarrow():
+    """pyarrow with its parquet and ipc modules loaded, or None."""
+    try:
+        import pyarrow
+        import pyarrow.ipc  # noqa: F401
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def message_schema(pa):
+    return pa.schema([
+        ('user_id', pa.int64()),
+        ('session_id', pa.string()),
+        ('position', pa.int32()),
+        ('role', pa.string()),
+        ('ts', pa.timestamp('s', tz='UTC')),
+        ('content', pa.string()),
+        ('content_chars', pa.int32()),
+        ('archived_at', pa.string()),
+        ('imported', pa.bool_()),
+    ])
+
+
+# ==================== LISTING AND FETCHING ====================
+
+def user_ids(after: Optional[int]) -> Iterator[int]:
+    """User IDs with archives, in S3 listing order, from `after` (inclusive) on."""
+    start = f"{handler.ARCHIVE_PREFIX}/{after}/" if after is not None else ''
+    paginator = handler.get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=handler.ARCHIVE_BUCKET, Prefix=f"{handler.ARCHIVE_PREFIX}/", Delimiter='/'):
+        for common in page.get('CommonPrefixes', []):
+            if common['Prefix'] < start:
+                continue
+            user = common['Prefix'].rstrip('/').split('/')[-1]
+            if user.isdigit():
+                yield int(user)
+
+
+def list_user(user_id: int) -> Optional[List[Dict[str, Any]]]:
+    try:
+        return handler.scan_user_archives(user_id)
+    except Exception as e:
+        log(f"Could not list archives of user {user_id}: {e}")
+        return None
+
+
+def list_archives(pool: ThreadPoolExecutor, cursor: Optional[Dict[str, Any]],
+                  failed: List[str]) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """
+    (user_id, listing entry) for every archive after the checkpoint cursor,
+    users listed in parallel. Users whose listing fails are added to `failed`
+    as "<user_id>/*".
+    """
+    users = user_ids(cursor['user_id'] if cursor else None)
+    while True:
+        block = list(islice(users, USERS_PER_LISTING))
+        if not block:
+            return
+        for user_id, archives in zip(block, pool.map(list_user, block)):
+            if archives is None:
+                failed.append(f"{user_id}/*")
+                continue
+            for archive in archives:
+                if cursor and user_id == cursor['user_id'] and archive['session_id'] <= cursor['session_id']:
+                    continue
+                yield user_id, archive
+
+
+def fetch_archives(pool: ThreadPoolExecutor, listing, window: int):
+    """(user_id, listing entry, archive or None) in listing order, with at most `window` fetches in flight."""
+    pending = deque()
+    for user_id, entry in listing:
+        pending.append((user_id, entry, pool.submit(handler.get_archive_from_s3, user_id, entry['session_id'])))
+        if len(pending) >= window:
+            user_id, entry, future = pending.popleft()
+            yield user_id, entry, future.result()
+    while pending:
+        user_id, entry, future = pending.popleft()
+        yield user_id, entry, future.result()
+
+
+# ==================== ROWS ====================
+
+_days: Dict[int, str] = {}
+
+
+def utc_day(ts: int) -> str:
+    day = _days.get(ts // 86400)
+    if day is None:
+        day = _days[ts // 86400] = datetime.utcfromtimestamp(ts - ts % 86400).strftime('%Y-%m-%d')
+    return day
+
+
+def archive_rows(user_id: int, archive: Dict[str, Any], with_content: bool):
+    """Yield ((date, model), row) per message. Messages without a timestamp take the session's last one."""
+    session_id = str(archive.get('session_id', ''))
+    model = str(archive.get('model_name') or 'unknown')
+    archived_at = str(archive.get('archived_at', ''))
+    imported = 'imported_at' in archive
+    try:
+        fallback_ts = int(archive.get('last_message_ts') or 0)
+    except (TypeError, ValueError):
+        fallback_ts = 0
+    for position, message in enumerate(archive.get('conversation') or []):
+        if not isinstance(message, dict):
+            continue
+        try:
+            ts = int(message.get('ts') or 0) or fallback_ts
+        except (TypeError, ValueError):
+            ts = fallback_ts
+        content = message.get('content', '')
+        if not isinstance(content, str):
+            content = str(content)
+        date = utc_day(ts) if ts else (archived_at[:10] or 'unknown')
+        yield (date, model), (user_id, session_id, position, str(message.get('role', '')), ts or None,
+                              content if with_content else None, len(content), archived_at, imported)
+
+
+# ==================== OUTPUT ====================
+
+class BatchWriter:
+    """
+    Buffers the rows of one batch per partition and writes each partition to
+    its own part file. Files are written as `.tmp` and only renamed into place
+    by close(), so a crash mid-batch leaves nothing that looks finished.
+    """
+
+    def __init__(self, pa, out: str, fmt: str, batch: int, max_buffered_rows: int):
+        self.pa = pa
+        self.schema = message_schema(pa)
+        self.out = out
+        self.fmt = fmt
+        self.name = f"part-{batch:05d}.{fmt}"
+        self.max_buffered_rows = max_buffered_rows
+        self.buffers: Dict[Tuple[str, str], List[list]] = {}
+        self.writers: Dict[Tuple[str, str], Any] = {}
+        self.buffered = 0
+        self.rows = 0
+
+    def add(self, partition: Tuple[str, str], row: tuple):
+        columns = self.buffers.get(partition)
+        if columns is None:
+            columns = self.buffers[partition] = [[] for _ in COLUMNS]
+        for column, value in zip(columns, row):
+            column.append(value)
+        self.buffered += 1
+        self.rows += 1
+        if self.buffered >= self.max_buffered_rows:
+            self.spill(self.max_buffered_rows // 2)
+
+    def spill(self, keep: int):
+        """Write out the largest partitions until at most `keep` rows are buffered."""
+        for partition in sorted(self.buffers, key=lambda p: len(self.buffers[p][0]), reverse=True):
+            if self.buffered <= keep:
+                break
+            self.write(partition)
+
+    def write(self, partition: Tuple[str, str]):
+        columns = self.buffers.pop(partition)
+        table = self.pa.Table.from_arrays(
+            [self.pa.array(values, type=field.type) for values, field in zip(columns, self.schema)],
+            schema=self.schema
+        )
+        writer = self.writers.get(partition)
+        if writer is None:
+            directory = self.partition_dir(partition)
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, self.name + '.tmp')
+            if self.fmt == 'parquet':
+                writer = self.pa.parquet.ParquetWriter(path, self.schema, compression='zstd')
+            else:
+                writer = self.pa.ipc.new_file(path, self.schema)
+            self.writers[partition] = writer
+        writer.write_table(table)
+        self.buffered -= table.num_rows
+
+    def partition_dir(self, partition: Tuple[str, str]) -> str:
+        date, model = partition
+        return os.path.join(self.out, f"date={date}", f"model={quote(model, safe='')}")
+
+    def close(self) -> int:
+        """Write what is buffered, finish every file and rename it into place. Returns the file count."""
+        for partition in list(self.buffers):
+            self.write(partition)
+        for partition, writer in self.writers.items():
+            writer.close()
+            path = os.path.join(self.partition_dir(partition), self.name)
+            os.replace(path + '.tmp', path)
+        return len(self.writers)
+
+
+def part_files(out: str) -> Iterator[Tuple[str, int, bool]]:
+    """(path, batch number, unfinished) of every part file under `out`."""
+    for directory, _, files in os.walk(out):
+        for name in files:
+            match = PART_FILE.match(name)
+            if match:
+                yield os.path.join(directory, name), int(match.group(1)), bool(match.group(3))
+
+
+def remove_parts(out: str, from_batch: int) -> int:
+    """Delete unfinished part files and those of batches >= from_batch, then empty partition directories."""
+    removed = 0
+    for path, batch, unfinished in list(part_files(out)):
+        if unfinished or batch >= from_batch:
+            os.remove(path)
+            removed += 1
+    for directory, dirs, files in os.walk(out, topdown=False):
+        if directory != out and not dirs and not files and os.path.basename(directory).startswith(('date=', 'model=')):
+            os.rmdir(directory)
+    return removed
+
+
+def load_checkpoint(out: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(out, CHECKPOINT_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_checkpoint(out: str, state: Dict[str, Any]):
+    path = os.path.join(out, CHECKPOINT_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def new_state(args) -> Dict[str, Any]:
+    return {'format': args.format, 'content': not args.no_content, 'batch': 0, 'cursor': None,
+            'objects': 0, 'messages': 0, 'bytes': 0, 'files': 0, 'failed': [], 'complete': False}
+
+
+# ==================== EXPORT ====================
+
+def export(args, pa) -> Dict[str, Any]:
+    os.makedirs(args.out, exist_ok=True)
+    state = None if args.restart else load_checkpoint(args.out)
+    if state and state['complete']:
+        log(f"{args.out} already holds a complete export; use --restart to redo it")
+        return dict(state, resumed=True, objects_per_s=0.0, elapsed_s=0.0)
+    if state and (state['format'], state['content']) != (args.format, not args.no_content):
+        raise SystemExit(f"{args.out} was started with --format {state['format']}"
+                         f"{'' if state['content'] else ' --no-content'}; use the same options or --restart")
+    resumed = state is not None
+    if state is None:
+        state = new_state(args)
+    removed = remove_parts(args.out, state['batch'])
+    if resumed:
+        log(f"Resuming after {state['objects']} objects at batch {state['batch']} ({removed} stale files removed)")
+
+    handler.POOL_CONNECTIONS = max(handler.POOL_CONNECTIONS, args.workers + args.list_workers)
+    handler.get_s3_client()  # create it before the pools share it
+
+    objects = messages = 0
+    started = last_report = time.monotonic()
+    writer = None
+    in_batch = 0
+
+    def commit():
+        nonlocal writer, in_batch
+        state['files'] += writer.close()
+        state['batch'] += 1
+        save_checkpoint(args.out, state)
+        writer, in_batch = None, 0
+
+    with ThreadPoolExecutor(args.list_workers, thread_name_prefix='list') as list_pool, \
+            ThreadPoolExecutor(args.workers, thread_name_prefix='fetch') as fetch_pool:
+        listing = list_archives(list_pool, state['cursor'], state['failed'])
+        for user_id, entry, archive in fetch_archives(fetch_pool, listing, args.workers * IN_FLIGHT_PER_WORKER):
+            if writer is None:
+                writer = BatchWriter(pa, args.out, args.format, state['batch'], args.max_buffered_rows)
+            if archive is None:
+                state['failed'].append(f"{user_id}/{entry['session_id']}")
+            else:
+                before = writer.rows
+                for partition, row in archive_rows(user_id, archive, not args.no_content):
+                    writer.add(partition, row)
+                messages += writer.rows - before
+                state['messages'] += writer.rows - before
+                state['bytes'] += entry['size']
+            objects += 1
+            state['objects'] += 1
+            state['cursor'] = {'user_id': user_id, 'session_id': entry['session_id']}
+            in_batch += 1
+            if in_batch >= args.batch_objects:
+                commit()
+
+            now = time.monotonic()
+            if now - last_report >= PROGRESS_SECONDS:
+                last_report = now
+                log(f"{state['objects']} objects  {objects / (now - started):.1f} obj/s  "
+                    f"{state['messages']} messages  {len(state['failed'])} failed")
+
+    if writer is not None:
+        commit()
+    state['complete'] = True
+    save_checkpoint(args.out, state)
+
+    elapsed = time.monotonic() - started
+    return dict(state, resumed=resumed, run_objects=objects, run_messages=messages, elapsed_s=round(elapsed, 3),
+                objects_per_s=round(objects / elapsed, 1) if elapsed else 0.0)
+
+
+def log(line: str):
+    print(line, file=sys.stderr, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', required=True, help='output directory (also holds the checkpoint)')
+    parser.add_argument('--format', choices=['parquet', 'arrow'], default='parquet')
+    parser.add_argument('--workers', type=int, default=16, help='threads fetching archives')
+    parser.add_argument('--list-workers', type=int, default=4, help='threads listing user prefixes')
+    parser.add_argument('--batch-objects', type=int, default=1000, help='archives per committed batch')
+    parser.add_argument('--max-buffered-rows', type=int, default=200000, help='rows held before writing row groups')
+    parser.add_argument('--no-content', action='store_true', help='leave message text out (content_chars is kept)')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint and export from scratch')
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+    args = parser.parse_args()
+
+    pa = get_pyarrow()
+    if pa is None:
+        raise SystemExit("pyarrow is required for the analytics export: pip install pyarrow")
+
+    summary = export(args, pa)
+    failed = summary.pop('failed')
+    summary['failed'] = len(failed)
+    if args.json:
+        print(json.dumps(dict(summary, failed_archives=failed), indent=2))
+        return
+    print(f"{summary['objects']} objects ({summary['bytes'] / 1e6:.1f} MB), {summary['messages']} messages, "
+          f"{summary['files']} files, {summary['failed']} failed")
+    print(f"{summary.get('run_objects', 0)} objects this run in {summary['elapsed_s']:.1f}s: "
+          f"{summary['objects_per_s']:.1f} objects/s")
+    for archive in failed:
+        print(f"failed: {archive}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+"""
+Bulk archive export
+
+Writes every archive of one or more users to ZIP files on disk, the way
+/export all sends them to Telegram (see ZIP EXPORT in handler.py):
+
+    <out>/archives_<user_id>.zip                       if it fits in one part
+    <out>/archives_<user_id>_part1.zip, _part2.zip...  otherwise
+
+Entries are the archives' JSON as stored, named archive_<number>_<session>.json
+with the numbers /listarchives shows, and each part is a complete ZIP. The
+archives are fetched --workers at a time and written to the file as they
+arrive, so memory stays at a few archives whatever the export's size. Parts
+are written as .tmp files and renamed once complete.
+
+The bucket and storage backend come from the same environment as the handler
+(ARCHIVE_BUCKET, STORAGE_BACKEND, STORAGE_PATH, AWS credentials).
+
+Usage:
+    python scripts/export_archives.py 123456789 --out exports/
+    python scripts/export_archives.py 123456789 987654321 --out exports/ --part-bytes 0
+    python scripts/export_archives.py 123456789 --out exports/ --from 40
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import handler  # noqa: E402
+
+
+def export_user(user_id: int, args) -> dict:
+    started = time.perf_counter()
+    archives = handler.scan_user_archives(user_id)  # a failed listing must not look like no archives
+    paths = []
+
+    def new_part(number: int):
+        paths.append(os.path.join(args.out, f"archives_{user_id}_part{number}.zip"))
+        return open(paths[-1] + '.tmp', 'wb')
+
+    def finish_part(number: int, out, numbers) -> bool:
+        out.close()
+        os.replace(paths[number - 1] + '.tmp', paths[number - 1])
+        print(f"user {user_id}: {os.path.basename(paths[number - 1])} archives {numbers[0]}-{numbers[-1]} "
+              f"({os.path.getsize(paths[number - 1]) / 1e6:.1f} MB)", file=sys.stderr)
+        return True
+
+    result = handler.export_archives_zip(user_id, archives, new_part, finish_part, max(args.start - 1, 0),
+                                         args.part_bytes or handler.ZIP_MAX_BYTES, args.workers)
+    if len(paths) == 1:
+        single = os.path.join(args.out, f"archives_{user_id}.zip")
+        os.replace(paths[0], single)
+        paths = [single]
+    return dict(result, user_id=user_id, archives=len(archives), files=paths,
+                elapsed_s=round(time.perf_counter() - started, 2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('user_ids', type=int, nargs='+')
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument('--part-bytes', type=int, default=handler.EXPORT_PART_BYTES,
+                        help='largest part in bytes, 0 = one file (up to the 4 GiB ZIP limit)')
+    parser.add_argument('--workers', type=int, default=16, help='threads fetching archives')
+    parser.add_argument('--from', dest='start', type=int, default=1, help='first archive number to export')
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    results = [export_user(user_id, args) for user_id in args.user_ids]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for r in results:
+        print(f"user {r['user_id']}: {r['exported']} of {r['archives']} archives in {r['parts']} files, "
+              f"{r['elapsed_s']:.1f}s")
+        if r['failed']:
+            print(f"  could not read: {', '.join(map(str, r['failed']))}")
+        if r['too_large']:
+            print(f"  larger than --part-bytes: {', '.join(map(str, r['too_large']))}")
+
+
+if __name__ == '__main__':
+    main()
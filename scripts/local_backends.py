@@ -0,0 +1,523 @@
+"""
+In-process stand-ins for the services handler.py talks to
+
+- FakeDynamoDB: the subset of the low-level DynamoDB client API the handler uses
+- FakeS3: put/get (with Range)/delete/list, including paginators, with ETags and IfMatch/IfNoneMatch
+- FakeHTTP: a requests.Session look-alike serving the Telegram Bot API and Ollama
+
+Every backend counts requests and bytes moved and can inject a fixed latency
+per request, so benchmarks can model a real network without one. Used by
+bench_pipeline.py and replay_updates.py; install() wires them into handler.
+"""
+
+import copy
+import datetime
+import json
+import json as _json  # request() takes a `json` argument, like requests
+import re
+import threading
+import time
+from decimal import Decimal
+from typing import Any, Dict, List, Optional
+
+# Expression evaluation and the S3 body are shared with the local storage backends
+from storage import (ConditionalCheckFailedException, NoSuchKey, S3Error, _apply_update, _Body,  # noqa: F401
+                     _check_conditions, _etag, _Expr)
+
+
+class Backend:
+    """Request/byte counters plus optional per-request latency."""
+
+    def __init__(self, name: str, latency_ms: float = 0.0):
+        self.name = name
+        self.latency_ms = latency_ms
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.calls: Dict[str, int] = {}
+
+    def _record(self, op: str, sent: int = 0, received: int = 0):
+        with self._lock:
+            self.requests += 1
+            self.bytes_out += sent
+            self.bytes_in += received
+            self.calls[op] = self.calls.get(op, 0) + 1
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000.0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {'requests': self.requests, 'bytes_out': self.bytes_out, 'bytes_in': self.bytes_in,
+                'calls': dict(self.calls)}
+
+
+def _size(obj: Any) -> int:
+    return len(json.dumps(obj, default=str))
+
+
+# ==================== DYNAMODB ====================
+
+class FakeDynamoDB(Backend):
+    """Single-table, typed-attribute store with the low-level client's method signatures."""
+
+    class exceptions:
+        ConditionalCheckFailedException = ConditionalCheckFailedException
+
+    def __init__(self, latency_ms: float = 0.0):
+        super().__init__('dynamodb', latency_ms)
+        self.tables: Dict[str, Dict[tuple, Dict[str, Any]]] = {}
+
+    @staticmethod
+    def _key(key: Dict[str, Any]) -> tuple:
+        pk, sk = key['pk'], key['sk']
+        return (Decimal(pk['N']) if 'N' in pk else pk['S'], sk.get('S', sk.get('N')))
+
+    def _table(self, name: str) -> Dict[tuple, Dict[str, Any]]:
+        return self.tables.setdefault(name, {})
+
+    def _check(self, item, condition, names, values):
+        if condition and not _Expr(condition, names, values).condition(item or {}):
+            raise ConditionalCheckFailedException('The conditional request failed')
+
+    def get_item(self, TableName, Key, **kwargs):
+        item = self._table(TableName).get(self._key(Key))
+        self._record('GetItem', _size(Key), _size(item) if item else 0)
+        return {'Item': copy.deepcopy(item)} if item else {}
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, **kwargs):
+        self._record('PutItem', _size(Item))
+        table = self._table(TableName)
+        key = self._key(Item)
+        self._check(table.get(key), ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+        table[key] = copy.deepcopy(Item)
+        return {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues=None,
+                    ExpressionAttributeNames=None, ConditionExpression=None, ReturnValues='NONE', **kwargs):
+        self._record('UpdateItem', _size(Key) + _size(ExpressionAttributeValues or {}))
+        table = self._table(TableName)
+        key = self._key(Key)
+        current = table.get(key)
+        self._check(current, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+        item = copy.deepcopy(current) if current else copy.deepcopy(Key)
+        _apply_update(item, UpdateExpression, ExpressionAttributeNames or {}, ExpressionAttributeValues or {})
+        table[key] = item
+        if ReturnValues in ('ALL_NEW', 'UPDATED_NEW'):
+            return {'Attributes': copy.deepcopy(item)}
+        if ReturnValues == 'ALL_OLD' and current:
+            return {'Attributes': copy.deepcopy(current)}
+        return {}
+
+    def delete_item(self, TableName, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues='NONE', **kwargs):
+        self._record('DeleteItem', _size(Key))
+        table = self._table(TableName)
+        key = self._key(Key)
+        self._check(table.get(key), ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+        current = table.pop(key, None)
+        if ReturnValues == 'ALL_OLD' and current:
+            return {'Attributes': current}
+        return {}
+
+    def query(self, TableName, KeyConditionExpression, ExpressionAttributeValues=None,
+              ExpressionAttributeNames=None, FilterExpression=None, Limit=None,
+              ExclusiveStartKey=None, ScanIndexForward=True, **kwargs):
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        matches = []
+        # Snapshot first: replay_updates.py runs handler invocations on several threads
+        table = dict(self._table(TableName))
+        for key in sorted(table, key=lambda k: (str(k[0]), k[1]), reverse=not ScanIndexForward):
+            item = table[key]
+            if not _Expr(KeyConditionExpression, names, values).condition(item):
+                continue
+            if FilterExpression and not _Expr(FilterExpression, names, values).condition(item):
+                continue
+            matches.append(copy.deepcopy(item))
+        if Limit:
+            matches = matches[:Limit]
+        self._record('Query', _size(values), sum(_size(i) for i in matches))
+        return {'Items': matches, 'Count': len(matches)}
+
+    def scan(self, TableName, **kwargs):
+        items = [copy.deepcopy(i) for i in self._table(TableName).values()]
+        self._record('Scan', 0, sum(_size(i) for i in items))
+        return {'Items': items, 'Count': len(items)}
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        responses = {}
+        received = 0
+        for table_name, request in RequestItems.items():
+            if len(request['Keys']) > 100:
+                raise ValueError('Too many items requested for the BatchGetItem call')
+            found = []
+            for key in request['Keys']:
+                item = self._table(table_name).get(self._key(key))
+                if item:
+                    found.append(copy.deepcopy(item))
+                    received += _size(item)
+            responses[table_name] = found
+        self._record('BatchGetItem', _size(RequestItems), received)
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        sent = 0
+        for table_name, requests in RequestItems.items():
+            for request in requests:
+                if 'PutRequest' in request:
+                    item = request['PutRequest']['Item']
+                    self._table(table_name)[self._key(item)] = copy.deepcopy(item)
+                    sent += _size(item)
+                else:
+                    self._table(table_name).pop(self._key(request['DeleteRequest']['Key']), None)
+        self._record('BatchWriteItem', sent)
+        return {'UnprocessedItems': {}}
+
+
+# ==================== S3 ====================
+
+class _Paginator:
+    def __init__(self, s3: 'FakeS3'):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None, PaginationConfig=None, **kwargs):
+        page_size = (PaginationConfig or {}).get('PageSize', 1000)
+        token = None
+        while True:
+            page = self.s3.list_objects_v2(Bucket=Bucket, Prefix=Prefix, Delimiter=Delimiter,
+                                           MaxKeys=page_size, ContinuationToken=token)
+            yield page
+            token = page.get('NextContinuationToken')
+            if not token:
+                return
+
+
+class FakeS3(Backend):
+    class exceptions:
+        NoSuchKey = NoSuchKey
+
+    def __init__(self, latency_ms: float = 0.0):
+        super().__init__('s3', latency_ms)
+        self.objects: Dict[str, Dict[str, Any]] = {}
+
+    def put_object(self, Bucket, Key, Body=b'', IfMatch=None, IfNoneMatch=None, **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        elif hasattr(Body, 'read'):
+            Body = Body.read()
+        self._record('PutObject', len(Body))
+        with self._lock:
+            current = self.objects.get(f"{Bucket}/{Key}")
+            _check_conditions(Key, current['ETag'] if current else None, IfMatch, IfNoneMatch)
+            self.objects[f"{Bucket}/{Key}"] = {
+                'Body': bytes(Body),
+                'ETag': _etag(bytes(Body)),
+                'LastModified': datetime.datetime.now(datetime.timezone.utc),
+                'Metadata': kwargs.get('Metadata', {}),
+                'ContentType': kwargs.get('ContentType', 'binary/octet-stream'),
+            }
+        return {'ETag': _etag(bytes(Body))}
+
+    def _get(self, Bucket, Key):
+        obj = self.objects.get(f"{Bucket}/{Key}")
+        if obj is None:
+            self._record('GetObject')
+            raise NoSuchKey(f"An error occurred (NoSuchKey): {Key}")
+        return obj
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None, **kwargs):
+        obj = self._get(Bucket, Key)
+        _check_conditions(Key, obj['ETag'], IfMatch)
+        body = obj['Body']
+        if Range:
+            start, end = Range[len('bytes='):].split('-')
+            if start == '':
+                body = body[-int(end):]
+            else:
+                body = body[int(start):int(end) + 1 if end else None]
+        self._record('GetObject', 0, len(body))
+        return {'Body': _Body(body), 'ContentLength': len(body), 'Metadata': obj['Metadata'],
+                'LastModified': obj['LastModified'], 'ETag': obj['ETag']}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        obj = self._get(Bucket, Key)
+        self._record('HeadObject')
+        return {'ContentLength': len(obj['Body']), 'Metadata': obj['Metadata'], 'LastModified': obj['LastModified'],
+                'ETag': obj['ETag']}
+
+    def delete_object(self, Bucket, Key, IfMatch=None, **kwargs):
+        self._record('DeleteObject')
+        with self._lock:
+            if IfMatch is not None:
+                current = self.objects.get(f"{Bucket}/{Key}")
+                _check_conditions(Key, current['ETag'] if current else None, IfMatch)
+            self.objects.pop(f"{Bucket}/{Key}", None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self._record('DeleteObjects')
+        for obj in Delete['Objects']:
+            self.objects.pop(f"{Bucket}/{obj['Key']}", None)
+        return {'Deleted': Delete['Objects']}
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, MaxKeys=1000, ContinuationToken=None,
+                        StartAfter=None, **kwargs):
+        marker = f"{Bucket}/"
+        objects = dict(self.objects)
+        keys = sorted(k[len(marker):] for k in objects if k.startswith(marker + Prefix))
+        contents, prefixes = [], []
+        after = ContinuationToken or StartAfter
+        for key in keys:
+            if after and key <= after:
+                continue
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                common = Prefix + rest.split(Delimiter, 1)[0] + Delimiter
+                if not prefixes or prefixes[-1] != common:
+                    prefixes.append(common)
+                continue
+            obj = objects[marker + key]
+            contents.append({'Key': key, 'Size': len(obj['Body']), 'LastModified': obj['LastModified']})
+            if len(contents) >= MaxKeys:
+                break
+        page = {'Contents': contents, 'CommonPrefixes': [{'Prefix': p} for p in prefixes],
+                'KeyCount': len(contents)}
+        if len(contents) >= MaxKeys:
+            page['IsTruncated'] = True
+            page['NextContinuationToken'] = contents[-1]['Key']
+        self._record('ListObjectsV2', 0, _size([c['Key'] for c in contents]))
+        return page
+
+    def get_paginator(self, name: str):
+        assert name == 'list_objects_v2', name
+        return _Paginator(self)
+
+
+# ==================== HTTP: TELEGRAM + OLLAMA ====================
+
+class FakeResponse:
+    def __init__(self, status_code: int = 200, payload: Any = None, content: bytes = b'',
+                 headers: Optional[Dict[str, str]] = None):
+        self.status_code = status_code
+        self.content = content if payload is None else json.dumps(payload).encode('utf-8')
+        self.headers = dict(headers or {})
+        self.headers.setdefault('Content-Length', str(len(self.content)))
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size: int = 1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FakeTelegram(Backend):
+    """Bot API subset: getUpdates, sendMessage, sendDocument, getFile and file downloads."""
+
+    def __init__(self, latency_ms: float = 0.0):
+        super().__init__('telegram', latency_ms)
+        self.updates: List[Dict[str, Any]] = []
+        self.files: Dict[str, bytes] = {}
+        self.sent: List[Dict[str, Any]] = []
+        self.keep_sent = 1000
+        # Optional hook: fn(method, payload) -> FakeResponse or None, e.g. to inject 429s
+        self.interceptor = None
+
+    def add_file(self, file_id: str, content: bytes):
+        self.files[file_id] = content
+
+    def push_updates(self, updates: List[Dict[str, Any]]):
+        """Queue updates for getUpdates (safe to call from another thread)."""
+        with self._lock:
+            self.updates.extend(updates)
+
+    def handle(self, method: str, path: str, params=None, json_body=None, data=None, files=None) -> FakeResponse:
+        payload = json_body if json_body is not None else dict(data or {})
+        sent = _size(payload) + sum(len(f[1]) for f in (files or {}).values())
+        if path.startswith('/file/'):
+            file_id = path.rsplit('/', 1)[-1]
+            content = self.files.get(file_id)
+            self._record('download', 0, len(content or b''))
+            return FakeResponse(200, content=content) if content is not None else FakeResponse(404, content=b'')
+
+        api_method = path.rsplit('/', 1)[-1]
+        if self.interceptor:
+            intercepted = self.interceptor(api_method, payload)
+            if intercepted is not None:
+                self._record(api_method, sent, len(intercepted.content))
+                return intercepted
+
+        if api_method == 'getUpdates':
+            offset = int((params or {}).get('offset', 0))
+            limit = int((params or {}).get('limit', 100))
+            with self._lock:
+                # Like the real API, asking for an offset confirms every update before it
+                if offset:
+                    self.updates = [u for u in self.updates if u['update_id'] >= offset]
+                result = [u for u in self.updates if u['update_id'] >= offset][:limit]
+            response = FakeResponse(200, {'ok': True, 'result': result})
+        elif api_method in ('sendMessage', 'sendDocument'):
+            record = dict(payload)
+            if files:
+                record['document_size'] = sum(len(f[1]) for f in files.values())
+            self.sent.append(record)
+            if len(self.sent) > self.keep_sent:
+                del self.sent[:len(self.sent) - self.keep_sent]
+            response = FakeResponse(200, {'ok': True, 'result': {'message_id': len(self.sent)}})
+        elif api_method == 'getFile':
+            file_id = (params or {}).get('file_id', '')
+            if file_id in self.files:
+                response = FakeResponse(200, {'ok': True, 'result': {
+                    'file_id': file_id, 'file_size': len(self.files[file_id]), 'file_path': f"documents/{file_id}"}})
+            else:
+                response = FakeResponse(200, {'ok': False, 'description': 'file not found'})
+        else:
+            response = FakeResponse(200, {'ok': True, 'result': True})
+        self._record(api_method, sent, len(response.content))
+        return response
+
+
+class FakeOllama(Backend):
+    """Answers /api/chat with a canned reply and /api/embeddings with a deterministic vector."""
+
+    def __init__(self, latency_ms: float = 0.0, reply_chars: int = 400, embedding_dim: int = 64):
+        super().__init__('ollama', latency_ms)
+        self.reply_chars = reply_chars
+        self.embedding_dim = embedding_dim
+        self.fail = False
+
+    def _embed(self, text: str) -> List[float]:
+        vec = [0.0] * self.embedding_dim
+        for word in re.findall(r'\w+', text.lower()):
+            vec[hash(word) % self.embedding_dim] += 1.0
+        return vec
+
+    def handle(self, method: str, path: str, json_body=None, **kwargs) -> FakeResponse:
+        sent = _size(json_body or {})
+        if self.fail:
+            self._record(path, sent)
+            raise ConnectionError('fake ollama is down')
+        if path.endswith('/api/chat'):
+            last = (json_body or {}).get('messages', [{}])[-1].get('content', '')
+            text = (f"Echo: {last} " * (self.reply_chars // max(len(last) + 7, 1) + 1))[:self.reply_chars]
+            response = FakeResponse(200, {'model': json_body.get('model'), 'message': {'role': 'assistant', 'content': text},
+                                          'done': True})
+        elif path.endswith('/api/embeddings'):
+            response = FakeResponse(200, {'embedding': self._embed(json_body.get('prompt', ''))})
+        elif path.endswith('/api/embed'):
+            inputs = json_body.get('input', [])
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            response = FakeResponse(200, {'embeddings': [self._embed(t) for t in inputs]})
+        elif path.endswith('/api/tags'):
+            response = FakeResponse(200, {'models': [{'name': 'llama3'}]})
+        else:
+            response = FakeResponse(404, content=b'not found')
+        self._record(path, sent, len(response.content))
+        return response
+
+
+class FakeHTTP:
+    """requests.Session stand-in that routes Telegram and Ollama URLs to the fakes."""
+
+    def __init__(self, telegram: FakeTelegram, ollama: FakeOllama, ollama_url: str):
+        self.telegram = telegram
+        self.ollama = ollama
+        self.ollama_url = ollama_url.rstrip('/')
+
+    def request(self, method: str, url: str, params=None, json=None, data=None, files=None, headers=None, **kwargs):
+        if json is None and isinstance(data, (bytes, str)) and 'json' in (headers or {}).get('Content-Type', ''):
+            # A pre-encoded JSON body (data=..., Content-Type: application/json), as the handler sends
+            json, data = _json.loads(data), None
+        if url.startswith('https://api.telegram.org'):
+            path = url[len('https://api.telegram.org'):]
+            return self.telegram.handle(method, path, params=params, json_body=json, data=data, files=files)
+        if url.startswith(self.ollama_url):
+            return self.ollama.handle(method, url[len(self.ollama_url):], json_body=json)
+        raise ConnectionError(f"no fake backend for {url}")
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        pass
+
+
+# ==================== WIRING ====================
+
+class LocalBackends:
+    """All fakes together; install() points a handler module at them."""
+
+    def __init__(self, ddb_ms: float = 0.0, s3_ms: float = 0.0, telegram_ms: float = 0.0,
+                 ollama_ms: float = 0.0, reply_chars: int = 400):
+        self.dynamodb = FakeDynamoDB(ddb_ms)
+        self.s3 = FakeS3(s3_ms)
+        self.telegram = FakeTelegram(telegram_ms)
+        self.ollama = FakeOllama(ollama_ms, reply_chars)
+
+    @property
+    def backends(self) -> List[Backend]:
+        return [self.dynamodb, self.s3, self.telegram, self.ollama]
+
+    def install(self, handler):
+        handler.TELEGRAM_TOKEN = handler.TELEGRAM_TOKEN or 'local-bench'
+        handler.TELEGRAM_API = f"https://api.telegram.org/bot{handler.TELEGRAM_TOKEN}"
+        handler._dynamodb_client = self.dynamodb
+        handler._s3_client = self.s3
+        handler._http_session = FakeHTTP(self.telegram, self.ollama, handler.OLLAMA_URL)
+        reset_handler_caches(handler)
+        return self
+
+    def reset_stats(self):
+        for backend in self.backends:
+            backend.reset_stats()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {b.name: b.stats() for b in self.backends}
+
+
+def reset_handler_caches(handler):
+    """Clear the handler's module-level and per-bot caches so every run starts from a cold container."""
+    for name in dir(handler):
+        value = getattr(handler, name)
+        if name.startswith('_') and name.endswith('_cache') and hasattr(value, 'clear'):
+            value.clear()
+    for bot in {handler.HOME_BOT, handler._active_bot, *handler.BOTS.values()}:
+        for name in handler.BotState.__slots__:
+            if name.endswith('_cache'):
+                getattr(bot.state, name).clear()
+
+
+def make_update(update_id: int, user_id: int, text: str = '', document: Optional[Dict[str, Any]] = None,
+                chat_id: Optional[int] = None) -> Dict[str, Any]:
+    """Build a minimal Telegram update as the Bot API would deliver it."""
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id if chat_id is not None else user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"},
+    }
+    if document is not None:
+        message['document'] = document
+    else:
+        message['text'] = text
+    return {'update_id': update_id, 'message': message}
@@ -0,0 +1,496 @@
+#!/usr/bin/python
+"""
+Trace-replay load generator for Telegram update streams
+
+Replays a JSONL log of Telegram updates through lambda_handler against the
+in-process stand-ins in local_backends.py, at a configurable rate and
+concurrency ramp, and reports where the handler saturates.
+
+Trace format, one JSON object per line:
+- a raw Telegram update, as recorded from getUpdates or a webhook log
+  (arrival times come from message.date), or
+- an envelope {"at": seconds, "update": {...}, "document_messages": N}
+  (document_messages sizes the archive served for a document update), and
+- optionally one header line {"seed": {"<user_id>": {"sessions": N,
+  "messages": N, "archives": N}}} describing state to create before replay.
+
+Modes:
+- webhook: every update is its own invocation, like API Gateway. Updates are
+  queued at their arrival time and a pool of --concurrency workers (Lambda
+  concurrency, or Telegram's max_connections if lower) drains the queue.
+- polling: one poller invokes lambda_handler with an empty event, which
+  calls getUpdates and works through what is queued, like the scheduled job.
+
+Every combination of --concurrency and --rate is one step of the ramp, run
+against fresh backends. For each step it reports offered and achieved
+throughput, queueing delay (start minus arrival), service time, error rate
+and the deepest backlog, plus the concurrency Little's law says the offered
+rate needs. A step is saturated when it falls behind the offered rate or its
+p95 queueing delay exceeds --max-queue-ms.
+
+Workers are threads sharing one handler module, so module-level caches are
+warmer than across separate Lambda containers and pure CPU work is serialized
+by the GIL. Keep the injected backend latencies realistic, since they are
+what the extra workers overlap.
+
+Usage:
+    python scripts/replay_updates.py --synthesize --write-trace trace.jsonl
+    python scripts/replay_updates.py --trace trace.jsonl --concurrency 1,4,16 --rate 20,50,100,200
+    python scripts/replay_updates.py --synthesize --heavy-users 3 --heavy-sessions 300 --burst-size 50
+    python scripts/replay_updates.py --trace recorded.jsonl --mode polling --rate trace
+"""
+
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+sys.path.insert(0, SCRIPT_DIR)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('METRICS_SINK', 'emf')  # same per-invocation cost as in Lambda
+
+import handler  # noqa: E402
+from bench_pipeline import archive_document, percentile, seed_archives, seed_sessions  # noqa: E402
+from local_backends import LocalBackends, make_update  # noqa: E402
+
+# (text, weight) for synthesized commands
+COMMAND_MIX = [
+    ('/help', 3), ('/status', 2), ('/history', 6), ('/history 50', 2), ('/listsessions', 5),
+    ('/switch 1', 3), ('/newsession', 2), ('/listarchives', 3), ('/export 1', 1), ('/restore 1', 1),
+    ('/echo ping', 1),
+]
+
+Event = Dict[str, Any]
+
+
+# ==================== TRACES ====================
+
+def load_trace(path: str) -> Tuple[Dict[str, Any], List[Event]]:
+    """Read a JSONL trace into (seed, events sorted by arrival)."""
+    seed: Dict[str, Any] = {}
+    events: List[Event] = []
+    first_date = None
+    with open(path) as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if 'seed' in record:
+                seed.update(record['seed'])
+                continue
+            if 'update' in record:
+                events.append({'at': float(record.get('at', 0.0)), 'update': record['update'],
+                               'document_messages': record.get('document_messages')})
+                continue
+            if 'update_id' not in record:
+                raise ValueError(f"{path}:{line_no}: neither an update, an envelope nor a seed header")
+            date = (record.get('message') or {}).get('date', 0)
+            first_date = date if first_date is None else first_date
+            events.append({'at': float(date - first_date), 'update': record, 'document_messages': None})
+    events.sort(key=lambda e: e['at'])
+    return seed, events
+
+
+def write_trace(path: str, seed: Dict[str, Any], events: List[Event]):
+    with open(path, 'w') as f:
+        if seed:
+            f.write(json.dumps({'seed': seed}) + '\n')
+        for event in events:
+            record = {'at': round(event['at'], 4), 'update': event['update']}
+            if event.get('document_messages'):
+                record['document_messages'] = event['document_messages']
+            f.write(json.dumps(record) + '\n')
+
+
+def synthesize_trace(args) -> Tuple[Dict[str, Any], List[Event]]:
+    """Poisson arrivals plus periodic bursts over a mix of users, commands, chat and imports."""
+    rng = random.Random(args.seed)
+    users = [3000 + i for i in range(args.users)]
+    heavy = users[:args.heavy_users]
+    light = users[args.heavy_users:] or users
+
+    seed = {str(u): {'sessions': args.sessions, 'messages': args.messages, 'archives': 0} for u in users}
+    for u in heavy:
+        seed[str(u)] = {'sessions': args.heavy_sessions, 'messages': args.messages, 'archives': args.heavy_archives}
+
+    arrivals = []
+    t = 0.0
+    while True:
+        t += rng.expovariate(args.synth_rate)
+        if t >= args.duration:
+            break
+        arrivals.append(t)
+    if args.burst_every and args.burst_size:
+        burst_at = args.burst_every
+        while burst_at < args.duration:
+            arrivals.extend([burst_at] * args.burst_size)
+            burst_at += args.burst_every
+    arrivals.sort()
+
+    commands = [text for text, weight in COMMAND_MIX for _ in range(weight)]
+    events = []
+    for i, at in enumerate(arrivals):
+        update_id = i + 1
+        user_id = rng.choice(heavy) if heavy and rng.random() < args.heavy_share else rng.choice(light)
+        roll = rng.random()
+        if roll < args.import_share:
+            file_id = f"replay-import-{update_id}"
+            update = make_update(update_id, user_id, document={
+                'file_id': file_id, 'file_name': 'archive.json', 'mime_type': 'application/json',
+                'file_size': args.import_messages * 80})
+            events.append({'at': at, 'update': update, 'document_messages': args.import_messages})
+            continue
+        if roll < args.import_share + args.command_share:
+            text = rng.choice(commands)
+        else:
+            text = f"message {update_id} from {user_id}: how does this work?"
+        events.append({'at': at, 'update': make_update(update_id, user_id, text), 'document_messages': None})
+    return seed, events
+
+
+def arrival_times(events: List[Event], rate: Optional[float]) -> List[float]:
+    """Trace timing, rescaled to an average rate (keeps burst shape); rate 0 means all at once."""
+    native = [e['at'] for e in events]
+    if rate is None:
+        return native
+    span = native[-1] - native[0] if native else 0.0
+    if rate == 0 or span <= 0:
+        return [0.0] * len(native)
+    scale = (len(native) / rate) / span
+    return [(at - native[0]) * scale for at in native]
+
+
+def parse_rates(text: str) -> List[Optional[float]]:
+    """'trace' keeps recorded timing, 'max' (or 0) sends everything at once."""
+    rates = []
+    for part in text.split(','):
+        part = part.strip().lower()
+        if part == 'trace':
+            rates.append(None)
+        elif part == 'max':
+            rates.append(0.0)
+        else:
+            rates.append(float(part))
+    return rates
+
+
+def rate_label(rate: Optional[float]) -> str:
+    if rate is None:
+        return 'trace'
+    return 'max' if rate == 0 else f"{rate:g}"
+
+
+# ==================== REPLAY ====================
+
+def prepare(backends: LocalBackends, seed: Dict[str, Any], events: List[Event], args):
+    """Create seeded state, and serve a document for every document update in the trace."""
+    seen = {(e['update'].get('message') or {}).get('from', {}).get('id') for e in events}
+    for user in seen:
+        if user is not None and str(user) not in seed and args.sessions:
+            seed_sessions(int(user), args.sessions, args.messages)
+    for user, spec in seed.items():
+        if spec.get('sessions'):
+            seed_sessions(int(user), spec['sessions'], spec.get('messages', args.messages))
+        if spec.get('archives'):
+            seed_archives(int(user), spec['archives'], args.archive_messages)
+
+    documents: Dict[int, bytes] = {}
+    for event in events:
+        document = (event['update'].get('message') or {}).get('document')
+        if not document:
+            continue
+        messages = event.get('document_messages') or max(int(document.get('file_size', 0)) // 80, 1)
+        if messages not in documents:
+            documents[messages] = archive_document(messages)
+        backends.telegram.add_file(document['file_id'], documents[messages])
+
+
+def invoke(event: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[str]]:
+    """Run one invocation; returns (result, error or None)."""
+    try:
+        result = handler.lambda_handler(event, None)
+    except Exception as e:
+        return {}, f"{type(e).__name__}: {e}"
+    if result.get('statusCode') != 200:
+        return result, f"status {result.get('statusCode')}"
+    return result, None
+
+
+def handled_error(processed: Dict[str, Any]) -> Optional[str]:
+    code = processed.get('handled')
+    return code if isinstance(code, str) and 'error' in code else None
+
+
+def replay_webhook(events: List[Event], arrivals: List[float], concurrency: int,
+                   timeout: float) -> Tuple[List[Dict[str, Any]], int, Dict[str, int]]:
+    records = [{'arrival': at} for at in arrivals]
+    pending: 'queue.Queue[Optional[int]]' = queue.Queue()
+    max_backlog = 0
+    t0 = time.perf_counter()
+
+    def worker():
+        while True:
+            index = pending.get()
+            if index is None:
+                return
+            record = records[index]
+            record['start'] = time.perf_counter() - t0
+            result, error = invoke({'body': json.dumps(events[index]['update'])})
+            record['end'] = time.perf_counter() - t0
+            if not error:
+                body = json.loads(result.get('body') or '{}')
+                if not body.get('ok'):
+                    error = body.get('error', 'not ok')
+                else:
+                    error = handled_error(body.get('result') or {})
+                    record['handled'] = (body.get('result') or {}).get('handled')
+            record['error'] = error
+
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for w in workers:
+        w.start()
+    for index, at in enumerate(arrivals):
+        delay = at - (time.perf_counter() - t0)
+        if delay > 0:
+            time.sleep(delay)
+        if time.perf_counter() - t0 > timeout:
+            break
+        pending.put(index)
+        max_backlog = max(max_backlog, pending.qsize())
+    for _ in workers:
+        pending.put(None)
+    for w in workers:
+        w.join(max(timeout - (time.perf_counter() - t0), 0.1))
+    return records, max_backlog, {}
+
+
+def replay_polling(backends: LocalBackends, events: List[Event], arrivals: List[float],
+                   poll_interval: float, timeout: float) -> Tuple[List[Dict[str, Any]], int, Dict[str, int]]:
+    records = [{'arrival': at} for at in arrivals]
+    by_update = {e['update']['update_id']: i for i, e in enumerate(events)}
+    first_id = min(by_update) if by_update else 1
+    handler.save_offset(first_id)  # skip the "first run" path, which drops the backlog
+    done = threading.Event()
+    max_backlog = 0
+    failed_polls = 0
+    t0 = time.perf_counter()
+
+    def feeder():
+        for index, at in enumerate(arrivals):
+            delay = at - (time.perf_counter() - t0)
+            if delay > 0:
+                time.sleep(delay)
+            if done.is_set():
+                return
+            backends.telegram.push_updates([events[index]['update']])
+
+    feed = threading.Thread(target=feeder, daemon=True)
+    feed.start()
+    remaining = set(by_update)
+    while remaining and time.perf_counter() - t0 < timeout:
+        max_backlog = max(max_backlog, len(backends.telegram.updates))
+        start = time.perf_counter() - t0
+        result, error = invoke({})
+        end = time.perf_counter() - t0
+        body = result.get('body')
+        messages = body.get('messages', []) if isinstance(body, dict) else []
+        for processed in messages:
+            index = by_update.get(processed.get('update_id'))
+            if index is None or 'end' in records[index]:
+                continue
+            records[index].update(start=start, end=end, error=handled_error(processed),
+                                  handled=processed.get('handled'))
+            remaining.discard(processed.get('update_id'))
+        if isinstance(body, dict):
+            # Updates without a message are acknowledged but never reported as processed
+            acknowledged = body.get('new_offset', first_id)
+            for update_id in [u for u in remaining if u < acknowledged]:
+                records[by_update[update_id]].update(start=start, end=end, error=None)
+                remaining.discard(update_id)
+        elif error:
+            failed_polls += 1
+        if poll_interval:
+            time.sleep(poll_interval)
+        elif not messages:
+            time.sleep(0.005)
+    done.set()
+    return records, max_backlog, {'failed_poll': failed_polls} if failed_polls else {}
+
+
+def summarize(records: List[Dict[str, Any]], max_backlog: int, extra_errors: Dict[str, int], args) -> Dict[str, Any]:
+    completed = [r for r in records if 'end' in r]
+    arrivals = [r['arrival'] for r in records]
+    span = (max(arrivals) - min(arrivals)) if arrivals else 0.0
+    queue_ms = sorted((r['start'] - r['arrival']) * 1000 for r in completed)
+    service_ms = sorted((r['end'] - r['start']) * 1000 for r in completed)
+    errors = sum(1 for r in completed if r.get('error')) + (len(records) - len(completed))
+    elapsed = (max(r['end'] for r in completed) - min(arrivals)) if completed else 0.0
+    offered = len(records) / span if span > 0 else float('inf')
+    achieved = len(completed) / elapsed if elapsed > 0 else 0.0
+    mean_service_s = sum(service_ms) / len(service_ms) / 1000 if service_ms else 0.0
+    q95 = percentile(queue_ms, 95)
+    error_kinds: Dict[str, int] = dict(extra_errors)
+    if len(completed) < len(records):
+        error_kinds['timeout'] = len(records) - len(completed)
+    for r in completed:
+        if r.get('error'):
+            kind = r['error'].split(':', 1)[0]
+            error_kinds[kind] = error_kinds.get(kind, 0) + 1
+    return {
+        'updates': len(records),
+        'completed': len(completed),
+        'offered_per_s': round(offered, 2) if offered != float('inf') else None,
+        'achieved_per_s': round(achieved, 2),
+        'queue_p50_ms': round(percentile(queue_ms, 50), 2),
+        'queue_p95_ms': round(q95, 2),
+        'queue_p99_ms': round(percentile(queue_ms, 99), 2),
+        'service_p50_ms': round(percentile(service_ms, 50), 2),
+        'service_p95_ms': round(percentile(service_ms, 95), 2),
+        'service_p99_ms': round(percentile(service_ms, 99), 2),
+        'error_rate': round(errors / len(records), 4) if records else 0.0,
+        # Turned away by per-user rate limits or the model in-flight cap (not errors)
+        'shed': sum(1 for r in completed if r.get('handled') in ('rate_limited', 'model_busy')),
+        'errors': error_kinds,
+        'max_backlog': max_backlog,
+        # Little's law: workers busy on average at the offered rate
+        'needed_concurrency': round(offered * mean_service_s, 2) if offered != float('inf') else None,
+        'saturated': offered == float('inf') or achieved < 0.9 * offered or q95 > args.max_queue_ms,
+    }
+
+
+def run_step(seed, events, concurrency: int, rate: Optional[float], args) -> Dict[str, Any]:
+    backends = LocalBackends(args.ddb_ms, args.s3_ms, args.telegram_ms, args.ollama_ms, args.reply_chars)
+    backends.install(handler)
+    prepare(backends, seed, events, args)
+    backends.reset_stats()
+    arrivals = arrival_times(events, rate)
+    if args.mode == 'webhook':
+        records, backlog, extra = replay_webhook(events, arrivals, concurrency, args.timeout)
+    else:
+        records, backlog, extra = replay_polling(backends, events, arrivals, args.poll_interval, args.timeout)
+    summary = summarize(records, backlog, extra, args)
+    summary['requests'] = {name: s['requests'] for name, s in backends.stats().items()}
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_argument_group('trace')
+    source.add_argument('--trace', default='', help='JSONL trace to replay')
+    source.add_argument('--synthesize', action='store_true', help='generate a trace instead of reading one')
+    source.add_argument('--write-trace', default='', help='save the (synthesized) trace and exit')
+    source.add_argument('--limit', type=int, default=0, help='replay only the first N updates')
+    synth = parser.add_argument_group('synthesized traffic')
+    synth.add_argument('--duration', type=float, default=30.0, help='seconds of traffic')
+    synth.add_argument('--synth-rate', type=float, default=10.0, help='mean Poisson arrivals per second')
+    synth.add_argument('--users', type=int, default=50)
+    synth.add_argument('--heavy-users', type=int, default=2, help='users with many sessions and archives')
+    synth.add_argument('--heavy-share', type=float, default=0.3, help='fraction of traffic from heavy users')
+    synth.add_argument('--heavy-sessions', type=int, default=200)
+    synth.add_argument('--heavy-archives', type=int, default=20)
+    synth.add_argument('--burst-every', type=float, default=10.0, help='seconds between bursts (0 = none)')
+    synth.add_argument('--burst-size', type=int, default=30, help='updates arriving at once in a burst')
+    synth.add_argument('--command-share', type=float, default=0.4)
+    synth.add_argument('--import-share', type=float, default=0.01)
+    synth.add_argument('--import-messages', type=int, default=2000)
+    synth.add_argument('--seed', type=int, default=7, help='random seed')
+    state = parser.add_argument_group('seeded state')
+    state.add_argument('--sessions', type=int, default=3, help='sessions for users without a seed entry')
+    state.add_argument('--messages', type=int, default=20, help='messages per seeded session')
+    state.add_argument('--archive-messages', type=int, default=200, help='messages per seeded archive')
+    load = parser.add_argument_group('load')
+    load.add_argument('--mode', choices=('webhook', 'polling'), default='webhook')
+    load.add_argument('--concurrency', default='1,2,4,8', help='comma-separated worker counts (webhook mode)')
+    load.add_argument('--rate', default='trace', help="comma-separated updates/s; 'trace' or 'max'")
+    load.add_argument('--poll-interval', type=float, default=0.0, help='seconds between polling invocations')
+    load.add_argument('--max-queue-ms', type=float, default=1000.0, help='p95 queueing delay that counts as saturated')
+    load.add_argument('--timeout', type=float, default=300.0, help='give up on a step after this many seconds')
+    load.add_argument('--ollama', action='store_true', help='enable the Ollama path for chat messages')
+    load.add_argument('--no-send-limits', action='store_true',
+                      help="disable the outbound per-chat/global pacing (Telegram's limits are on by default)")
+    load.add_argument('--rate-limits', default=None,
+                      help="override the handler's per-user RATE_LIMITS ('' disables them)")
+    backend = parser.add_argument_group('backend latency (ms per request)')
+    backend.add_argument('--ddb-ms', type=float, default=5.0)
+    backend.add_argument('--s3-ms', type=float, default=20.0)
+    backend.add_argument('--telegram-ms', type=float, default=40.0)
+    backend.add_argument('--ollama-ms', type=float, default=300.0)
+    backend.add_argument('--reply-chars', type=int, default=400)
+    parser.add_argument('--json', default='', help='write all step results to this file')
+    args = parser.parse_args()
+
+    if args.synthesize:
+        seed, events = synthesize_trace(args)
+    elif args.trace:
+        seed, events = load_trace(args.trace)
+    else:
+        parser.error('give --trace or --synthesize')
+    if args.limit:
+        events = events[:args.limit]
+    if args.write_trace:
+        write_trace(args.write_trace, seed, events)
+        print(f"Wrote {len(events)} updates to {args.write_trace}")
+        return
+    if not events:
+        parser.error('trace is empty')
+
+    rates = parse_rates(args.rate)
+    concurrencies = [int(c) for c in args.concurrency.split(',')] if args.mode == 'webhook' else [1]
+    handler.OLLAMA_ENABLED = args.ollama
+    if args.no_send_limits:
+        handler.SEND_CHAT_RATE = handler.SEND_GLOBAL_RATE = 0
+    if args.rate_limits is not None:
+        handler.RATE_LIMITS = args.rate_limits
+
+    print(f"{len(events)} updates, {len(seed)} seeded users, mode={args.mode}")
+    print(f"{'conc':>5}{'rate':>8}{'offered':>9}{'achieved':>10}{'q p50':>9}{'q p95':>9}{'q p99':>9}"
+          f"{'svc p50':>9}{'svc p95':>9}{'err %':>7}{'shed':>6}{'backlog':>9}{'need':>7}  state")
+    print('-' * 118)
+    steps = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        for concurrency, rate in itertools.product(concurrencies, rates):
+            result = run_step(seed, events, concurrency, rate, args)
+            result.update(concurrency=concurrency, rate=rate_label(rate))
+            steps.append(result)
+            offered = f"{result['offered_per_s']:.1f}" if result['offered_per_s'] is not None else 'inf'
+            need = f"{result['needed_concurrency']:.1f}" if result['needed_concurrency'] is not None else '-'
+            print(f"{concurrency:>5}{result['rate']:>8}{offered:>9}{result['achieved_per_s']:>10.1f}"
+                  f"{result['queue_p50_ms']:>9.0f}{result['queue_p95_ms']:>9.0f}{result['queue_p99_ms']:>9.0f}"
+                  f"{result['service_p50_ms']:>9.1f}{result['service_p95_ms']:>9.1f}"
+                  f"{result['error_rate'] * 100:>7.1f}{result['shed']:>6}{result['max_backlog']:>9}{need:>7}  "
+                  f"{'SATURATED' if result['saturated'] else 'ok'}", file=sys.__stdout__, flush=True)
+
+    print('\nSaturation throughput (best achieved rate) per concurrency:')
+    for concurrency in concurrencies:
+        rows = [s for s in steps if s['concurrency'] == concurrency]
+        best = max(s['achieved_per_s'] for s in rows)
+        sustained = [s for s in rows if not s['saturated']]
+        ceiling = max((s['offered_per_s'] for s in sustained), default=None)
+        note = f", sustains {ceiling:.1f} upd/s offered" if ceiling else ', saturated at every rate tried'
+        print(f"  {concurrency:>4} workers: {best:.1f} upd/s{note}")
+    errors: Dict[str, int] = {}
+    for step in steps:
+        for kind, count in step['errors'].items():
+            errors[kind] = errors.get(kind, 0) + count
+    if errors:
+        print('Errors by kind: ' + ', '.join(f"{k} x{v}" for k, v in sorted(errors.items())))
+
+    if args.json:
+        meta = {k: v for k, v in vars(args).items() if k != 'json'}
+        with open(args.json, 'w') as f:
+            json.dump({'meta': meta, 'steps': steps}, f, indent=2)
+        print(f"\nWrote {args.json}")
+
+
+if __name__ == '__main__':
+    main()
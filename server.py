@@ -0,0 +1,365 @@
+#!/usr/bin/python
+"""
+Self-hosted webhook server
+
+Runs the bot as one long-lived process instead of API Gateway + Lambda.
+Telegram POSTs updates to the webhook path. Each update is saved to the
+table (pk OFFSET_PK, sk INBOX#<update_id>) and queued before it is
+acknowledged, then handled by process_telegram_update on a fixed pool of
+worker threads, which delete the saved copy once it is done.
+
+- Updates from one user run one at a time, in arrival order; different users
+  run in parallel.
+- The queue is bounded. When it is full, or the update cannot be saved, the
+  POST gets a 503, and Telegram redelivers the update later.
+- Updates still saved at start-up (the server crashed, or the drain ran out
+  of time) are queued again before the first new one.
+- Clients and connection pools to Telegram, Ollama, DynamoDB and S3 are built
+  at start-up and stay warm.
+- Embedding and search indexing run every SERVER_FLUSH_INTERVAL seconds, so
+  they batch across users.
+
+Endpoints:
+    POST <path>     Telegram webhook; checks X-Telegram-Bot-Api-Secret-Token when WEBHOOK_SECRET is set
+    GET  /healthz   200 while accepting updates, 503 when draining or full
+    GET  /metrics   Prometheus text: queue depth, update counts, latency and per-stage time
+
+On SIGTERM or SIGINT the server stops accepting updates, works through the
+queue for up to SERVER_DRAIN_TIMEOUT seconds and exits; what is left stays
+saved for the next start.
+
+Usage:
+    python server.py --port 8080 --workers 8
+    WEBHOOK_SECRET=... python server.py --path /telegram
+"""
+
+import argparse
+import hmac
+import json
+import os
+import signal
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Deque, Dict, Hashable, Optional, Tuple
+
+import handler
+
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', '8'))
+SERVER_MAX_PENDING = int(os.environ.get('SERVER_MAX_PENDING', '1000'))  # queued updates before 503
+SERVER_FLUSH_INTERVAL = float(os.environ.get('SERVER_FLUSH_INTERVAL', '2'))  # seconds between embed/index runs
+SERVER_DRAIN_TIMEOUT = float(os.environ.get('SERVER_DRAIN_TIMEOUT', '30'))
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+LATENCY_WINDOW = 1000  # recent updates kept for the latency quantiles
+INBOX_PREFIX = 'INBOX#'  # sk prefix at pk OFFSET_PK: updates acknowledged but not yet handled
+
+
+def _quantile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def save_update(update: Dict[str, Any]) -> str:
+    """Store an update until a worker has handled it. Returns its sk."""
+    sk = f"{INBOX_PREFIX}{int(update.get('update_id') or 0):012d}"
+    handler.db_put_item({'pk': handler.OFFSET_PK, 'sk': sk, 'update': json.dumps(update)})
+    return sk
+
+
+def forget_update(sk: str):
+    try:
+        handler.db_delete_item({'pk': handler.OFFSET_PK, 'sk': sk})
+    except Exception as e:
+        # Handled once already; the next start would run it again
+        handler.log_error("Error removing saved update %s: %s", sk, e)
+
+
+def saved_updates():
+    """Updates acknowledged by an earlier run and not handled, oldest first, as (sk, update)."""
+    items = handler.db_query(handler.OFFSET_PK, INBOX_PREFIX)
+    return [(item['sk'], json.loads(item['update'])) for item in sorted(items, key=lambda item: item['sk'])]
+
+
+class UpdateDispatcher:
+    """
+    Bounded per-user FIFO queues served by a fixed pool of worker threads.
+
+    A user is in `ready` only while it has queued updates and no worker is on
+    it, so at most one of its updates is in flight at a time.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self.max_pending = max_pending
+        self.queues: Dict[Hashable, Deque[Tuple[float, Dict[str, Any], str]]] = {}
+        self.ready: Deque[Hashable] = deque()
+        self.cond = threading.Condition()
+        self.pending = 0
+        self.in_flight = 0
+        self.accepting = True
+        self.counters: Counter = Counter()
+        self.stage_ms: Counter = Counter()
+        self.stage_calls: Counter = Counter()
+        self.wait_ms: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.handle_ms: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.threads = [threading.Thread(target=self._work, name=f"worker-{i}", daemon=True) for i in range(workers)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, update: Dict[str, Any], sk: str, replayed: bool = False) -> bool:
+        """
+        Queue a saved update behind the same user's earlier ones; False if
+        draining or full. Replayed updates are already acknowledged, so they
+        are queued past max_pending.
+        """
+        user_id = handler.update_user_id(update)
+        key = user_id if user_id is not None else ('update', update.get('update_id'))
+        with self.cond:
+            if not self.accepting or self.pending >= self.max_pending and not replayed:
+                self.counters['rejected'] += 1
+                return False
+            queue = self.queues.get(key)
+            if queue is None:
+                queue = self.queues[key] = deque()
+                self.ready.append(key)
+            queue.append((time.perf_counter(), update, sk))
+            self.pending += 1
+            self.counters['received'] += 1
+            self.cond.notify()
+        return True
+
+    def reject(self):
+        with self.cond:
+            self.counters['rejected'] += 1
+
+    def drain(self, timeout: float) -> bool:
+        """Stop accepting updates and wait for the queued ones; True if all were handled."""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            self.accepting = False
+            self.cond.notify_all()
+            while self.pending or self.in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.ready:
+                    self.cond.wait()
+                key = self.ready.popleft()
+                queued_at, update, sk = self.queues[key].popleft()
+                self.pending -= 1
+                self.in_flight += 1
+            self._handle(update, queued_at)
+            forget_update(sk)
+            with self.cond:
+                self.in_flight -= 1
+                if self.queues[key]:
+                    self.ready.append(key)
+                else:
+                    del self.queues[key]
+                self.cond.notify_all()
+
+    def _handle(self, update: Dict[str, Any], queued_at: float):
+        """Same per-update lifecycle as a webhook invocation of lambda_handler."""
+        started = time.perf_counter()
+        handler.begin_invocation()
+        outcome = 'failed'
+        try:
+            result = handler.process_telegram_update(update)
+            outcome = 'processed' if result.get('processed') else 'ignored'
+        except Exception as e:
+            handler.log_error("Update %s failed: %s", update.get('update_id'), e, exc_info=True)
+        finally:
+            # Only this update's chat: a worker must not end up pacing other users' replies
+            chat_id = ((update.get('message') or {}).get('chat') or {}).get('id')
+            if chat_id is not None:
+                handler.flush_outbox(wait=True, chat_id=chat_id)
+            handler.flush_usage()
+            elapsed_ms = (time.perf_counter() - started) * 1000.0
+            stages = getattr(handler._trace, 'stages', None) or {}
+            handler.emit_metrics('server', elapsed_ms, 1, getattr(handler._trace, 'errors', 0))
+            with self.cond:
+                self.counters[outcome] += 1
+                self.wait_ms.append((started - queued_at) * 1000.0)
+                self.handle_ms.append(elapsed_ms)
+                for stage, (calls, total_ms) in stages.items():
+                    self.stage_calls[stage] += calls
+                    self.stage_ms[stage] += total_ms
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.cond:
+            return {
+                'accepting': self.accepting,
+                'pending': self.pending,
+                'in_flight': self.in_flight,
+                'users_queued': len(self.queues),
+                'workers': len(self.threads),
+                'counters': dict(self.counters),
+                'stage_ms': dict(self.stage_ms),
+                'stage_calls': dict(self.stage_calls),
+                'wait_ms': list(self.wait_ms),
+                'handle_ms': list(self.handle_ms),
+            }
+
+
+def deferred_work_loop(stop: threading.Event, interval: float):
+    """Every `interval` seconds send replies left queued and embed and index new messages, batched across users."""
+    while not stop.wait(interval):
+        handler.begin_invocation()
+        try:
+            handler.resume_deferred_replies()  # left by a previous run that shut down with replies unsent
+            handler.flush_outbox(wait=False)
+            handler.run_deferred_work()
+        except Exception as e:
+            handler.log_error("Deferred work failed: %s", e, exc_info=True)
+
+
+def render_metrics(state: Dict[str, Any], started_at: float) -> str:
+    lines = [
+        f"chatbot_uptime_seconds {time.time() - started_at:.0f}",
+        f"chatbot_workers {state['workers']}",
+        f"chatbot_updates_pending {state['pending']}",
+        f"chatbot_updates_in_flight {state['in_flight']}",
+        f"chatbot_users_queued {state['users_queued']}",
+    ]
+    for outcome in ('received', 'processed', 'ignored', 'failed', 'rejected'):
+        lines.append(f'chatbot_updates_total{{outcome="{outcome}"}} {state["counters"].get(outcome, 0)}')
+    for name in ('wait_ms', 'handle_ms'):
+        for q in (0.5, 0.95, 0.99):
+            lines.append(f'chatbot_update_{name}{{quantile="{q}"}} {_quantile(state[name], q):.3f}')
+    for stage in sorted(state['stage_ms']):
+        lines.append(f'chatbot_stage_ms_total{{stage="{stage}"}} {state["stage_ms"][stage]:.3f}')
+        lines.append(f'chatbot_stage_calls_total{{stage="{stage}"}} {state["stage_calls"][stage]}')
+    return '\n'.join(lines) + '\n'
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep Telegram's connections open between updates
+    server: 'WebhookServer'
+
+    def do_POST(self):
+        if self.path.split('?', 1)[0] != self.server.webhook_path:
+            return self._reply(404, {'ok': False, 'error': 'Not found'})
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if WEBHOOK_SECRET and not hmac.compare_digest(
+                self.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), WEBHOOK_SECRET):
+            return self._reply(403, {'ok': False, 'error': 'Forbidden'})
+        try:
+            update = json.loads(body or b'{}')
+        except ValueError:
+            # Like lambda_handler: acknowledge, or Telegram keeps redelivering it
+            return self._reply(200, {'ok': False, 'error': 'Invalid JSON'})
+        if not isinstance(update, dict):
+            return self._reply(200, {'ok': False, 'error': 'Invalid update'})
+        dispatcher = self.server.dispatcher
+        if not dispatcher.accepting or dispatcher.pending >= dispatcher.max_pending:
+            dispatcher.reject()
+            return self._reply(503, {'ok': False, 'error': 'Busy'}, {'Retry-After': '1'})
+        # Saved before the 200: once acknowledged, Telegram never sends it again
+        try:
+            sk = save_update(update)
+        except Exception as e:
+            handler.log_error("Error saving update %s: %s", update.get('update_id'), e)
+            dispatcher.reject()
+            return self._reply(503, {'ok': False, 'error': 'Unavailable'}, {'Retry-After': '1'})
+        if not dispatcher.submit(update, sk):
+            forget_update(sk)
+            return self._reply(503, {'ok': False, 'error': 'Busy'}, {'Retry-After': '1'})
+        return self._reply(200, {'ok': True})
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        state = self.server.dispatcher.snapshot()
+        if path == '/healthz':
+            healthy = state['accepting'] and state['pending'] < self.server.dispatcher.max_pending
+            return self._reply(200 if healthy else 503, {
+                'ok': healthy, 'pending': state['pending'], 'in_flight': state['in_flight'],
+                'workers': state['workers'], 'models': handler.model_status_lines()})
+        if path == '/metrics':
+            return self._send(200, render_metrics(state, self.server.started_at).encode('utf-8'),
+                              'text/plain; version=0.0.4')
+        return self._reply(404, {'ok': False, 'error': 'Not found'})
+
+    def _reply(self, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+        self._send(status, json.dumps(payload).encode('utf-8'), 'application/json', headers)
+
+    def _send(self, status: int, body: bytes, content_type: str, headers: Optional[Dict[str, str]] = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        handler.log_debug("%s %s", self.address_string(), format % args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], dispatcher: UpdateDispatcher, webhook_path: str):
+        super().__init__(address, WebhookRequestHandler)
+        self.dispatcher = dispatcher
+        self.webhook_path = webhook_path
+        self.started_at = time.time()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default=os.environ.get('SERVER_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('SERVER_PORT', '8080')))
+    parser.add_argument('--path', default=os.environ.get('WEBHOOK_PATH', '/'), help='webhook path')
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS)
+    parser.add_argument('--max-pending', type=int, default=SERVER_MAX_PENDING)
+    args = parser.parse_args()
+
+    # One pooled connection per worker to each backend, built before the first update
+    handler.POOL_CONNECTIONS = max(handler.POOL_CONNECTIONS, args.workers)
+    handler.prime()
+
+    dispatcher = UpdateDispatcher(args.workers, args.max_pending)
+    saved = saved_updates()
+    for sk, update in saved:
+        dispatcher.submit(update, sk, replayed=True)
+    if saved:
+        handler.log_info("Queued %d updates saved by the previous run", len(saved))
+    dispatcher.start()
+    httpd = WebhookServer((args.host, args.port), dispatcher, args.path)
+    stop = threading.Event()
+    deferred = threading.Thread(target=deferred_work_loop, args=(stop, SERVER_FLUSH_INTERVAL), daemon=True)
+    deferred.start()
+
+    def shutdown(signum, frame):
+        stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    threading.Thread(target=httpd.serve_forever, name='http', daemon=True).start()
+    handler.log_info("Listening on %s:%d%s with %d workers", args.host, args.port, args.path, args.workers)
+
+    stop.wait()
+    handler.log_info("Draining %d queued updates", dispatcher.snapshot()['pending'])
+    if not dispatcher.drain(SERVER_DRAIN_TIMEOUT):
+        handler.log_warning("Drain timed out; %d updates left saved for the next start",
+                            dispatcher.pending + dispatcher.in_flight)
+    httpd.shutdown()
+    httpd.server_close()
+    deferred.join()
+    handler.begin_invocation()
+    handler.flush_outbox(wait=True)
+    handler.run_deferred_work()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,723 @@
+"""
+Storage backends
+
+handler.py keeps sessions, offsets, counters and index bookkeeping in one
+DynamoDB table, and archives, segments and indexes in one S3 bucket. It talks
+to both through the low-level boto3 client API. This module provides the same
+client surface (the subset handler.py calls) on local storage, so
+single-node deployments (server.py) and benchmarks run without AWS.
+
+- ItemStore: get/put/update/delete_item, query, batch_get/batch_write_item,
+  including condition and update expressions
+- ObjectStore: put/get (with Range)/head/delete_object(s), list_objects_v2
+  and its paginator, with MD5 ETags and IfMatch/IfNoneMatch conditions
+
+Implementations:
+
+- memory: MemoryItemStore + MemoryObjectStore, dicts in the process
+- sqlite: SQLiteItemStore (one WAL-mode database, keyed by table, user and
+  sort key, with an index on user and is_active, like active_sessions_index)
+  + FileObjectStore (one file per object under a directory)
+
+handler.get_dynamodb_client() and get_s3_client() return these instead of
+boto3 clients when STORAGE_BACKEND is 'sqlite' or 'memory'; open_storage()
+builds the pair.
+"""
+
+import copy
+import datetime
+import hashlib
+import io
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+from decimal import Decimal
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# ==================== EXPRESSIONS ====================
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+
+class _Expr:
+    """Tiny evaluator for the DynamoDB expression grammar the handler uses."""
+
+    TOKEN = re.compile(r'\s*(<=|>=|<>|[=<>(),]|[#:]?[A-Za-z_][A-Za-z0-9_.]*|\S)')
+
+    def __init__(self, text: str, names: Optional[Dict[str, str]], values: Optional[Dict[str, Any]]):
+        self.tokens = [t for t in self.TOKEN.findall(text) if t]
+        self.pos = 0
+        self.names = names or {}
+        self.values = values or {}
+
+    def peek(self) -> Optional[str]:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self, expected: Optional[str] = None) -> str:
+        tok = self.peek()
+        if tok is None or (expected and tok.upper() != expected):
+            raise ValueError(f"expected {expected!r}, got {tok!r}")
+        self.pos += 1
+        return tok
+
+    def name(self, tok: str) -> str:
+        return self.names.get(tok, tok)
+
+    def operand(self, item: Dict[str, Any], tok: str):
+        if tok.startswith(':'):
+            return _plain(self.values[tok])
+        value = item.get(self.name(tok))
+        return _plain(value) if value is not None else None
+
+    # condition := disjunct (OR disjunct)*
+    def condition(self, item: Dict[str, Any]) -> bool:
+        result = self.conjunct(item)
+        while self.peek() and self.peek().upper() == 'OR':
+            self.take()
+            rhs = self.conjunct(item)
+            result = result or rhs
+        return result
+
+    def conjunct(self, item: Dict[str, Any]) -> bool:
+        result = self.atom(item)
+        while self.peek() and self.peek().upper() == 'AND':
+            self.take()
+            rhs = self.atom(item)
+            result = result and rhs
+        return result
+
+    def atom(self, item: Dict[str, Any]) -> bool:
+        tok = self.take()
+        if tok.upper() == 'NOT':
+            return not self.atom(item)
+        if tok == '(':
+            result = self.condition(item)
+            self.take(')')
+            return result
+        func = tok.lower()
+        if func in ('attribute_exists', 'attribute_not_exists', 'begins_with', 'contains') and self.peek() == '(':
+            self.take('(')
+            path = self.take()
+            arg = None
+            if self.peek() == ',':
+                self.take(',')
+                arg = self.operand(item, self.take())
+            self.take(')')
+            value = self.operand(item, path)
+            if func == 'attribute_exists':
+                return value is not None
+            if func == 'attribute_not_exists':
+                return value is None
+            if func == 'begins_with':
+                return isinstance(value, str) and value.startswith(arg)
+            return value is not None and arg in value
+        lhs = self.operand(item, tok)
+        op = self.take()
+        if op.upper() == 'BETWEEN':
+            lo = self.operand(item, self.take())
+            self.take('AND')
+            hi = self.operand(item, self.take())
+            return lhs is not None and lo <= lhs <= hi
+        rhs = self.operand(item, self.take())
+        if op == '=':
+            return lhs == rhs
+        if op == '<>':
+            return lhs != rhs
+        if lhs is None or rhs is None:
+            return False
+        return {'<': lhs < rhs, '<=': lhs <= rhs, '>': lhs > rhs, '>=': lhs >= rhs}[op]
+
+
+def _plain(av: Dict[str, Any]) -> Any:
+    """Attribute value -> comparable python value (only scalar types matter for conditions)."""
+    (kind, value), = av.items()
+    if kind == 'N':
+        return Decimal(value)
+    if kind in ('S', 'B', 'BOOL'):
+        return value
+    if kind == 'NULL':
+        return None
+    if kind in ('SS', 'NS', 'BS'):
+        return set(value)
+    return json.dumps(value, sort_keys=True)
+
+
+def _apply_update(item: Dict[str, Any], expression: str, names: Dict[str, str], values: Dict[str, Any]):
+    """Apply SET / ADD / REMOVE / DELETE clauses to a typed item in place."""
+    clauses = re.split(r'\b(SET|ADD|REMOVE|DELETE)\b', expression, flags=re.IGNORECASE)
+    for i in range(1, len(clauses), 2):
+        action, body = clauses[i].upper(), clauses[i + 1]
+        for part in _split_top(body):
+            part = part.strip()
+            if not part:
+                continue
+            if action == 'REMOVE':
+                item.pop(names.get(part, part), None)
+            elif action == 'DELETE':
+                path, val = part.split(None, 1)
+                path = names.get(path, path)
+                (kind, members), = values[val.strip()].items()
+                remaining = set(item.get(path, {kind: []})[kind]) - set(members)
+                if remaining:
+                    item[path] = {kind: sorted(remaining)}
+                else:
+                    item.pop(path, None)
+            elif action == 'ADD':
+                path, val = part.split(None, 1)
+                path = names.get(path, path)
+                delta = values[val.strip()]
+                if 'N' in delta:
+                    current = Decimal(item.get(path, {'N': '0'})['N'])
+                    item[path] = {'N': str(current + Decimal(delta['N']))}
+                else:
+                    (kind, members), = delta.items()
+                    existing = set(item.get(path, {kind: []})[kind])
+                    item[path] = {kind: sorted(existing | set(members))}
+            else:
+                path, rhs = part.split('=', 1)
+                path = names.get(path.strip(), path.strip())
+                item[path] = _set_value(item, rhs.strip(), names, values)
+
+
+def _split_top(body: str) -> List[str]:
+    parts, depth, start = [], 0, 0
+    for i, ch in enumerate(body):
+        if ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+        elif ch == ',' and depth == 0:
+            parts.append(body[start:i])
+            start = i + 1
+    parts.append(body[start:])
+    return parts
+
+
+def _set_value(item, rhs, names, values):
+    for op in ('+', '-'):
+        if op in rhs and not rhs.startswith('list_append'):
+            left, right = rhs.split(op, 1)
+            a = Decimal(_set_value(item, left.strip(), names, values)['N'])
+            b = Decimal(_set_value(item, right.strip(), names, values)['N'])
+            return {'N': str(a + b if op == '+' else a - b)}
+    m = re.match(r'if_not_exists\(\s*([^,]+?)\s*,\s*([^)]+?)\s*\)$', rhs)
+    if m:
+        path = names.get(m.group(1), m.group(1))
+        return copy.deepcopy(item[path]) if path in item else copy.deepcopy(values[m.group(2)])
+    m = re.match(r'list_append\(\s*([^,]+?)\s*,\s*([^)]+?)\s*\)$', rhs)
+    if m:
+        lists = [_set_value(item, p, names, values)['L'] for p in (m.group(1), m.group(2))]
+        return {'L': lists[0] + lists[1]}
+    if rhs.startswith(':'):
+        return copy.deepcopy(values[rhs])
+    return copy.deepcopy(item[names.get(rhs, rhs)])
+
+
+# ==================== ITEMS ====================
+
+_PK_CONDITION = re.compile(r'^\s*pk\s*=\s*(:\w+)(?:\s+AND\s+begins_with\(\s*sk\s*,\s*(:\w+)\s*\))?\s*$', re.IGNORECASE)
+
+
+def _key_value(av: Dict[str, Any]) -> str:
+    """Key attribute -> canonical string (numbers without trailing zeros)."""
+    if 'N' in av:
+        number = Decimal(av['N'])
+        return str(int(number)) if number == number.to_integral_value() else str(number.normalize())
+    return av['S']
+
+
+class ItemStore:
+    """
+    The DynamoDB low-level client calls the handler makes, over a store of
+    typed items keyed by (table, pk, sk). Subclasses provide _get, _put,
+    _delete, _range and _transaction.
+
+    Items go in and come out copied one level deep. Updates replace whole
+    attributes (values are deep-copied from the expression), so that is
+    enough to keep stored items isolated from callers.
+    """
+
+    class exceptions:
+        ConditionalCheckFailedException = ConditionalCheckFailedException
+
+    # ---- storage primitives ----
+
+    def _get(self, table: str, pk: str, sk: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def _put(self, table: str, pk: str, sk: str, item: Dict[str, Any]):
+        raise NotImplementedError
+
+    def _delete(self, table: str, pk: str, sk: str):
+        raise NotImplementedError
+
+    def _range(self, table: str, pk: str, prefix: str, forward: bool) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def _transaction(self):
+        """Context manager making a read-check-write sequence atomic."""
+        raise NotImplementedError
+
+    # ---- client API ----
+
+    @staticmethod
+    def _key(key: Dict[str, Any]) -> Tuple[str, str]:
+        return _key_value(key['pk']), _key_value(key['sk'])
+
+    @staticmethod
+    def _check(item, condition, names, values):
+        if condition and not _Expr(condition, names, values).condition(item or {}):
+            raise ConditionalCheckFailedException('The conditional request failed')
+
+    def get_item(self, TableName, Key, **kwargs):
+        item = self._get(TableName, *self._key(Key))
+        return {'Item': dict(item)} if item else {}
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, **kwargs):
+        pk, sk = self._key(Item)
+        with self._transaction():
+            if ConditionExpression:
+                self._check(self._get(TableName, pk, sk), ConditionExpression,
+                            ExpressionAttributeNames, ExpressionAttributeValues)
+            self._put(TableName, pk, sk, dict(Item))
+        return {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues=None,
+                    ExpressionAttributeNames=None, ConditionExpression=None, ReturnValues='NONE', **kwargs):
+        pk, sk = self._key(Key)
+        with self._transaction():
+            current = self._get(TableName, pk, sk)
+            self._check(current, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+            item = dict(current) if current else dict(Key)
+            _apply_update(item, UpdateExpression, ExpressionAttributeNames or {}, ExpressionAttributeValues or {})
+            self._put(TableName, pk, sk, item)
+        if ReturnValues in ('ALL_NEW', 'UPDATED_NEW'):
+            return {'Attributes': dict(item)}
+        if ReturnValues == 'ALL_OLD' and current:
+            return {'Attributes': dict(current)}
+        return {}
+
+    def delete_item(self, TableName, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues='NONE', **kwargs):
+        pk, sk = self._key(Key)
+        with self._transaction():
+            current = self._get(TableName, pk, sk)
+            if ConditionExpression:
+                self._check(current, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+            self._delete(TableName, pk, sk)
+        if ReturnValues == 'ALL_OLD' and current:
+            return {'Attributes': dict(current)}
+        return {}
+
+    def query(self, TableName, KeyConditionExpression, ExpressionAttributeValues=None,
+              ExpressionAttributeNames=None, FilterExpression=None, Limit=None,
+              ScanIndexForward=True, **kwargs):
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        match = _PK_CONDITION.match(KeyConditionExpression)
+        if not match:
+            raise ValueError(f"unsupported key condition: {KeyConditionExpression}")
+        prefix = values[match.group(2)]['S'] if match.group(2) else ''
+        items = self._range(TableName, _key_value(values[match.group(1)]), prefix, ScanIndexForward)
+        if FilterExpression:
+            items = [i for i in items if _Expr(FilterExpression, names, values).condition(i)]
+        if Limit:
+            items = items[:Limit]
+        return {'Items': [dict(i) for i in items], 'Count': len(items)}
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        responses = {}
+        for table, request in RequestItems.items():
+            if len(request['Keys']) > 100:
+                raise ValueError('Too many items requested for the BatchGetItem call')
+            found = (self._get(table, *self._key(key)) for key in request['Keys'])
+            responses[table] = [dict(item) for item in found if item]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        with self._transaction():
+            for table, requests in RequestItems.items():
+                for request in requests:
+                    if 'PutRequest' in request:
+                        item = request['PutRequest']['Item']
+                        self._put(table, *self._key(item), dict(item))
+                    else:
+                        self._delete(table, *self._key(request['DeleteRequest']['Key']))
+        return {'UnprocessedItems': {}}
+
+
+class MemoryItemStore(ItemStore):
+    """Items in per-(table, pk) dicts; gone when the process exits."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._partitions: Dict[Tuple[str, str], Dict[str, Dict[str, Any]]] = {}
+
+    def _get(self, table, pk, sk):
+        partition = self._partitions.get((table, pk))
+        return partition.get(sk) if partition else None
+
+    def _put(self, table, pk, sk, item):
+        with self._lock:
+            self._partitions.setdefault((table, pk), {})[sk] = item
+
+    def _delete(self, table, pk, sk):
+        with self._lock:
+            partition = self._partitions.get((table, pk))
+            if partition:
+                partition.pop(sk, None)
+
+    def _range(self, table, pk, prefix, forward):
+        with self._lock:
+            partition = dict(self._partitions.get((table, pk)) or {})
+        keys = sorted((sk for sk in partition if sk.startswith(prefix)), reverse=not forward)
+        return [partition[sk] for sk in keys]
+
+    def _transaction(self):
+        return self._lock
+
+
+class SQLiteItemStore(ItemStore):
+    """
+    Items in one SQLite database in WAL mode, so readers never wait for the
+    writer. Rows are keyed by (tbl, pk, sk) and hold the typed item as JSON.
+    is_active is copied into its own column and indexed with pk. Each thread
+    gets its own connection.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS items ("
+        " tbl TEXT NOT NULL, pk TEXT NOT NULL, sk TEXT NOT NULL, is_active INTEGER, item TEXT NOT NULL,"
+        " PRIMARY KEY (tbl, pk, sk)) WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS items_active ON items (tbl, pk, is_active)",
+    )
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._connection()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            self._local.conn = conn
+        return conn
+
+    def _get(self, table, pk, sk):
+        row = self._connection().execute(
+            'SELECT item FROM items WHERE tbl = ? AND pk = ? AND sk = ?', (table, pk, sk)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _put(self, table, pk, sk, item):
+        active = item.get('is_active')
+        self._connection().execute(
+            'INSERT OR REPLACE INTO items (tbl, pk, sk, is_active, item) VALUES (?, ?, ?, ?, ?)',
+            (table, pk, sk, int(Decimal(active['N'])) if active and 'N' in active else None,
+             json.dumps(item, separators=(',', ':'))))
+
+    def _delete(self, table, pk, sk):
+        self._connection().execute('DELETE FROM items WHERE tbl = ? AND pk = ? AND sk = ?', (table, pk, sk))
+
+    def _range(self, table, pk, prefix, forward):
+        order = 'ASC' if forward else 'DESC'
+        if prefix:
+            # [prefix, prefix with its last character bumped) is exactly the keys starting with prefix
+            upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            rows = self._connection().execute(
+                f'SELECT item FROM items WHERE tbl = ? AND pk = ? AND sk >= ? AND sk < ? ORDER BY sk {order}',
+                (table, pk, prefix, upper))
+        else:
+            rows = self._connection().execute(
+                f'SELECT item FROM items WHERE tbl = ? AND pk = ? ORDER BY sk {order}', (table, pk))
+        return [json.loads(row[0]) for row in rows]
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        conn = self._connection()
+        if conn.in_transaction:
+            yield
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+
+# ==================== OBJECTS ====================
+
+class NoSuchKey(Exception):
+    pass
+
+
+class S3Error(Exception):
+    """Shaped like botocore's ClientError: the code is in response['Error']['Code']."""
+
+    def __init__(self, code: str, message: str = ''):
+        super().__init__(f"An error occurred ({code}): {message}")
+        self.response = {'Error': {'Code': code, 'Message': message}}
+
+
+def _etag(body: bytes) -> str:
+    """S3's ETag of a single-part upload: the quoted MD5 of the body."""
+    return '"' + hashlib.md5(body).hexdigest() + '"'
+
+
+def _check_conditions(key: str, etag: Optional[str], IfMatch: Optional[str] = None, IfNoneMatch: Optional[str] = None):
+    """Apply S3's conditional request headers to the object's current ETag (None when it does not exist)."""
+    if IfMatch is not None:
+        if etag is None:
+            raise NoSuchKey(f"An error occurred (NoSuchKey): {key}")
+        if IfMatch not in ('*', etag):
+            raise S3Error('PreconditionFailed', f"{key} does not match {IfMatch}")
+    if IfNoneMatch is not None and etag is not None and IfNoneMatch in ('*', etag):
+        raise S3Error('PreconditionFailed', f"{key} already exists")
+
+
+class _Body(io.BytesIO):
+    """get_object()['Body']: read() plus botocore's iter_chunks()."""
+
+    def iter_chunks(self, chunk_size: int = 1024 * 1024):
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+class _Paginator:
+    def __init__(self, store: 'ObjectStore'):
+        self.store = store
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None, PaginationConfig=None, **kwargs):
+        page_size = (PaginationConfig or {}).get('PageSize', 1000)
+        token = None
+        while True:
+            page = self.store.list_objects_v2(Bucket=Bucket, Prefix=Prefix, Delimiter=Delimiter,
+                                              MaxKeys=page_size, ContinuationToken=token)
+            yield page
+            token = page.get('NextContinuationToken')
+            if not token:
+                return
+
+
+def _byte_range(body: bytes, spec: Optional[str]) -> bytes:
+    if not spec:
+        return body
+    start, end = spec[len('bytes='):].split('-')
+    if start == '':
+        return body[-int(end):]
+    return body[int(start):int(end) + 1 if end else None]
+
+
+class ObjectStore:
+    """
+    The S3 client calls the handler makes, over a store of objects keyed by
+    (bucket, key). Subclasses provide _read, _write, _remove and _keys.
+    Object metadata is not kept (the handler only writes it).
+    """
+
+    class exceptions:
+        NoSuchKey = NoSuchKey
+
+    _conditional = threading.Lock()  # a condition check and the write it guards happen as one step
+
+    def _read(self, bucket: str, key: str) -> Optional[Tuple[bytes, datetime.datetime]]:
+        raise NotImplementedError
+
+    def _write(self, bucket: str, key: str, body: bytes):
+        raise NotImplementedError
+
+    def _remove(self, bucket: str, key: str):
+        raise NotImplementedError
+
+    def _keys(self, bucket: str, prefix: str) -> List[Tuple[str, int, datetime.datetime]]:
+        """Sorted (key, size, last modified) of the objects under prefix."""
+        raise NotImplementedError
+
+    def _object(self, bucket: str, key: str) -> Tuple[bytes, datetime.datetime]:
+        found = self._read(bucket, key)
+        if found is None:
+            raise NoSuchKey(f"An error occurred (NoSuchKey): {key}")
+        return found
+
+    def _current_etag(self, bucket: str, key: str) -> Optional[str]:
+        found = self._read(bucket, key)
+        return _etag(found[0]) if found is not None else None
+
+    def put_object(self, Bucket, Key, Body=b'', IfMatch=None, IfNoneMatch=None, **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        elif hasattr(Body, 'read'):
+            Body = Body.read()
+        Body = bytes(Body)
+        if IfMatch is None and IfNoneMatch is None:
+            self._write(Bucket, Key, Body)
+        else:
+            with self._conditional:
+                _check_conditions(Key, self._current_etag(Bucket, Key), IfMatch, IfNoneMatch)
+                self._write(Bucket, Key, Body)
+        return {'ETag': _etag(Body)}
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None, **kwargs):
+        body, modified = self._object(Bucket, Key)
+        etag = _etag(body)
+        _check_conditions(Key, etag, IfMatch)
+        body = _byte_range(body, Range)
+        return {'Body': _Body(body), 'ContentLength': len(body), 'Metadata': {}, 'LastModified': modified,
+                'ETag': etag}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        body, modified = self._object(Bucket, Key)
+        return {'ContentLength': len(body), 'Metadata': {}, 'LastModified': modified, 'ETag': _etag(body)}
+
+    def delete_object(self, Bucket, Key, IfMatch=None, **kwargs):
+        if IfMatch is None:
+            self._remove(Bucket, Key)
+        else:
+            with self._conditional:
+                _check_conditions(Key, self._current_etag(Bucket, Key), IfMatch)
+                self._remove(Bucket, Key)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        for obj in Delete['Objects']:
+            self._remove(Bucket, obj['Key'])
+        return {'Deleted': Delete['Objects']}
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, MaxKeys=1000, ContinuationToken=None,
+                        StartAfter=None, **kwargs):
+        contents, prefixes = [], []
+        after = ContinuationToken or StartAfter
+        for key, size, modified in self._keys(Bucket, Prefix):
+            if after and key <= after:
+                continue
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                common = Prefix + rest.split(Delimiter, 1)[0] + Delimiter
+                if not prefixes or prefixes[-1] != common:
+                    prefixes.append(common)
+                continue
+            contents.append({'Key': key, 'Size': size, 'LastModified': modified})
+            if len(contents) >= MaxKeys:
+                break
+        page = {'Contents': contents, 'CommonPrefixes': [{'Prefix': p} for p in prefixes],
+                'KeyCount': len(contents)}
+        if len(contents) >= MaxKeys:
+            page['IsTruncated'] = True
+            page['NextContinuationToken'] = contents[-1]['Key']
+        return page
+
+    def get_paginator(self, name: str):
+        if name != 'list_objects_v2':
+            raise ValueError(f"unsupported paginator: {name}")
+        return _Paginator(self)
+
+
+class MemoryObjectStore(ObjectStore):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._objects: Dict[Tuple[str, str], Tuple[bytes, datetime.datetime]] = {}
+
+    def _read(self, bucket, key):
+        return self._objects.get((bucket, key))
+
+    def _write(self, bucket, key, body):
+        with self._lock:
+            self._objects[(bucket, key)] = (body, datetime.datetime.now(datetime.timezone.utc))
+
+    def _remove(self, bucket, key):
+        with self._lock:
+            self._objects.pop((bucket, key), None)
+
+    def _keys(self, bucket, prefix):
+        with self._lock:
+            found = [(k, len(b), m) for (bk, k), (b, m) in self._objects.items() if bk == bucket and k.startswith(prefix)]
+        return sorted(found)
+
+
+class FileObjectStore(ObjectStore):
+    """Objects as files under root/bucket/key; writes go to a temporary file that is renamed into place."""
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+
+    def _path(self, bucket: str, key: str) -> str:
+        path = os.path.normpath(os.path.join(self.root, bucket, key))
+        if not path.startswith(os.path.join(self.root, bucket) + os.sep):
+            raise ValueError(f"object key escapes the bucket: {key}")
+        return path
+
+    def _read(self, bucket, key):
+        path = self._path(bucket, key)
+        try:
+            with open(path, 'rb') as f:
+                body = f.read()
+            modified = os.stat(path).st_mtime
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return None
+        return body, datetime.datetime.fromtimestamp(modified, datetime.timezone.utc)
+
+    def _write(self, bucket, key, body):
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(body)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _remove(self, bucket, key):
+        try:
+            os.unlink(self._path(bucket, key))
+        except FileNotFoundError:
+            pass
+
+    def _keys(self, bucket, prefix):
+        base = os.path.join(self.root, bucket)
+        # Only walk the deepest directory the prefix names
+        start = os.path.join(base, os.path.dirname(prefix)) if '/' in prefix else base
+        found = []
+        for directory, _, files in os.walk(start):
+            for name in files:
+                if name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(directory, name)
+                key = os.path.relpath(path, base).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    stat = os.stat(path)
+                    found.append((key, stat.st_size,
+                                  datetime.datetime.fromtimestamp(stat.st_mtime, datetime.timezone.utc)))
+        return sorted(found)
+
+
+# ==================== SELECTION ====================
+
+def open_storage(backend: str, path: str) -> Tuple[ItemStore, ObjectStore]:
+    """
+    Build the (items, objects) pair for STORAGE_BACKEND.
+
+    sqlite keeps items in path/items.db and objects under path/objects/.
+    """
+    if backend == 'memory':
+        return MemoryItemStore(), MemoryObjectStore()
+    if backend == 'sqlite':
+        os.makedirs(path, exist_ok=True)
+        return SQLiteItemStore(os.path.join(path, 'items.db')), FileObjectStore(os.path.join(path, 'objects'))
+    raise ValueError(f"unknown storage backend: {backend!r} (expected aws, sqlite or memory)")
@@ -0,0 +1,79 @@
+"""Circuit breaker probes that the invocation deadline cuts short."""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import handler  # noqa: E402
+
+URL = 'http://ollama.test'
+
+
+class StubResponse:
+    status_code = 200
+    content = b'{"message": {"content": "hello"}}'
+    text = ''
+
+
+class StubHTTP:
+    """Ollama stand-in: fails after `delay` seconds while `failing`, answers otherwise."""
+
+    def __init__(self):
+        self.failing = False
+        self.delay = 0.0
+        self.calls = 0
+
+    def post(self, url, **kwargs):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.failing:
+            raise ConnectionError("timed out")
+        return StubResponse()
+
+
+def setup(monkeypatch):
+    http = StubHTTP()
+    monkeypatch.setattr(handler, 'OLLAMA_URL', URL)
+    monkeypatch.setattr(handler, 'OLLAMA_URLS', [])
+    monkeypatch.setattr(handler, 'OLLAMA_FALLBACK_MODEL', '')
+    monkeypatch.setattr(handler, 'DEADLINE_RESERVE_MS', 0)
+    monkeypatch.setattr(handler, '_model_target_cache', {})
+    monkeypatch.setattr(handler, 'get_http', lambda: http)
+    handler.begin_invocation()
+    target = handler.model_targets('llama3')[0]
+    # Open, with the cooldown already over: the next allow() hands out the half-open probe
+    for _ in range(handler.BREAKER_FAILURES):
+        target.breaker.record_failure(time.monotonic() - handler.BREAKER_COOLDOWN - 1, 'error 500')
+    assert target.breaker.state == 'open'
+    return http, target
+
+
+def assert_next_call_allowed(http, target):
+    handler.begin_invocation()  # no deadline
+    http.failing, http.delay = False, 0.0
+    assert handler.call_ollama('llama3', [{'role': 'user', 'content': 'hi'}]) == 'hello'
+    assert target.breaker.state == 'closed'
+    assert not target.breaker.probing
+
+
+def test_probe_cut_during_the_call_is_released(monkeypatch):
+    http, target = setup(monkeypatch)
+    handler._trace.deadline = time.monotonic() + 1.05
+    http.failing, http.delay = True, 1.0
+    reply = handler.call_ollama('llama3', [{'role': 'user', 'content': 'hi'}])
+    assert reply.startswith("Sorry, I ran out of time")
+    assert http.calls == 1
+    assert not target.breaker.probing
+    assert_next_call_allowed(http, target)
+
+
+def test_no_probe_is_taken_without_time_for_it(monkeypatch):
+    http, target = setup(monkeypatch)
+    handler._trace.deadline = time.monotonic() + 0.5
+    reply = handler.call_ollama('llama3', [{'role': 'user', 'content': 'hi'}])
+    assert reply.startswith("Sorry, I ran out of time")
+    assert http.calls == 0
+    assert not target.breaker.probing
+    assert_next_call_allowed(http, target)
@@ -55,4 +55,15 @@ variable "lambda_timeout" {
   description = "Lambda function timeout in seconds"
   type        = number
   default     = 30
-}
\ No newline at end of file
+}
+
+variable "log_level" {
+  description = "Handler log level (DEBUG, INFO, WARNING, ERROR)"
+  type        = string
+  default     = "INFO"
+
+  validation {
+    condition     = contains(["DEBUG", "INFO", "WARNING", "ERROR"], var.log_level)
+    error_message = "Log level must be DEBUG, INFO, WARNING, or ERROR."
+  }
+}